@@ -8,12 +8,13 @@
 # supplied dataset.
 ####################################################################
 
-import xml.etree.cElementTree as ET
 import csv
 import codecs
 import re
 import pprint
+import osm_parsers
 from collections import defaultdict
+from street_names import MAPPING, StreetNameNormalizer
 
 # ================================================== #
 # Input File
@@ -65,139 +66,260 @@ expected = ["Street",
             "Way",
             "Circle"]
 
+street_normalizer = StreetNameNormalizer(MAPPING)
+
+# ================================================== #
+# Auditor framework
+#
+# Each auditor declares the top level elements and
+# the tag keys it is interested in. run_auditors()
+# parses the OSM file once and dispatches every
+# element to the auditors that registered for it.
+# ================================================== #
+TOP_LEVEL_ELEMENTS = ('node', 'way', 'relation')
+
+# Register for every tag key rather than a fixed list
+ALL_KEYS = None
+
+
+class Auditor(object):
+    """Base class for an auditor fed by run_auditors()"""
+
+    # Receive every XML element parsed in on_xml_element()
+    count_all = False
+
+    # Top level elements passed to on_element()
+    element_types = ()
+
+    # Tag keys passed to on_tag(), ALL_KEYS for every key
+    tag_keys = ()
+
+    # Top level elements whose child tags are passed to on_tag()
+    tag_parents = ('node', 'way')
+
+    def on_xml_element(self, elem):
+        pass
+
+    def on_element(self, elem):
+        pass
+
+    def on_tag(self, elem, tag):
+        pass
+
+    def result(self):
+        raise NotImplementedError
+
+
 # ================================================== #
-# Mapping for correcting street type names
-# ================================================== #
-MAPPING = {"St":      "Street",
-           "Strret":  "Street",
-           "Street ": "Street",
-           "st":      "Street",
-           "ST.":     "Street",
-           "Ave":     "Avenue",
-           "ave.":    "Avenue",
-           "Ave.":    "Avenue",
-           "Av":      "Avenue",
-           "avenue":  "Avenue",
-           "Rd.":     "Road",
-           "Rd":      "Road",
-           "rd":      "Road",
-           "Raod":    "Road",
-           "Pkwy":    "Parkway",
-           "Pky":     "Parkway",
-           "ct":      "Court",
-           "Dr":      "Drive",
-           "dr":      "Drive",
-           "trail":   "Trail",
-           "Pl":      "Place",
-           "Ct":      "Court",
-           "Blvd":    "Boulevard",
-           "ste.":    "Suite",
-           "Ste":     "Suite",
-           "ste":     "Suite"}
+# Auditor to count the number of tags by type
+# ================================================== #
+class TagCountAuditor(Auditor):
+
+    count_all = True
+
+    def __init__(self):
+        self.tags = {}
+
+    def on_xml_element(self, elem):
+        if elem.tag in self.tags:
+            self.tags[elem.tag] += 1
+        else:
+            self.tags[elem.tag] = 1
+
+    def result(self):
+        return self.tags
+
 
 # ================================================== #
-# Function to audit an OSM file and check for
-# unexpected zip codes
+# Auditor to count the number of tags that contain
+# potential problem characters
+# ================================================== #
+class ProblemTagAuditor(Auditor):
+
+    tag_keys    = ALL_KEYS
+    tag_parents = TOP_LEVEL_ELEMENTS
+
+    def __init__(self):
+        self.keys = {"lower":         0,
+                     "lower_colon":   0,
+                     "problem_chars": 0,
+                     "other":         0}
+
+    def on_tag(self, elem, tag):
+        self.keys = categorize_key_type(tag, self.keys)
+
+    def result(self):
+        return self.keys
+
+
+# ================================================== #
+# Auditor to collect the unique users that have
+# contributed to the data
+# ================================================== #
+class UserAuditor(Auditor):
+
+    element_types = TOP_LEVEL_ELEMENTS
+
+    def __init__(self):
+        self.users = set()
+
+    def on_element(self, elem):
+        self.users.add(elem.attrib['user'])
+
+    def result(self):
+        return self.users
+
+
+# ================================================== #
+# Auditor to find all street names that do not
+# match an expected value
+# ================================================== #
+class UnexpectedStreetAuditor(Auditor):
+
+    tag_keys = ('addr:street',)
+
+    def __init__(self):
+        self.unexp_street_types = defaultdict(set)
+
+    def on_tag(self, elem, tag):
+        address = tag.attrib['v']
+        self.unexp_street_types = check_street_unexp(self.unexp_street_types, address)
+        street_normalizer(address)
+
+    def result(self):
+        return self.unexp_street_types
+
+
+# ================================================== #
+# Auditor to count the number of each street type
+# ================================================== #
+class StreetTypeAuditor(Auditor):
+
+    tag_keys = ('addr:street',)
+
+    def __init__(self):
+        self.street_types_count = defaultdict(set)
+        initialize_street_types_count(self.street_types_count)
+
+    def on_tag(self, elem, tag):
+        self.street_types_count = check_street_exp(self.street_types_count, tag.attrib['v'])
+
+    def result(self):
+        return self.street_types_count
+
+
+# ================================================== #
+# Auditor to check for unexpected zip codes
+# ================================================== #
+class ZipCodeAuditor(Auditor):
+
+    tag_keys = ('addr:postcode', 'tiger:zip_left', 'tiger:zip_right')
+
+    def __init__(self):
+        self.unexp_zip_codes = defaultdict(set)
+
+    def on_tag(self, elem, tag):
+        self.unexp_zip_codes = check_zip_code(self.unexp_zip_codes, tag.attrib['v'])
+
+    def result(self):
+        return self.unexp_zip_codes
+
+
+# ================================================== #
+# Function to run a list of auditors over an OSM
+# file in a single parsing pass and return their
+# results in the same order
 # ================================================== #
-def audit_zip_codes(osmfile):
-    osm_file = open(osmfile, "r")
-    unexp_zip_codes = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+def run_auditors(osmfile, auditors, parser=None):
+
+    # Build the dispatch tables once so the parsing
+    # loop only does dictionary lookups
+    any_callbacks     = []
+    element_callbacks = defaultdict(list)
+    all_tag_callbacks = defaultdict(list)
+    tag_callbacks     = defaultdict(lambda: defaultdict(list))
+
+    for auditor in auditors:
+        if auditor.count_all:
+            any_callbacks.append(auditor.on_xml_element)
+        for element_type in auditor.element_types:
+            element_callbacks[element_type].append(auditor.on_element)
+        for parent in auditor.tag_parents:
+            if auditor.tag_keys is ALL_KEYS:
+                all_tag_callbacks[parent].append(auditor.on_tag)
+            else:
+                for key in auditor.tag_keys:
+                    tag_callbacks[parent][key].append(auditor.on_tag)
+
+    for elem in stream_elements(osmfile, parser):
+
+        for callback in any_callbacks:
+            callback(elem)
 
-        if elem.tag == "node" or elem.tag == "way":
+        if elem.tag not in TOP_LEVEL_ELEMENTS:
+            continue
+
+        for callback in element_callbacks.get(elem.tag, ()):
+            callback(elem)
+
+        all_tags   = all_tag_callbacks.get(elem.tag, ())
+        keyed_tags = tag_callbacks.get(elem.tag, {})
+        if all_tags or keyed_tags:
             for tag in elem.iter("tag"):
-                if is_zip_code(tag):
-                    unexp_zip_codes = check_zip_code(unexp_zip_codes, tag.attrib['v'])
-    osm_file.close()
-    return unexp_zip_codes
+                for callback in all_tags:
+                    callback(elem, tag)
+                for callback in keyed_tags.get(tag.attrib['k'], ()):
+                    callback(elem, tag)
+
+    return [auditor.result() for auditor in auditors]
+
+
+# ================================================== #
+# Function to audit an OSM file and check for
+# unexpected zip codes
+# ================================================== #
+def audit_zip_codes(osmfile, parser=None):
+    return run_auditors(osmfile, [ZipCodeAuditor()], parser)[0]
 
 
 # ================================================== #
 # Function to audit an OSM file and count the number
 # of tags by type
 # ================================================== #
-def audit_tags(filename):
-    tags = {}
-    for event, elem in ET.iterparse(filename):
-        if elem.tag in tags:
-            tags[elem.tag] += 1
-        else:
-            tags[elem.tag] = 1
-    return tags
+def audit_tags(filename, parser=None):
+    return run_auditors(filename, [TagCountAuditor()], parser)[0]
 
 
 # ================================================== #
 # Function to audit an OSM file and count the number
 # of tags that contain potential problem characters
 # ================================================== #
-def audit_problem_tags(filename):
-    keys = {"lower":         0,
-            "lower_colon":   0,
-            "problem_chars": 0,
-            "other":         0}
-    for _, element in ET.iterparse(filename):
-        keys = categorize_key_type(element, keys)
-    return keys
+def audit_problem_tags(filename, parser=None):
+    return run_auditors(filename, [ProblemTagAuditor()], parser)[0]
 
 
 # ================================================== #
 # Function to audit an OSM file and count the number
 # of unique users that have contributed to the data
 # ================================================== #
-def audit_users(filename):
-    users = set()
-    for _, element in ET.iterparse(filename):
-
-        if element.tag == "node":
-            for tag in element.iter("node"):
-                if tag.attrib['user'] not in users:
-                    users.add(tag.attrib['user'])
-        if element.tag == "relation":
-            for tag in element.iter("relation"):
-                if tag.attrib['user'] not in users:
-                    users.add(tag.attrib['user'])
-        if element.tag == "way":
-            for tag in element.iter("way"):
-                if tag.attrib['user'] not in users:
-                    users.add(tag.attrib['user'])
-    return users
+def audit_users(filename, parser=None):
+    return run_auditors(filename, [UserAuditor()], parser)[0]
 
 
 # ================================================== #
 # Function to audit an OSM file and find all street
 # names that do not match an expected value
 # ================================================== #
-def audit_unexpected_streets(osmfile):
-    osm_file = open(osmfile, "r")
-    unexp_street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    address = tag.attrib['v']
-                    unexp_street_types = check_street_unexp(unexp_street_types, address)
-                    fix_street_name(address, MAPPING)
-    osm_file.close()
-    return unexp_street_types
+def audit_unexpected_streets(osmfile, parser=None):
+    return run_auditors(osmfile, [UnexpectedStreetAuditor()], parser)[0]
 
 
 # ================================================== #
 # Function to audit an OSM file and count the number
 # of each street type
 # ================================================== #
-def audit_street_types(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types_count = defaultdict(set)
-    initialize_street_types_count(street_types_count)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    street_types_count = check_street_exp(street_types_count, tag.attrib['v'])
-    osm_file.close()
-    return street_types_count
+def audit_street_types(osmfile, parser=None):
+    return run_auditors(osmfile, [StreetTypeAuditor()], parser)[0]
 
 
 # ================================================== #
@@ -303,7 +425,7 @@ def is_zip_valid(zip_code):
 # ================================================== #
 def is_street_name(tag):
 
-    if (tag == "addr:street"):
+    if (tag.attrib['k'] == "addr:street"):
         return True
     else:
         return False
@@ -332,34 +454,24 @@ def initialize_street_types_count(street_types_count):
 
 
 # ================================================== #
-# Helper Function to update a bad street name based
-# on a defined mapping
+# Helper Function to stream every element from the
+# OSM file with bounded memory. Each element is
+# yielded once fully parsed, then top level elements
+# are released so only the audit results are kept
 # ================================================== #
-def fix_street_name(address, mapping):
-    words = address.split()
-    for w in range(len(words)):
-        if words[w] in mapping:
-            # Don't update 'Apartment E' to 'Apartment East'
-            if words[w-1].lower() in [ 'apartment', 'apt', 'building', 'suite', 'ste.', 'ste']:
-                continue
-            else:
-                words[w] = mapping[words[w]]
-                address = " ".join(words)
-    return address
+def stream_elements(osm_file, parser=None):
+    """Yield every element on its end event, with an osm_parsers backend"""
+
+    return osm_parsers.iter_elements(osm_file, None, parser)
 
 
 # ================================================== #
 # Helper Function to grab an element from the OSM
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def get_element(osm_file, tags=('node', 'way', 'relation'), parser=None):
     """Yield element if it is the right type of tag"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return osm_parsers.iter_elements(osm_file, tags, parser)
 
 # ================================================== #
 # Helper Function to write to csv files
@@ -382,44 +494,42 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 # Function to audit and find issues with the data
 # ================================================== #
-def audit():
+def audit(parser=None):
 
     '''
+    Run every auditor over the OSM file in a single pass
     '''
 
+    (tags,
+     keys,
+     users,
+     unexp_street_types,
+     street_types_count,
+     unexp_zip_codes) = run_auditors(OSM_FILE, [TagCountAuditor(),
+                                                ProblemTagAuditor(),
+                                                UserAuditor(),
+                                                UnexpectedStreetAuditor(),
+                                                StreetTypeAuditor(),
+                                                ZipCodeAuditor()],
+                                               parser)
+
     # Count the number of unique tags within the XML file
-    tags = audit_tags(OSM_FILE)
     pprint.pprint(tags)
 
-    '''
     # Count the number of potential problem tags
-    keys = audit_problem_tags(OSM_FILE)
     pprint.pprint(keys)
-    '''
 
-    '''
     # Count the number of unique users that have contributed
-    users = audit_users(OSM_FILE)
     pprint.pprint(len(users))
-    '''
 
-    '''
     # Audit the street names and formatting
-    unexp_street_types = audit_unexpected_streets(OSM_FILE)
-    # pprint.pprint(dict(unexp_street_types))
-    '''
+    pprint.pprint(dict(unexp_street_types))
 
-    '''
     # Count the number of street types
-    street_types_count = audit_street_types(OSM_FILE)
     pprint.pprint(dict(street_types_count))
-    '''
 
-    '''
     # Audit the zip codes of elements
-    unexp_zip_codes = audit_zip_codes(OSM_FILE)
     pprint.pprint(dict(unexp_zip_codes))
-    '''
 
 
 # ================================================== #
@@ -0,0 +1,284 @@
+####################################################################
+# File: benchmark.py
+#
+# Description: This code times the audit, clean, load, query and
+# sample stages end to end, on a given OSM file or on a synthetic
+# one from synth_osm.py. Each stage runs in its own process so its
+# peak memory can be measured. Results can be saved as a JSON
+# baseline and later runs report their change against it.
+####################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import audit_osm_data
+import clean_osm_data
+import osm_db
+import osm_input
+import osm_parsers
+import split_osm
+import synth_osm
+
+# ================================================== #
+# Baseline File
+# ================================================== #
+BASELINE_PATH = "benchmark_baseline.json"
+
+# Slowdown (as a fraction) reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+STAGES = ['audit', 'clean', 'load', 'query', 'sample']
+
+
+# ================================================== #
+# Stage Functions. Each gets the input file and a
+# scratch directory; output goes to the directory
+# ================================================== #
+def stage_audit(osm_file, work_dir):
+    audit_osm_data.OSM_FILE = osm_file
+    audit_osm_data.audit()
+
+
+def stage_clean(osm_file, work_dir):
+    os.chdir(work_dir)
+    clean_osm_data.process_map(osm_file)
+
+
+def stage_load(osm_file, work_dir):
+    db_path = os.path.join(work_dir, "benchmark.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    clean_osm_data.load_map(osm_file, db_path)
+
+
+def stage_query(osm_file, work_dir):
+    db = sqlite3.connect(os.path.join(work_dir, "benchmark.db"))
+    try:
+        osm_db.time_queries(db, osm_db.QUERIES, repeat=1)
+    finally:
+        db.close()
+
+
+def stage_sample(osm_file, work_dir):
+    split_osm.sample_osm(osm_file, [(10,  os.path.join(work_dir, "sample_10.osm")),
+                                    (400, os.path.join(work_dir, "sample_400.osm"))])
+
+
+STAGE_FUNCTIONS = {'audit':  stage_audit,
+                   'clean':  stage_clean,
+                   'load':   stage_load,
+                   'query':  stage_query,
+                   'sample': stage_sample}
+
+
+# ================================================== #
+# Helper Function run in the child process: time one
+# stage with its output silenced and send back the
+# elapsed time and peak RSS
+# ================================================== #
+def run_child(stage, osm_file, work_dir, conn):
+
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull
+    try:
+        start = time.time()
+        STAGE_FUNCTIONS[stage](osm_file, work_dir)
+        elapsed = time.time() - start
+
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak /= 1024
+        conn.send((elapsed, peak / 1024.0, None))
+    except Exception as e:
+        conn.send((None, None, "%s: %s" % (type(e).__name__, e)))
+    finally:
+        sys.stdout = sys.__stdout__
+        devnull.close()
+        conn.close()
+
+
+# ================================================== #
+# Function to run one stage in a fresh process
+# ================================================== #
+def run_stage(stage, osm_file, work_dir):
+
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_child,
+                                      args=(stage, osm_file, work_dir, child_conn))
+    process.start()
+    elapsed, peak_mb, error = parent_conn.recv()
+    process.join()
+
+    if error:
+        raise RuntimeError("%s stage failed: %s" % (stage, error))
+    return elapsed, peak_mb
+
+
+# ================================================== #
+# Helper Function to count the top level elements
+# ================================================== #
+def count_elements(osm_file):
+    if osm_input.is_pbf(osm_file):
+        return sum(1 for _ in osm_parsers.iter_elements(osm_file, ('node', 'way', 'relation')))
+    return sum(len(bounds) - 1 for _, bounds in split_osm.get_element_bounds(osm_file))
+
+
+# ================================================== #
+# Function to run the benchmark stages and collect
+# throughput and peak memory for each
+# ================================================== #
+def run_benchmark(osm_file, stages=STAGES, work_dir=None):
+
+    osm_file = os.path.abspath(osm_file)
+    size     = os.path.getsize(osm_file)
+    elements = count_elements(osm_file)
+
+    own_dir  = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="osm_benchmark_")
+    results  = {'input': osm_file, 'bytes': size, 'elements': elements, 'stages': {}}
+    try:
+        # The queries need the database the load stage builds
+        if 'query' in stages and 'load' not in stages:
+            run_stage('load', osm_file, work_dir)
+
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            elapsed, peak_mb = run_stage(stage, osm_file, work_dir)
+            elapsed = max(elapsed, 1e-9)
+            results['stages'][stage] = {'seconds':          elapsed,
+                                        'mb_per_sec':       size / 1e6 / elapsed,
+                                        'elements_per_sec': elements / elapsed,
+                                        'peak_rss_mb':      peak_mb}
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir)
+
+    return results
+
+
+# ================================================== #
+# Function to compare a run with a saved baseline.
+# Returns {stage: (time change, memory change)} as
+# fractions
+# ================================================== #
+def compare_to_baseline(results, baseline):
+
+    deltas = {}
+    for stage, current in results['stages'].items():
+        previous = baseline['stages'].get(stage)
+        if previous is None:
+            continue
+        deltas[stage] = (current['seconds'] / previous['seconds'] - 1,
+                         current['peak_rss_mb'] / previous['peak_rss_mb'] - 1)
+    return deltas
+
+
+# ================================================== #
+# Function to print the results table, with the
+# baseline changes when there are any. Returns the
+# stages that got slower than the threshold allows
+# ================================================== #
+def print_results(results, deltas=None, threshold=REGRESSION_THRESHOLD):
+
+    print "Input: %s (%.1f MB, %d elements)" % (results['input'],
+                                                results['bytes'] / 1e6,
+                                                results['elements'])
+    print "%-8s %10s %10s %14s %10s %10s %10s" % ("stage", "seconds", "MB/s", "elements/s",
+                                                  "peak MB", "time", "memory")
+    regressions = []
+    for stage in STAGES:
+        if stage not in results['stages']:
+            continue
+        current = results['stages'][stage]
+        time_delta = memory_delta = ""
+        if deltas and stage in deltas:
+            time_delta   = "%+.1f%%" % (deltas[stage][0] * 100)
+            memory_delta = "%+.1f%%" % (deltas[stage][1] * 100)
+            if deltas[stage][0] > threshold:
+                regressions.append(stage)
+                time_delta += " !"
+        print "%-8s %10.2f %10.2f %14.0f %10.1f %10s %10s" % (stage,
+                                                               current['seconds'],
+                                                               current['mb_per_sec'],
+                                                               current['elements_per_sec'],
+                                                               current['peak_rss_mb'],
+                                                               time_delta,
+                                                               memory_delta)
+    if regressions:
+        print "Regressions over %.0f%%: %s" % (threshold * 100, ", ".join(regressions))
+    return regressions
+
+
+# ================================================== #
+# Main()
+# ================================================== #
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Time the OSM pipeline stages")
+    parser.add_argument('--input', help="OSM file (default: a synthetic file)")
+    parser.add_argument('--scale', type=float, default=synth_osm.SCALE,
+                        help="synthetic file size, 1 is about 10 MB")
+    parser.add_argument('--seed', type=int, default=synth_osm.SEED)
+    parser.add_argument('--stages', default=",".join(STAGES))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--parser', default=osm_parsers.PARSER, choices=list(osm_parsers.PARSERS),
+                        help="XML parser backend for the audit, clean and load stages")
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+
+    # Stage processes are forked, so they inherit the backend
+    osm_parsers.set_parser(args.parser)
+
+    synth_dir = None
+    osm_file  = args.input
+    if osm_file is None:
+        synth_dir = tempfile.mkdtemp(prefix="osm_synth_")
+        osm_file  = os.path.join(synth_dir, "synthetic_%g.osm" % args.scale)
+        synth_osm.write_synthetic_osm(osm_file, args.scale, args.seed)
+
+    try:
+        results = run_benchmark(osm_file, stages)
+        results['parser'] = args.parser
+    finally:
+        if synth_dir:
+            shutil.rmtree(synth_dir)
+
+    deltas = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['bytes'] != results['bytes']:
+            print "Baseline input was %d bytes, this one is %d" % (baseline['bytes'], results['bytes'])
+        if baseline.get('parser', 'etree') != results['parser']:
+            print "Baseline used the %s parser, this run %s" % (baseline.get('parser', 'etree'),
+                                                              results['parser'])
+        deltas = compare_to_baseline(results, baseline)
+
+    regressions = print_results(results, deltas, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print "Saved baseline to %s" % args.baseline
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,9 +8,23 @@
 ####################################################################
 
 import xml.etree.cElementTree as ET
+import osm_db
+import osm_input
+import osm_parsers
 import csv
 import codecs
-from collections import defaultdict
+import cStringIO
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import timeit
+from collections import defaultdict, namedtuple
+from street_names import MAPPING, StreetNameNormalizer, fix_street_name
 
 # ================================================== #
 # Input File
@@ -18,6 +32,12 @@ from collections import defaultdict
 OSM_FILE = 'denver-boulder_colorado_small.osm'
 # OSM_FILE = 'denver-boulder_colorado.osm'
 
+# ================================================== #
+# Number of worker processes for process_map
+# (1 runs the serial path)
+# ================================================== #
+WORKERS = 1
+
 # ================================================== #
 # Output Files
 # ================================================== #
@@ -27,6 +47,37 @@ WAYS_PATH      = "ways.csv"
 WAY_NODES_PATH = "way_nodes.csv"
 WAY_TAGS_PATH  = "way_tags.csv"
 
+# ================================================== #
+# Output directory for the columnar (.npy) format
+# ================================================== #
+COLUMNAR_DIR = "osm_columns"
+
+# ================================================== #
+# Values that fail schema validation in process_map
+# ================================================== #
+VALIDATION_PATH = "validation_failures.csv"
+
+# ================================================== #
+# Checkpoints for long process_map runs, written each
+# time this many input bytes have been cleaned
+# ================================================== #
+CHECKPOINT_PATH  = "process_map.checkpoint"
+CHECKPOINT_BYTES = 64 << 20
+
+# ================================================== #
+# Output Database, shared with the query scripts
+# ================================================== #
+DB_PATH = osm_db.DB_PATH
+
+# Rows per executemany() call when loading the database
+BATCH_SIZE = 10000
+
+# ================================================== #
+# Stage profiler for the current process_map run, or
+# None when it is not being profiled
+# ================================================== #
+PROFILER = None
+
 # ================================================== #
 # Output File Formatting
 # ================================================== #
@@ -36,40 +87,82 @@ WAY_FIELDS       = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS  = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# Fixed layout records produced by shape_node/shape_way
+Node    = namedtuple('Node',    NODE_FIELDS)
+Way     = namedtuple('Way',     WAY_FIELDS)
+Tag     = namedtuple('Tag',     NODE_TAGS_FIELDS)
+WayNode = namedtuple('WayNode', WAY_NODES_FIELDS)
+
+# Output files in the order they are opened by process_map
+OUTPUT_PATHS  = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+OUTPUT_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS]
+
 # ================================================== #
-# Mapping for correcting street type names
-# ================================================== #
-MAPPING = {"St":      "Street",
-           "Strret":  "Street",
-           "Street ": "Street",
-           "st":      "Street",
-           "ST.":     "Street",
-           "Ave":     "Avenue",
-           "ave.":    "Avenue",
-           "Ave.":    "Avenue",
-           "Av":      "Avenue",
-           "avenue":  "Avenue",
-           "Rd.":     "Road",
-           "Rd":      "Road",
-           "rd":      "Road",
-           "Raod":    "Road",
-           "Pkwy":    "Parkway",
-           "Pky":     "Parkway",
-           "ct":      "Court",
-           "Dr":      "Drive",
-           "dr":      "Drive",
-           "trail":   "Trail",
-           "Pl":      "Place",
-           "Ct":      "Court",
-           "Blvd":    "Boulevard",
-           "ste.":    "Suite",
-           "Ste":     "Suite",
-           "ste":     "Suite"}
+# Database tables, matching schema.sql
+# ================================================== #
+OUTPUT_TABLES = ['nodes', 'node_tags', 'ways', 'way_nodes', 'way_tags']
+
+CREATE_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INT PRIMARY KEY NOT NULL,
+    lat FLOAT,
+    lon FLOAT,
+    user TEXT,
+    uid INT,
+    version INT,
+    changeset INT,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ways (
+    id INT PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INT,
+    version TEXT,
+    changeset INT,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS way_nodes (
+    id INT REFERENCES ways,
+    node_id INT REFERENCES nodes,
+    position INT
+);
+"""
+
+# Plain tag tables (see osm_db for the dictionary
+# encoded ones)
+CREATE_TAG_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS node_tags (
+    id INT REFERENCES nodes,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+
+CREATE TABLE IF NOT EXISTS way_tags (
+    id INT REFERENCES ways,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+"""
+
+# Pragmas used while bulk loading, restored afterwards
+LOAD_PRAGMAS = {'synchronous':  'OFF',
+                'journal_mode': 'MEMORY',
+                'temp_store':   'MEMORY',
+                'cache_size':   '-262144'}
 
+# ================================================== #
+# Regex forms
+# ================================================== #
+element_start_re = re.compile(r'<(?:node|way|relation)[\s/>]')
+osm_end_re       = re.compile(r'</osm\s*>')
 
 # ================================================== #
 # Function to clean XML node elements and return
-# a Python Dictionary of the cleaned elements
+# a Python Dictionary of the cleaned records
 # ================================================== #
 def shape_node(element):
 
@@ -77,41 +170,30 @@ def shape_node(element):
     # NODE_FIELDS      = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
     # NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 
-    node_element      = {}
-    node_element_tags = []
+    attrib     = element.attrib
+    element_id = get_element_id(element)
 
     # Gather NODE FIELD attributes
-    for item in NODE_FIELDS:
-        if item in element.attrib:
-            node_element[item] = element.attrib[item]
+    node_element = Node._make([attrib.get(item) for item in NODE_FIELDS])
 
     # Gather all sub element tags
-    for subelem in element:
-
-        # TAG subelement
-        if subelem.tag == "tag":
-            node_element_tag          = {}
-            node_element_tag['id']    = get_element_id(element)
-            node_element_tag["type"]  = get_tag_type(subelem)
-            node_element_tag["key"]   = get_tag_key(subelem)
-            node_element_tag["value"] = get_tag_value(subelem)
-            node_element_tags.append(node_element_tag)
-
-    # clean the TIGER data gathered
-    node_element_tags = clean_tiger_data(node_element_tags)
+    node_element_tags = [make_tag(element_id, subelem.attrib)
+                         for subelem in element if subelem.tag == "tag"]
 
-    # Clean Addresses
-    node_element_tags = clean_addresses(node_element_tags)
-
-    # Clean Zip Codes
-    node_element_tags = clean_zip_codes(node_element_tags)
+    # Clean the TIGER data, addresses and zip codes,
+    # timed as its own stage when profiling
+    if PROFILER:
+        PROFILER.lap('shape_node')
+    node_element_tags = tag_cleaner.clean(node_element_tags)
+    if PROFILER:
+        PROFILER.lap('clean_tags')
 
     return {'node': node_element, 'node_tags': node_element_tags}
 
 
 # ================================================== #
 # Function to clean XML way elements and return
-# a Python Dictionary of the cleaned elements
+# a Python Dictionary of the cleaned records
 # ================================================== #
 def shape_way(element):
 
@@ -120,112 +202,48 @@ def shape_way(element):
     # WAY_TAGS_FIELDS  = ['id', 'key', 'value', 'type']
     # WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
-    way_element       = {}
+    attrib     = element.attrib
+    element_id = get_element_id(element)
+
     way_element_tags  = []
     way_element_nodes = []
 
     # Gather WAY FIELD attributes
-    for item in WAY_FIELDS:
-        if item in element.attrib:
-            way_element[item] = element.attrib[item]
+    way_element = Way._make([attrib.get(item) for item in WAY_FIELDS])
 
     # Gather all sub element tags
     for index, subelem in enumerate(element):
 
         # NODE subelement
         if subelem.tag == "nd":
-            way_element_node             = {}
-            way_element_node['id']       = get_element_id(element)
-            way_element_node["node_id"]  = get_node_id(subelem)
-            way_element_node["position"] = index
-            way_element_nodes.append(way_element_node)
+            way_element_nodes.append(WayNode(element_id, get_node_id(subelem), index))
 
         # TAG subelement
-        if subelem.tag == "tag":
-            way_element_tag          = {}
-            way_element_tag['id']    = get_element_id(element)
-            way_element_tag["type"]  = get_tag_type(subelem)
-            way_element_tag["key"]   = get_tag_key(subelem)
-            way_element_tag["value"] = get_tag_value(subelem)
-            way_element_tags.append(way_element_tag)
+        elif subelem.tag == "tag":
+            way_element_tags.append(make_tag(element_id, subelem.attrib))
 
-    # Clean the TIGER data gathered
-    way_element_tags = clean_tiger_data(way_element_tags)
-
-    # Clean Addresses
-    way_element_tags = clean_addresses(way_element_tags)
-
-    # Clean Zip Codes
-    way_element_tags = clean_zip_codes(way_element_tags)
+    # Clean the TIGER data, addresses and zip codes,
+    # timed as its own stage when profiling
+    if PROFILER:
+        PROFILER.lap('shape_way')
+    way_element_tags = tag_cleaner.clean(way_element_tags)
+    if PROFILER:
+        PROFILER.lap('clean_tags')
 
     return {'way': way_element, 'way_nodes': way_element_nodes, 'way_tags': way_element_tags}
 
 
 # ================================================== #
-# Function to clean TIGER data addresses and zip codes
+# Helper Function to build a Tag record from the
+# attributes of a node/way tag, splitting the "k"
+# attribute into its type and key once
 # ================================================== #
-def clean_tiger_data(list_of_tags):
-
-    #TAGS_FIELDS = ['id', 'key', 'value', 'type']
-    new_list_of_tags = []
-
-    street_str   = []
-    city_str     = ""
-    id_str       = ""
-    zipcode_str = ""
+def make_tag(element_id, attrib):
 
-    for tag_item in list_of_tags:
-
-        # TIGER data
-        if tag_item["type"] == "tiger":
-
-            # County <=> City
-            if tag_item["key"] == "county":
-                new_tag_item         = {}
-                new_tag_item['type'] = "addr"
-                new_tag_item['key']  = "county"
-                new_tag_item['id']   = tag_item['id']
-                if "," in  tag_item["value"]:
-                    new_tag_item['value'] = tag_item["value"].split(",", 1)[0]
-                else:
-                    new_tag_item['value'] = tag_item["value"]
-                new_list_of_tags.append(new_tag_item)
-
-            # zipcode
-            if tag_item["key"] == "zip_left":
-                new_tag_item          = {}
-                new_tag_item['type']  = "addr"
-                new_tag_item['key']   = "postcode"
-                new_tag_item['id']    = tag_item['id']
-                new_tag_item['value'] = tag_item["value"]
-                new_list_of_tags.append(new_tag_item)
-
-            # street_address pt1"
-            if tag_item["key"] == "name_direction_prefix":
-                street_str.insert(0, tag_item["value"])
-
-            # street_address pt2"
-            if tag_item["key"] == "name_base":
-                street_str.insert(1, tag_item["value"])
-
-            # street_address pt3"
-            if tag_item["key"] == "name_type":
-                street_str.insert(2, tag_item["value"])
-
-        # Non Tiger item, don't change
-        else:
-            new_list_of_tags.append(tag_item)
-
-        # Add an item of the joined street address
-    if (len(street_str) != 0):
-        new_tag_item          = {}
-        new_tag_item['type']  = "addr"
-        new_tag_item['key']   = "street"
-        new_tag_item['id']    = tag_item['id']
-        new_tag_item['value'] = " ".join(street_str)
-        new_list_of_tags.append(new_tag_item)
-
-    return new_list_of_tags
+    tag_type, colon, key = attrib['k'].partition(":")
+    if not colon:
+        tag_type, key = "regular", tag_type
+    return Tag(element_id, key, attrib.get('v'), tag_type)
 
 
 # ================================================== #
@@ -297,167 +315,580 @@ def get_tag_value(elem):
 
 
 # ================================================== #
-# Function to clean address names of mistakes
+# Function to check if a postal code is valid
 # ================================================== #
-def clean_addresses(list_of_tags):
+def is_postcode_valid(postcode_str):
 
-    for item in list_of_tags:
+    if (len(postcode_str) == 5 and postcode_str[:2] == "80"):
+        return True
+    else:
+        print "Invalid postcode: " + postcode_str
+        return False
 
-        # Street name
-        if (item['key'] == "street"):
-            item['value'] = fix_street_name(item['value'], MAPPING)
 
-    return list_of_tags
+# ================================================== #
+# Function to remove all whitespaces from a string
+# ================================================== #
+def remove_whitespace(string_in):
+    return string_in.replace(" ", "")
 
 
 # ================================================== #
-# Function to clean zip codes of mistakes
+# Tag cleaning rule engine
+#
+# The TIGER, address and zip code fixes are
+# declared as rules of (type, key, action). Rules for
+# a specific type rewrite the tags of that type; rules
+# for ANY type then clean the resulting tags by key.
+# TagCleaner compiles the rules into dictionaries keyed
+# on type and key and cleans each element's tags in a
+# single pass without changing the list it reads
 # ================================================== #
-def clean_zip_codes(list_of_tags):
+ANY = None
+
+
+class CleaningState(object):
+    """Per element state shared by the rules"""
+
+    def __init__(self):
+        self.street   = []
+        self.deferred = []
+
+
+# TIGER county <=> City
+def tiger_county(tag, state):
+    return (Tag(tag.id, "county", tag.value.split(",", 1)[0], "addr"),)
+
+
+# TIGER zipcode
+def tiger_zip_left(tag, state):
+    return (Tag(tag.id, "postcode", tag.value, "addr"),)
+
+
+# TIGER street address parts, joined once all the
+# element's tags have been read
+def tiger_street_part(position):
+    def rule(tag, state):
+        state.street.insert(position, tag.value)
+        return ()
+    return rule
 
-    for item in list_of_tags:
-        if(item['key'] == "postcode"):
 
-            # Assign the postcode to a local variable
-            postcode = item['value']
+# Other TIGER tags are dropped
+def drop_tag(tag, state):
+    return ()
 
-            # Remove whitespace to standardize format
-            postcode = remove_whitespace(postcode)
 
-            # Standardize each postcode format
+# Street name
+def fix_street_tag(tag, state):
+    return (tag._replace(value=street_normalizer(tag.value)),)
 
-            if (len(postcode) == 5
-                and is_postcode_valid(postcode)):
 
-                # Standard 5 digit postcode
-                item['value'] = postcode
+# Standardize each postcode format, multiple and
+# ranged postcodes are added after the other tags
+def fix_postcode_tag(tag, state):
 
-            elif (len(postcode) == 10
-                  and postcode[5] == "-"
-                  and is_postcode_valid(postcode[:5])):
+    # Remove whitespace to standardize format
+    postcode = remove_whitespace(tag.value)
 
-                # Grab 5 digits from ZIP+4 format
-                item['value'] = postcode[:5]
+    if (len(postcode) == 5
+        and is_postcode_valid(postcode)):
 
+        # Standard 5 digit postcode
+        value = postcode
 
-            elif (len(postcode) == 7
-                  and postcode[:2] == "CO"
-                  and is_postcode_valid(postcode[2:])):
+    elif (len(postcode) == 10
+          and postcode[5] == "-"
+          and is_postcode_valid(postcode[:5])):
 
-                # Correct zip code in format "CO80214"
-                item['value'] = postcode[2:]
+        # Grab 5 digits from ZIP+4 format
+        value = postcode[:5]
 
-            elif (len(postcode) == 14
-                  and postcode[:9] == "Golden,CO"
-                  and is_postcode_valid(postcode[9:])):
+    elif (len(postcode) == 7
+          and postcode[:2] == "CO"
+          and is_postcode_valid(postcode[2:])):
 
-                # Correct zip code in format "Golden, CO 80401"
-                item['value'] = postcode[9:]
+        # Correct zip code in format "CO80214"
+        value = postcode[2:]
 
-            elif (";" in postcode):
+    elif (len(postcode) == 14
+          and postcode[:9] == "Golden,CO"
+          and is_postcode_valid(postcode[9:])):
 
-                # Add all valid postalcode values if multiples listed
-                for new_postcode in postcode.split(';'):
-                    new_tag = item.copy()
-                    new_tag['value'] = new_postcode
-                    if(is_postcode_valid(new_postcode)):
-                        list_of_tags.append(new_tag)
-                list_of_tags.remove(item)
+        # Correct zip code in format "Golden, CO 80401"
+        value = postcode[9:]
 
-            elif (":" in postcode):
+    elif (";" in postcode):
 
-                # Add all valid postalcode values if range listed
-                for new_postcode in range(int(postcode.split(':')[0]), int(postcode.split(':')[1])):
-                    new_tag = item.copy()
-                    new_tag['value'] = str(new_postcode)
-                    if (is_postcode_valid(str(new_postcode))):
-                        list_of_tags.append(new_tag)
-                list_of_tags.remove(item)
+        # Add all valid postalcode values if multiples listed
+        for new_postcode in postcode.split(';'):
+            if is_postcode_valid(new_postcode):
+                state.deferred.append(tag._replace(value=new_postcode))
+        return ()
 
+    elif (":" in postcode):
+
+        # Add all valid postalcode values if range listed
+        for new_postcode in range(int(postcode.split(':')[0]), int(postcode.split(':')[1])):
+            if is_postcode_valid(str(new_postcode)):
+                state.deferred.append(tag._replace(value=str(new_postcode)))
+        return ()
+
+    else:
+
+        # Display and remove the bad postcodes
+        print "Bad postcode: " + postcode
+        return ()
+
+    return (tag._replace(value=value),)
+
+
+# ================================================== #
+# Helper Function to wrap a cleaning rule in stage
+# profiler laps. The time before the rule runs goes
+# to clean_tags, the rule itself to its own stage
+# ================================================== #
+def timed_rule(action, stage):
+
+    def timed(tag, state):
+        PROFILER.lap('clean_tags')
+        produced = action(tag, state)
+        PROFILER.lap(stage)
+        return produced
+
+    return timed
+
+
+CLEANING_RULES = [
+    # type     key                      action
+    ('tiger', 'county',                tiger_county),
+    ('tiger', 'zip_left',              tiger_zip_left),
+    ('tiger', 'name_direction_prefix', tiger_street_part(0)),
+    ('tiger', 'name_base',             tiger_street_part(1)),
+    ('tiger', 'name_type',             tiger_street_part(2)),
+    ('tiger', ANY,                     drop_tag),
+    (ANY,     'street',                fix_street_tag),
+    (ANY,     'postcode',              fix_postcode_tag),
+]
+
+
+class TagCleaner(object):
+    """Clean a list of tags with rules compiled to dispatch on key
+
+    A second copy of the rules wraps each action in stage profiler
+    laps (one rule:<type>:<key> stage per rule); clean() uses it
+    only while PROFILER is set.
+    """
+
+    def __init__(self, rules):
+        self.type_rules       = defaultdict(dict)
+        self.key_rules        = {}
+        self.timed_type_rules = defaultdict(dict)
+        self.timed_key_rules  = {}
+        for tag_type, key, action in rules:
+            timed = timed_rule(action, "rule:%s:%s" % (tag_type or "*", key or "*"))
+            if tag_type is ANY:
+                self.key_rules[key]       = action
+                self.timed_key_rules[key] = timed
             else:
+                self.type_rules[tag_type][key]       = action
+                self.timed_type_rules[tag_type][key] = timed
+        self.type_rules       = dict(self.type_rules)
+        self.timed_type_rules = dict(self.timed_type_rules)
+
+    def clean(self, tags):
+        state   = CleaningState()
+        cleaned = []
+        if PROFILER:
+            type_rules, key_rules = self.timed_type_rules, self.timed_key_rules
+        else:
+            type_rules, key_rules = self.type_rules, self.key_rules
+
+        for tag in tags:
+            rules = type_rules.get(tag.type)
+            if rules is None:
+                produced = (tag,)
+            else:
+                action   = rules.get(tag.key) or rules.get(ANY)
+                produced = action(tag, state) if action else (tag,)
+
+            for new_tag in produced:
+                action = key_rules.get(new_tag.key)
+                cleaned.extend(action(new_tag, state) if action else (new_tag,))
+
+        # Add an item of the joined street address
+        if state.street:
+            new_tag = Tag(tags[-1].id, "street", " ".join(state.street), "addr")
+            action  = key_rules.get("street")
+            cleaned.extend(action(new_tag, state) if action else (new_tag,))
+
+        cleaned.extend(state.deferred)
+        return cleaned
+
 
-                # Display the bad postcodes
-                print "Bad postcode: " + postcode
+tag_cleaner = TagCleaner(CLEANING_RULES)
 
-                # Remove bad postal code
-                list_of_tags.remove(item)
 
-    return list_of_tags
+street_normalizer = StreetNameNormalizer(MAPPING)
 
 
 # ================================================== #
-# Function to check if a postal code is valid
+# Function to time the street normalizer against
+# fix_street_name on the street names of a file
 # ================================================== #
-def is_postcode_valid(postcode_str):
+def benchmark_street_normalizer(file_in, number=5):
 
-    if (len(postcode_str) == 5 and postcode_str[:2] == "80"):
-        return True
-    else:
-        print "Invalid postcode: " + postcode_str
-        return False
+    addresses = [tag.attrib['v']
+                 for element in get_element(file_in, tags=('node', 'way'))
+                 for tag in element.iter("tag")
+                 if tag.attrib['k'] in ("addr:street", "tiger:name_base")]
+
+    normalizer = StreetNameNormalizer(MAPPING)
+    assert [normalizer(a) for a in addresses] == [fix_street_name(a, MAPPING) for a in addresses]
+
+    original = timeit.timeit(lambda: [fix_street_name(a, MAPPING) for a in addresses], number=number)
+    cached   = timeit.timeit(lambda: [normalizer(a) for a in addresses], number=number)
+
+    print "%d street names, %d unique" % (len(addresses), len(set(addresses)))
+    print "fix_street_name:      %.4fs" % original
+    print "StreetNameNormalizer: %.4fs (%.1fx)" % (cached, original / max(cached, 1e-9))
+    print normalizer.cache_info()
 
 
 # ================================================== #
-# Function to remove all whitespaces from a string
+# Helper Function to grab an element from the OSM
 # ================================================== #
-def remove_whitespace(string_in):
-    return string_in.replace(" ", "")
+def get_element(osm_file, tags=('node', 'way', 'relation'), parser=None):
+    """Yield element if it is the right type of tag
+
+    parser names an osm_parsers backend, the default is osm_parsers.PARSER
+    """
+    return osm_parsers.iter_elements(osm_file, tags, parser)
 
 
 # ================================================== #
-# Helper Function to update a bad street name based
-# on a defined mapping
+# Helper Function to write to csv files. Records are
+# already in field order, so rows are buffered and
+# written in large batches through csv.writer. Values
+# are only encoded when a batch holds non-ASCII text
 # ================================================== #
-def fix_street_name(address, mapping):
-    words = address.split()
-    for w in range(len(words)):
-        if words[w] in mapping:
-            # Don't update 'Apartment E' to 'Apartment East'
-            if words[w-1].lower() in [ 'apartment', 'apt', 'building', 'suite', 'ste.', 'ste']:
-                continue
-            else:
-                words[w] = mapping[words[w]]
-                address = " ".join(words)
-    return address
+class UnicodeRowWriter(object):
+    """Write shaped records to a csv file in buffered batches"""
+
+    def __init__(self, f, fieldnames, batch_size=BATCH_SIZE):
+        self.f          = f
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        self.rows       = []
+
+    def writeheader(self):
+        self.flush()
+        csv.writer(self.f).writerow(self.fieldnames)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        buf = cStringIO.StringIO()
+        try:
+            csv.writer(buf).writerows(self.rows)
+        except UnicodeEncodeError:
+            # Redo the batch, encoding only the rows that need it
+            buf    = cStringIO.StringIO()
+            writer = csv.writer(buf)
+            for row in self.rows:
+                try:
+                    writer.writerow(row)
+                except UnicodeEncodeError:
+                    writer.writerow([(v.encode('utf-8') if isinstance(v, unicode) else v)
+                                     for v in row])
+        self.f.write(buf.getvalue())
+        self.rows = []
 
 
 # ================================================== #
-# Helper Function to grab an element from the OSM
+# Helper Function to build an INSERT statement for
+# the given table fields
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def insert_sql(table, fields, verb="INSERT"):
+    return "%s INTO %s (%s) VALUES (%s)" % (verb,
+                                            table,
+                                            ", ".join(fields),
+                                            ", ".join("?" * len(fields)))
+
+
+# ================================================== #
+# Helper Function to write rows into a SQLite table
+# ================================================== #
+class SqliteTableWriter(object):
+    """Buffer shaped rows and insert them into a table with executemany"""
+
+    def __init__(self, db, table, fields, batch_size=BATCH_SIZE):
+        self.db         = db
+        self.fields     = fields
+        self.batch_size = batch_size
+        self.sql        = insert_sql(table, fields)
+        self.rows       = []
+        self.count      = 0
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    def flush(self):
+        if self.rows:
+            self.db.executemany(self.sql, self.rows)
+            self.count += len(self.rows)
+            self.rows = []
 
 
 # ================================================== #
-# Helper Function to write to csv files
+# Helper Function to hand out ids for the tag keys or
+# values of a dictionary encoded database, keeping
+# the lookup in memory during a bulk load
 # ================================================== #
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+class TagDictionary(object):
+    """Map strings to the ids of a tag_keys or tag_values table"""
+
+    def __init__(self, db, table, column):
+        self.db    = db
+        self.sql   = "INSERT INTO %s (id, %s) VALUES (?, ?)" % (table, column)
+        self.codes = dict((text, code) for code, text in
+                          db.execute("SELECT id, %s FROM %s" % (column, table)))
+        self.next_code = max(self.codes.values() or [0]) + 1
+        self.new = []
+
+    def code(self, text):
+        if text is None:
+            return None
+        try:
+            return self.codes[text]
+        except KeyError:
+            code = self.codes[text] = self.next_code
+            self.next_code += 1
+            self.new.append((code, text))
+            return code
+
+    def flush(self):
+        if self.new:
+            self.db.executemany(self.sql, self.new)
+            self.new = []
+
+
+# ================================================== #
+# Helper Function to write Tag records into the
+# *_data table of a dictionary encoded database
+# ================================================== #
+class EncodedTagWriter(SqliteTableWriter):
+    """SqliteTableWriter that swaps tag strings for dictionary ids"""
+
+    def __init__(self, db, table, keys, values, batch_size=BATCH_SIZE):
+        SqliteTableWriter.__init__(self, db, table + '_data',
+                                   ['id', 'key_id', 'value_id', 'type_id'], batch_size)
+        self.keys   = keys
+        self.values = values
+
+    def encode(self, tag):
+        return (tag.id,
+                self.keys.code(tag.key),
+                self.values.code(tag.value),
+                self.keys.code(tag.type))
+
+    def writerow(self, tag):
+        SqliteTableWriter.writerow(self, self.encode(tag))
+
+    def writerows(self, tags):
+        SqliteTableWriter.writerows(self, [self.encode(tag) for tag in tags])
+
+    def flush(self):
+        self.keys.flush()
+        self.values.flush()
+        SqliteTableWriter.flush(self)
+
+
+# ================================================== #
+# Helper Function to create a writer for each of the
+# output files
+# ================================================== #
+def make_writers(files, header=True):
+
+    writers = [UnicodeRowWriter(f, fields) for f, fields in zip(files, OUTPUT_FIELDS)]
+    if header:
+        for writer in writers:
+            writer.writeheader()
+    return writers
+
+
+# ================================================== #
+# Writer that passes each row on to several writers,
+# used to feed the node coordinate store while the
+# nodes are written out
+# ================================================== #
+class TeeWriter(object):
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def writeheader(self):
+        for writer in self.writers:
+            writer.writeheader()
 
     def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-                                                    k: (v.encode('utf-8') if isinstance(v, unicode) else v) for
-                                                    k, v in
-                                                    row.iteritems()
-                                                    })
+        for writer in self.writers:
+            writer.writerow(row)
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        for writer in self.writers:
+            writer.writerows(rows)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+
+# ================================================== #
+# Function to clean elements and write them out with
+# the given writers. Returns the id of the last
+# element written
+# ================================================== #
+def write_elements(elements, writers):
+
+    (nodes_writer,
+     node_tags_writer,
+     ways_writer,
+     way_nodes_writer,
+     way_tags_writer) = writers
+
+    # Stage timer hooks, see stage_profiler
+    profiler = PROFILER
+    if profiler:
+        profiler.mark()
+
+    last_id = None
+    for element in elements:
+        if profiler:
+            profiler.lap('parse')
+
+        # Clean and write out the NODES
+        if ( element.tag == 'node'):
+            el = shape_node(element)
+            if profiler:
+                profiler.lap('shape_node')
+            nodes_writer.writerow(el['node'])
+            node_tags_writer.writerows(el['node_tags'])
+
+        # Clean and write out the WAYS
+        elif ( element.tag == 'way'):
+            el = shape_way(element)
+            if profiler:
+                profiler.lap('shape_way')
+            ways_writer.writerow(el['way'])
+            way_nodes_writer.writerows(el['way_nodes'])
+            way_tags_writer.writerows(el['way_tags'])
+
+        else:
+            continue
+
+        if profiler:
+            profiler.lap('write')
+            profiler.written(element.tag, el)
+
+        last_id = element.attrib.get('id')
+
+    if profiler:
+        profiler.lap('parse')
+
+    for writer in writers:
+        writer.flush()
+
+    if profiler:
+        profiler.lap('write')
+
+    return last_id
 
 
 # ================================================== #
 # Function to fix issues found in the audit and
 # write the clean data out to csv files
 # ================================================== #
-def process_map(file_in):
+def process_map(file_in, workers=1, checkpoint=None, resume=False, output_format='csv',
+                coords=None, profile=None, validate=False, parser=None):
+
+    # The parser backend is switched for this run only;
+    # pool workers are forked with it already set
+    if parser is not None:
+        previous = osm_parsers.PARSER
+        osm_parsers.set_parser(parser)
+        try:
+            return process_map(file_in, workers, checkpoint, resume, output_format,
+                               coords, profile, validate)
+        finally:
+            osm_parsers.PARSER = previous
+
+    # The columnar writers hold every column in memory
+    # and save them at the end, so there is no split
+    # or resumable npy run
+    if output_format == 'npy' and (workers > 1 or checkpoint):
+        raise ValueError("output_format='npy' runs serially, it cannot be combined "
+                         "with workers or checkpoint")
+
+    # Profiling turns on the stage timer hooks in
+    # write_elements for this run only (see stage_profiler)
+    if profile:
+        if workers > 1:
+            raise ValueError("process_map can only be profiled with workers=1")
+
+        import stage_profiler
+        global PROFILER
+
+        report_path = stage_profiler.PROFILE_PATH if profile is True else profile
+        PROFILER = stage_profiler.StageProfiler(report_path)
+        try:
+            with PROFILER:
+                process_map(file_in, 1, checkpoint, resume, output_format, coords,
+                            validate=validate)
+        finally:
+            PROFILER = None
+        return
+
+    # Rows that fail the schema.py checks are collected
+    # here, or None when validation is off
+    failures = [] if validate else None
+
+    if output_format == 'npy':
+        process_map_columnar(file_in, coords=coords, failures=failures)
+        report_failures(failures)
+        return
+
+    if workers > 1 or checkpoint:
+        if workers > 1:
+            process_map_parallel(file_in, workers, failures=failures)
+        else:
+            process_map_checkpointed(file_in, checkpoint, resume, failures=failures)
+        report_failures(failures)
+
+        # These modes write the nodes out in pieces, so the
+        # coordinate store is built from the finished csv
+        if coords:
+            import node_coords
+            node_coords.build_from_csv(NODES_PATH, coords)
+        return
 
     with codecs.open(NODES_PATH,     'w') as nodes_file, \
          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
@@ -465,32 +896,545 @@ def process_map(file_in):
          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
          codecs.open(WAY_TAGS_PATH,  'w') as way_tags_file:
 
-        nodes_writer     = UnicodeDictWriter(nodes_file,      NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer      = UnicodeDictWriter(ways_file,       WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file,  WAY_NODES_FIELDS)
-        way_tags_writer  = UnicodeDictWriter(way_tags_file,   WAY_TAGS_FIELDS)
+        writers = make_writers([nodes_file,
+                                nodes_tags_file,
+                                ways_file,
+                                way_nodes_file,
+                                way_tags_file])
+
+        coord_builder = add_coord_builder(writers, coords)
+        add_validators(writers, failures)
+
+        write_elements(get_element(file_in, tags=('node', 'way')), writers)
+
+    if coord_builder:
+        coord_builder.save(coords)
+    report_failures(failures)
+
+
+# ================================================== #
+# Helper Function to also send the nodes to a node
+# coordinate store builder when coords is set (needs
+# numpy). Returns the builder, or None
+# ================================================== #
+def add_coord_builder(writers, coords):
+
+    if not coords:
+        return None
+
+    import node_coords
+
+    coord_builder = node_coords.NodeCoordBuilder()
+    writers[0] = TeeWriter(writers[0], coord_builder)
+    return coord_builder
+
+
+# ================================================== #
+# Helper Function to validate the rows against the
+# schema.py definitions on their way to the writers,
+# collecting failures in the given list. Does nothing
+# when failures is None
+# ================================================== #
+def add_validators(writers, failures):
+
+    if failures is None:
+        return
+
+    import schema_validator
+
+    validator = schema_validator.SchemaValidator(zip(OUTPUT_TABLES, OUTPUT_FIELDS))
+    for i, table in enumerate(OUTPUT_TABLES):
+        writers[i] = schema_validator.ValidatingWriter(writers[i], table, validator, failures)
+
+
+# ================================================== #
+# Helper Function to print a summary of the rows that
+# failed validation and write them all out to a csv
+# ================================================== #
+def report_failures(failures, report_path=VALIDATION_PATH, show=10):
+
+    if failures is None:
+        return
+
+    print "%d values failed validation" % len(failures)
+    if not failures:
+        return
+
+    for failure in failures[:show]:
+        print "  %s id=%s %s=%r: %s" % failure
+
+    with open(report_path, 'wb') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['table', 'id', 'field', 'value', 'error'])
+        for failure in failures:
+            writer.writerow([unicode(value).encode('utf-8') if value is not None else ''
+                             for value in failure])
+    print "All failures written to %s" % report_path
+
+
+# ================================================== #
+# Function to write the clean data out in a columnar
+# format, one .npy file per column (needs numpy)
+# ================================================== #
+def process_map_columnar(file_in, out_dir=COLUMNAR_DIR, coords=None, failures=None):
+
+    import columnar
+
+    writers = [columnar.ColumnarTableWriter(table, fields)
+               for table, fields in zip(OUTPUT_TABLES, OUTPUT_FIELDS)]
+    tables = list(writers)
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
+    coord_builder = add_coord_builder(writers, coords)
+    add_validators(writers, failures)
 
-        for element in get_element(file_in, tags=('node', 'way')):
+    write_elements(get_element(file_in, tags=('node', 'way')), writers)
 
-            # Clean and write out the NODES
-            if ( element.tag == 'node'):
-                el = shape_node(element)
-                nodes_writer.writerow(el['node'])
-                node_tags_writer.writerows(el['node_tags'])
+    for writer in tables:
+        writer.save(out_dir)
 
-            # Clean and write out the WAYS
-            elif ( element.tag == 'way'):
-                el = shape_way(element)
-                ways_writer.writerow(el['way'])
-                way_nodes_writer.writerows(el['way_nodes'])
-                way_tags_writer.writerows(el['way_tags'])
+    if coord_builder:
+        coord_builder.save(coords)
+
+
+# ================================================== #
+# Helper Function to record how far process_map has
+# got. The file is replaced atomically so a crash
+# never leaves a partial checkpoint behind
+# ================================================== #
+def write_checkpoint(checkpoint_path, file_in, offset, last_id, outputs):
+
+    state = {'input':        os.path.abspath(file_in),
+             'input_size':   os.path.getsize(file_in),
+             'input_mtime':  os.path.getmtime(file_in),
+             'offset':       offset,
+             'last_id':      last_id,
+             'outputs':      dict((path, output.tell())
+                                  for path, output in zip(OUTPUT_PATHS, outputs))}
+
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.rename(tmp_path, checkpoint_path)
+
+
+# ================================================== #
+# Helper Function to read a checkpoint and make sure
+# it was written for the same input file
+# ================================================== #
+def read_checkpoint(checkpoint_path, file_in):
+
+    with open(checkpoint_path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+
+    if (state['input'] != os.path.abspath(file_in) or
+        state['input_size'] != os.path.getsize(file_in) or
+        state['input_mtime'] != os.path.getmtime(file_in)):
+        raise ValueError("Checkpoint %s was written for a different input file" % checkpoint_path)
+
+    return state
+
+
+# ================================================== #
+# Function to run process_map in byte ranges, writing
+# a checkpoint after each one. With resume the output
+# files are truncated to the last checkpoint and the
+# run continues from its input offset
+# ================================================== #
+def process_map_checkpointed(file_in, checkpoint_path, resume=False,
+                             checkpoint_bytes=CHECKPOINT_BYTES, failures=None):
+
+    osm_input.require_seekable(file_in, "process_map with a checkpoint")
+
+    state = None
+    if resume and os.path.exists(checkpoint_path):
+        state = read_checkpoint(checkpoint_path, file_in)
+
+    if state:
+        print "Resuming at byte %d after element %s" % (state['offset'], state['last_id'])
+        outputs = []
+        for path in OUTPUT_PATHS:
+            output = open(path, 'r+b')
+            output.truncate(state['outputs'][path])
+            output.seek(0, os.SEEK_END)
+            outputs.append(output)
+        writers = make_writers(outputs, header=False)
+        offset  = state['offset']
+        last_id = state['last_id']
+    else:
+        outputs = [codecs.open(path, 'w') for path in OUTPUT_PATHS]
+        writers = make_writers(outputs)
+        offset  = 0
+        last_id = None
+
+    add_validators(writers, failures)
+
+    try:
+        chunk_count = max(1, os.path.getsize(file_in) // checkpoint_bytes)
+        for start, end in find_chunk_boundaries(file_in, chunk_count):
+            if end <= offset:
+                continue
+
+            chunk_last_id = write_elements(get_chunk_elements(file_in, max(start, offset), end), writers)
+            if chunk_last_id is not None:
+                last_id = chunk_last_id
+
+            # Make sure the rows are on disk before the
+            # checkpoint says they are
+            for output in outputs:
+                output.flush()
+                os.fsync(output.fileno())
+            write_checkpoint(checkpoint_path, file_in, end, last_id, outputs)
+    finally:
+        for output in outputs:
+            output.close()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+# ================================================== #
+# Helper Function to check whether a table exists
+# and has any rows
+# ================================================== #
+def has_rows(db, table):
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone():
+        return False
+    return db.execute("SELECT 1 FROM %s LIMIT 1" % table).fetchone() is not None
+
+
+# ================================================== #
+# Function to fix issues found in the audit and load
+# the clean data straight into the SQLite database
+# ================================================== #
+def load_map(file_in, db_path=DB_PATH, batch_size=BATCH_SIZE, index=True, encode_tags=False):
+
+    db = sqlite3.connect(db_path)
+    try:
+        # The tables have primary keys, so loading twice would
+        # fail part way through; ask for a fresh file instead
+        for table in ('nodes', 'ways'):
+            if has_rows(db, table):
+                raise ValueError("%s already holds a loaded map (%s has rows); remove it, "
+                                 "pick another db_path or use apply_change for updates"
+                                 % (db_path, table))
+
+        table_type = osm_db.tag_table_type(db)
+        if table_type and (table_type == 'view') != encode_tags:
+            raise ValueError("%s already stores its tags %s" %
+                             (db_path, "encoded" if table_type == 'view' else "as text"))
+
+        db.executescript(CREATE_TABLES_SQL)
+        if encode_tags:
+            osm_db.create_encoded_tag_tables(db)
+        else:
+            db.executescript(CREATE_TAG_TABLES_SQL)
+
+        # Remember the current settings so they can be
+        # turned back on once the load is done
+        saved_pragmas = {}
+        for pragma, value in LOAD_PRAGMAS.items():
+            saved_pragmas[pragma] = db.execute("PRAGMA %s" % pragma).fetchone()[0]
+            db.execute("PRAGMA %s = %s" % (pragma, value))
+
+        writers = [SqliteTableWriter(db, table, fields, batch_size)
+                   for table, fields in zip(OUTPUT_TABLES, OUTPUT_FIELDS)]
+
+        if encode_tags:
+            keys   = TagDictionary(db, 'tag_keys', 'key')
+            values = TagDictionary(db, 'tag_values', 'value')
+            writers[1] = EncodedTagWriter(db, 'node_tags', keys, values, batch_size)
+            writers[4] = EncodedTagWriter(db, 'way_tags', keys, values, batch_size)
+
+        start = time.time()
+        try:
+            try:
+                write_elements(get_element(file_in, tags=('node', 'way')), writers)
+            except:
+                # Drop the partial load before the PRAGMAs below,
+                # which would otherwise commit it
+                db.rollback()
+                raise
+            db.commit()
+            elapsed = max(time.time() - start, 1e-9)
+
+            # Indexes are cheaper to build once the rows are in
+            if index:
+                index_start = time.time()
+                osm_db.build_indexes(db)
+                osm_db.build_tag_stats(db)
+                osm_db.build_spatial_index(db)
+                print "Built indexes in %.2fs" % (time.time() - index_start)
+        finally:
+            for pragma, value in saved_pragmas.items():
+                db.execute("PRAGMA %s = %s" % (pragma, value))
+
+        total = 0
+        for table, writer in zip(OUTPUT_TABLES, writers):
+            print "%-10s %10d rows" % (table, writer.count)
+            total += writer.count
+        print "Loaded %d rows in %.2fs (%d rows/sec)" % (total, elapsed, total / elapsed)
+    finally:
+        db.close()
+
+
+# ================================================== #
+# Function to compare the plain and the dictionary
+# encoded tag storage: database size and the
+# queries.sql timings
+# ================================================== #
+def benchmark_tag_encoding(file_in, repeat=3):
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for encode_tags in (False, True):
+            db_path = os.path.join(tmp_dir, "encoded.db" if encode_tags else "text.db")
+            load_map(file_in, db_path, encode_tags=encode_tags)
+
+            db = sqlite3.connect(db_path)
+            try:
+                db.execute("VACUUM")
+                results[encode_tags] = dict(osm_db.time_queries(db, osm_db.QUERIES, repeat))
+            finally:
+                db.close()
+            results[encode_tags]['size'] = os.path.getsize(db_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    text, encoded = results[False], results[True]
+    print "%-16s %10s %10s" % ("", "text", "encoded")
+    print "%-16s %9.1fM %9.1fM (%.0f%% smaller)" % ("database size",
+                                                   text['size'] / 1e6,
+                                                   encoded['size'] / 1e6,
+                                                   100.0 * (1 - float(encoded['size']) / text['size']))
+    for name, _ in osm_db.QUERIES:
+        print "%-16s %9.2fms %9.2fms (%.1fx)" % (name,
+                                                 text[name] * 1000,
+                                                 encoded[name] * 1000,
+                                                 text[name] / max(encoded[name], 1e-9))
+
+
+# ================================================== #
+# Helper Function to grab each element from an OSM
+# change file along with its create, modify or
+# delete action
+# ================================================== #
+def get_change_elements(osc_file, tags=('node', 'way')):
+    """Yield (action, element) for each changed element"""
+
+    # Change files are usually published as .osc.gz
+    with osm_input.open_osm(osc_file) as change_file:
+        context = ET.iterparse(change_file, events=('start', 'end'))
+        _, root = next(context)
+        action      = None
+        action_elem = root
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ('create', 'modify', 'delete'):
+                    action      = elem.tag
+                    action_elem = elem
+            elif elem.tag in ('node', 'way', 'relation'):
+                if elem.tag in tags:
+                    yield action, elem
+                action_elem.clear()
+                root.clear()
+
+
+# ================================================== #
+# Helper Function to delete an element and all of its
+# tag and way node rows from the database
+# ================================================== #
+def delete_element(db, tag, element_id):
+
+    if tag == 'node':
+        db.execute("DELETE FROM node_tags WHERE id = ?", (element_id,))
+        db.execute("DELETE FROM nodes WHERE id = ?", (element_id,))
+
+    elif tag == 'way':
+        db.execute("DELETE FROM way_tags WHERE id = ?", (element_id,))
+        db.execute("DELETE FROM way_nodes WHERE id = ?", (element_id,))
+        db.execute("DELETE FROM ways WHERE id = ?", (element_id,))
+
+
+# ================================================== #
+# Helper Function to clean an element and insert it
+# into the database, replacing an older version
+# ================================================== #
+def insert_element(db, element):
+
+    if element.tag == 'node':
+        el = shape_node(element)
+        db.execute(insert_sql('nodes', NODE_FIELDS, "INSERT OR REPLACE"), el['node'])
+        db.executemany(insert_sql('node_tags', NODE_TAGS_FIELDS), el['node_tags'])
+
+    elif element.tag == 'way':
+        el = shape_way(element)
+        db.execute(insert_sql('ways', WAY_FIELDS, "INSERT OR REPLACE"), el['way'])
+        db.executemany(insert_sql('way_nodes', WAY_NODES_FIELDS), el['way_nodes'])
+        db.executemany(insert_sql('way_tags', WAY_TAGS_FIELDS), el['way_tags'])
+
+
+# ================================================== #
+# Function to apply an OSM change file (.osc) to an
+# existing database. Each created or modified element
+# goes through the same cleaning as process_map and
+# replaces its old rows; deleted elements are removed
+# ================================================== #
+def apply_change(osc_file, db_path=DB_PATH):
+
+    counts = defaultdict(int)
+    start  = time.time()
+
+    db = sqlite3.connect(db_path)
+    try:
+        for action, element in get_change_elements(osc_file):
+            delete_element(db, element.tag, get_element_id(element))
+            if action != 'delete':
+                insert_element(db, element)
+            counts[(action, element.tag)] += 1
+        db.commit()
+    finally:
+        db.close()
+
+    for (action, tag), count in sorted(counts.items()):
+        print "%-8s %-6s %8d" % (action, tag, count)
+    print "Applied %d changes in %.2fs" % (sum(counts.values()), time.time() - start)
+
+
+# ================================================== #
+# Function to split an OSM file into byte ranges that
+# start on a top level <node>, <way> or <relation>
+# element. The last range stops at the closing </osm>
+# ================================================== #
+def find_chunk_boundaries(file_in, chunk_count, block_size=1 << 20):
+
+    file_size = os.path.getsize(file_in)
+
+    with open(file_in, 'rb') as osm_file:
+
+        def next_match(offset, regex):
+            # Scan forward from offset, overlapping blocks so a
+            # match is never split between two reads
+            osm_file.seek(offset)
+            overlap = ""
+            while True:
+                block = osm_file.read(block_size)
+                if not block:
+                    return None
+                data = overlap + block
+                m = regex.search(data)
+                if m:
+                    return offset - len(overlap) + m.start()
+                overlap = data[-16:]
+                offset += len(block)
+
+        first = next_match(0, element_start_re)
+        if first is None:
+            return []
+
+        osm_file.seek(max(first, file_size - block_size))
+        tail = osm_file.read()
+        end = None
+        for m in osm_end_re.finditer(tail):
+            end = file_size - len(tail) + m.start()
+        if end is None:
+            end = file_size
+
+        boundaries = [first]
+        step = max(1, (end - first) // max(1, chunk_count))
+        for i in range(1, chunk_count):
+            boundary = next_match(first + i * step, element_start_re)
+            if boundary is None or boundary >= end:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        boundaries.append(end)
+
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+# ================================================== #
+# Helper Function to read the top level elements in
+# a byte range of an OSM file. The range is streamed
+# to the parser, so a worker never holds its whole
+# chunk in memory
+# ================================================== #
+def get_chunk_elements(file_in, start, end, tags=('node', 'way')):
+
+    with osm_input.ByteRangeReader(file_in, start, end, '<osm>', '</osm>') as chunk:
+        for element in get_element(chunk, tags=tags):
+            yield element
+
+
+# ================================================== #
+# Worker Function to clean one byte range of an OSM
+# file into its own set of csv files
+# ================================================== #
+def process_chunk(job):
+
+    file_in, start, end, out_dir, index, validate = job
+
+    paths = [os.path.join(out_dir, "%05d_%s" % (index, os.path.basename(path)))
+             for path in OUTPUT_PATHS]
+    files = [codecs.open(path, 'w') for path in paths]
+    failures = [] if validate else None
+    try:
+        writers = make_writers(files, header=False)
+        add_validators(writers, failures)
+        write_elements(get_chunk_elements(file_in, start, end), writers)
+    finally:
+        for f in files:
+            f.close()
+
+    return paths, failures
+
+
+# ================================================== #
+# Function to clean an OSM file with a pool of worker
+# processes. Chunk outputs are appended to the csv
+# files in file order, so the result matches the
+# serial process_map
+# ================================================== #
+def process_map_parallel(file_in, workers, chunks_per_worker=4, failures=None):
+
+    osm_input.require_seekable(file_in, "process_map with workers")
+
+    # Large files get more chunks rather than bigger ones,
+    # so the chunk csv files stay small too
+    chunk_count = max(workers * chunks_per_worker,
+                      -(-os.path.getsize(file_in) // CHECKPOINT_BYTES))
+    ranges  = find_chunk_boundaries(file_in, chunk_count)
+    out_dir = tempfile.mkdtemp(prefix="osm_chunks_")
+    jobs    = [(file_in, start, end, out_dir, index, failures is not None)
+               for index, (start, end) in enumerate(ranges)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        outputs = [codecs.open(path, 'w') for path in OUTPUT_PATHS]
+        try:
+            make_writers(outputs)
+
+            # imap returns chunks in order while later ones are
+            # still being cleaned
+            for chunk_paths, chunk_failures in pool.imap(process_chunk, jobs):
+                if chunk_failures:
+                    failures.extend(chunk_failures)
+                for output, chunk_path in zip(outputs, chunk_paths):
+                    with open(chunk_path, 'rb') as chunk_file:
+                        shutil.copyfileobj(chunk_file, output)
+                    os.remove(chunk_path)
+        finally:
+            for output in outputs:
+                output.close()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(out_dir, ignore_errors=True)
 
 
 # ================================================== #
@@ -498,4 +1442,4 @@ def process_map(file_in):
 # ================================================== #
 if __name__ == "__main__":
     print("Running...")
-    process_map(OSM_FILE)
+    process_map(OSM_FILE, workers=WORKERS)
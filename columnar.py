@@ -0,0 +1,235 @@
+####################################################################
+# File: columnar.py
+#
+# Description: This code writes the cleaned OSM records out in a
+# columnar format, one NumPy .npy file per column. Coordinates are
+# stored as float64, ids and counters as int64, timestamps as
+# datetime64 and text columns are dictionary encoded. The tables
+# can be memory-mapped back into pandas with load_table().
+####################################################################
+
+import array
+import calendar
+import json
+import os
+
+import numpy as np
+
+# ================================================== #
+# Column storage types
+#
+#   int   - int64, with a boolean .mask.npy marking
+#           missing values when there are any (ids
+#           can be negative, so no value is free
+#           to mark them)
+#   float - float64, missing values are stored as NaN
+#   time  - datetime64[s] from the OSM timestamp,
+#           missing values are stored as NaT
+#   dict  - int32 codes into a table of distinct values
+# ================================================== #
+COLUMN_TYPES = {'id':        'int',
+                'lat':       'float',
+                'lon':       'float',
+                'user':      'dict',
+                'uid':       'int',
+                'version':   'int',
+                'changeset': 'int',
+                'timestamp': 'time',
+                'key':       'dict',
+                'value':     'dict',
+                'type':      'dict',
+                'node_id':   'int',
+                'position':  'int'}
+
+# array typecode holding a 64 bit signed integer
+INT64_TYPECODE = 'l' if array.array('l').itemsize == 8 else 'q'
+
+# int64 value numpy reads as NaT in a datetime64 column
+NAT = np.iinfo('int64').min
+
+MANIFEST_NAME = "columns.json"
+
+
+# ================================================== #
+# Helper Function to convert an OSM timestamp such as
+# "2011-03-14T04:12:27Z" to seconds since the epoch
+# ================================================== #
+def parse_timestamp(timestamp):
+    return calendar.timegm((int(timestamp[0:4]),
+                            int(timestamp[5:7]),
+                            int(timestamp[8:10]),
+                            int(timestamp[11:13]),
+                            int(timestamp[14:16]),
+                            int(timestamp[17:19])))
+
+
+# ================================================== #
+# Column builders, one per storage type
+# ================================================== #
+class IntColumn(object):
+
+    def __init__(self):
+        self.values  = array.array(INT64_TYPECODE)
+        self.missing = array.array(INT64_TYPECODE)
+
+    def append(self, value):
+        if value is None:
+            self.missing.append(len(self.values))
+            self.values.append(0)
+        else:
+            self.values.append(int(value))
+
+    def save(self, path):
+        np.save(path + ".npy", np.frombuffer(self.values, dtype=np.int64))
+        if not self.missing:
+            return ['.npy']
+        mask = np.zeros(len(self.values), dtype=np.bool_)
+        mask[np.frombuffer(self.missing, dtype=np.int64)] = True
+        np.save(path + ".mask.npy", mask)
+        return ['.npy', '.mask.npy']
+
+
+class FloatColumn(object):
+
+    def __init__(self):
+        self.values = array.array('d')
+
+    def append(self, value):
+        self.values.append(float('nan') if value is None else float(value))
+
+    def save(self, path):
+        np.save(path + ".npy", np.frombuffer(self.values, dtype=np.float64))
+        return ['.npy']
+
+
+class TimeColumn(IntColumn):
+
+    def append(self, value):
+        self.values.append(NAT if value is None else parse_timestamp(value))
+
+    def save(self, path):
+        np.save(path + ".npy", np.frombuffer(self.values, dtype=np.int64).view('datetime64[s]'))
+        return ['.npy']
+
+
+class DictColumn(object):
+
+    def __init__(self):
+        self.codes  = array.array('i')
+        self.lookup = {}
+        self.values = []
+
+    def append(self, value):
+        if value is None:
+            value = ""
+        try:
+            code = self.lookup[value]
+        except KeyError:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def save(self, path):
+        np.save(path + ".codes.npy", np.frombuffer(self.codes, dtype=np.int32))
+
+        # Distinct values are stored as UTF-8 bytes with an
+        # offsets array, Arrow style, so long values don't pad
+        # every entry out to the longest one
+        encoded = [v if isinstance(v, bytes) else v.encode('utf-8') for v in self.values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in encoded], out=offsets[1:])
+        np.save(path + ".offsets.npy", offsets)
+        np.save(path + ".data.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        return ['.codes.npy', '.offsets.npy', '.data.npy']
+
+
+COLUMN_BUILDERS = {'int':   IntColumn,
+                   'float': FloatColumn,
+                   'time':  TimeColumn,
+                   'dict':  DictColumn}
+
+
+# ================================================== #
+# Writer with the same interface as the csv writers
+# used by process_map, building one column per field
+# ================================================== #
+class ColumnarTableWriter(object):
+    """Collect shaped records into typed columns"""
+
+    def __init__(self, table, fields):
+        self.table   = table
+        self.fields  = fields
+        self.columns = [COLUMN_BUILDERS[COLUMN_TYPES[field]]() for field in fields]
+        self.appends = [column.append for column in self.columns]
+        self.count   = 0
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        for append, value in zip(self.appends, row):
+            append(value)
+        self.count += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        pass
+
+    def save(self, out_dir):
+        table_dir = os.path.join(out_dir, self.table)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+
+        manifest = {'rows': self.count, 'columns': []}
+        for field, column in zip(self.fields, self.columns):
+            files = column.save(os.path.join(table_dir, field))
+            manifest['columns'].append({'name':  field,
+                                        'type':  COLUMN_TYPES[field],
+                                        'files': [field + suffix for suffix in files]})
+
+        with open(os.path.join(table_dir, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+
+# ================================================== #
+# Function to read a dictionary column's distinct
+# values back into a list of strings
+# ================================================== #
+def load_dictionary(path):
+    offsets = np.load(path + ".offsets.npy")
+    data    = np.load(path + ".data.npy").tostring()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+# ================================================== #
+# Function to load a table written by
+# ColumnarTableWriter into a pandas DataFrame. Numeric
+# columns are memory-mapped unless mmap is False;
+# dictionary columns become pandas Categoricals and
+# int columns with missing values nullable Int64
+# ================================================== #
+def load_table(out_dir, table, mmap=True):
+
+    import pandas as pd
+
+    table_dir = os.path.join(out_dir, table)
+    with open(os.path.join(table_dir, MANIFEST_NAME)) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    mmap_mode = 'r' if mmap else None
+    data = {}
+    for column in manifest['columns']:
+        path = os.path.join(table_dir, column['name'])
+        if column['type'] == 'dict':
+            codes = np.load(path + ".codes.npy", mmap_mode=mmap_mode)
+            data[column['name']] = pd.Categorical.from_codes(codes, load_dictionary(path))
+        elif column['name'] + ".mask.npy" in column['files']:
+            data[column['name']] = pd.arrays.IntegerArray(np.load(path + ".npy"),
+                                                          np.load(path + ".mask.npy"))
+        else:
+            data[column['name']] = np.load(path + ".npy", mmap_mode=mmap_mode)
+
+    return pd.DataFrame(data, columns=[column['name'] for column in manifest['columns']])
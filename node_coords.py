@@ -0,0 +1,174 @@
+####################################################################
+# File: node_coords.py
+#
+# Description: This code builds a compact on-disk store mapping
+# node id to (lat, lon), as a sorted int64 id array next to a
+# float64 coordinate array. The store is memory-mapped for lookups
+# and used to resolve every way into its coordinate sequence in a
+# single streaming pass over the way nodes.
+####################################################################
+
+import array
+import csv
+import itertools
+
+import numpy as np
+
+from columnar import INT64_TYPECODE
+
+# ================================================== #
+# Store Files
+# ================================================== #
+COORDS_PATH = "node_coords"
+
+IDS_SUFFIX    = ".ids.npy"
+COORDS_SUFFIX = ".coords.npy"
+
+# Number of way node rows looked up per block
+BLOCK_SIZE = 65536
+
+
+# ================================================== #
+# Builder with the same interface as the csv writers
+# used by process_map, collecting the node records
+# ================================================== #
+class NodeCoordBuilder(object):
+    """Collect node ids and coordinates and save them sorted by id"""
+
+    def __init__(self):
+        self.ids  = array.array(INT64_TYPECODE)
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, node):
+        if node.lat is None or node.lon is None:
+            return
+        self.ids.append(int(node.id))
+        self.lats.append(float(node.lat))
+        self.lons.append(float(node.lon))
+
+    def writerows(self, nodes):
+        for node in nodes:
+            self.writerow(node)
+
+    def flush(self):
+        pass
+
+    def save(self, path=COORDS_PATH):
+        ids    = np.frombuffer(self.ids, dtype=np.int64)
+        coords = np.column_stack((np.frombuffer(self.lats, dtype=np.float64),
+                                  np.frombuffer(self.lons, dtype=np.float64)))
+
+        # Extracts list nodes in id order, so the sort is
+        # usually skipped
+        if len(ids) > 1 and not (ids[1:] > ids[:-1]).all():
+            order  = np.argsort(ids, kind='mergesort')
+            ids    = ids[order]
+            coords = coords[order]
+
+        np.save(path + IDS_SUFFIX, ids)
+        np.save(path + COORDS_SUFFIX, coords)
+
+
+# ================================================== #
+# Memory-mapped node id => (lat, lon) lookups
+# ================================================== #
+class NodeCoordStore(object):
+    """Look up node coordinates from a saved NodeCoordBuilder"""
+
+    def __init__(self, path=COORDS_PATH):
+        self.ids    = np.load(path + IDS_SUFFIX, mmap_mode='r')
+        self.coords = np.load(path + COORDS_SUFFIX, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, node_ids):
+        """Return an (n, 2) array of lat/lon, NaN for unknown nodes"""
+
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        result   = np.full((len(node_ids), 2), np.nan)
+        if not len(self.ids):
+            return result
+
+        index = np.searchsorted(self.ids, node_ids)
+        index[index == len(self.ids)] = 0
+        found = self.ids[index] == node_ids
+        result[found] = self.coords[index[found]]
+        return result
+
+    def get(self, node_id):
+        lat, lon = self.lookup([node_id])[0]
+        if np.isnan(lat):
+            return None
+        return lat, lon
+
+
+# ================================================== #
+# Helper Function to stream (way id, node id) rows
+# from the way_nodes csv written by process_map
+# ================================================== #
+def read_way_nodes_csv(path):
+
+    with open(path, 'rb') as way_nodes_file:
+        reader = csv.reader(way_nodes_file)
+        next(reader)
+        for way_id, node_id, _ in reader:
+            yield int(way_id), int(node_id)
+
+
+# ================================================== #
+# Function to turn every way into its coordinate
+# sequence. Rows must be grouped by way, in position
+# order, as process_map writes them. Node ids are
+# looked up a block at a time and each way's slice is
+# yielded as (way id, (n, 2) array of lat/lon)
+# ================================================== #
+def resolve_way_geometries(store, way_nodes, block_size=BLOCK_SIZE):
+
+    way_nodes = iter(way_nodes)
+    pending_way, pending_coords = None, []
+
+    while True:
+        block = list(itertools.islice(way_nodes, block_size))
+        if not block:
+            break
+
+        way_ids = np.fromiter((row[0] for row in block), dtype=np.int64, count=len(block))
+        coords  = store.lookup([row[1] for row in block])
+
+        # Start of each run of rows belonging to one way
+        starts = np.flatnonzero(np.r_[True, way_ids[1:] != way_ids[:-1]])
+        ends   = np.r_[starts[1:], len(block)]
+
+        for start, end in zip(starts, ends):
+            way_id = way_ids[start]
+            if way_id == pending_way:
+                pending_coords.append(coords[start:end])
+                continue
+            if pending_way is not None:
+                yield pending_way, np.concatenate(pending_coords)
+            pending_way, pending_coords = way_id, [coords[start:end]]
+
+    if pending_way is not None:
+        yield pending_way, np.concatenate(pending_coords)
+
+
+# ================================================== #
+# Function to build the store from a nodes csv, for
+# process_map modes that write the nodes in pieces
+# ================================================== #
+def build_from_csv(nodes_path, path=COORDS_PATH):
+
+    builder = NodeCoordBuilder()
+    with open(nodes_path, 'rb') as nodes_file:
+        reader = csv.DictReader(nodes_file)
+        for row in reader:
+            if row['lat'] and row['lon']:
+                builder.ids.append(int(row['id']))
+                builder.lats.append(float(row['lat']))
+                builder.lons.append(float(row['lon']))
+    builder.save(path)
@@ -0,0 +1,708 @@
+####################################################################
+# File: osm_db.py
+#
+# Description: This code holds the steps that run against the
+# SQLite database once the cleaned OSM data has been loaded. It
+# builds the indexes and the combined tags table used by the
+# report queries, and times the queries.sql workload.
+####################################################################
+
+import sqlite3
+import time
+
+# ================================================== #
+# Database File
+# ================================================== #
+DB_PATH = "denver_osm.db"
+
+# ================================================== #
+# Report queries, as recorded in queries.sql
+# ================================================== #
+QUERIES = [
+    ('postcode_top5', """
+        SELECT tags.value, COUNT(*) as count
+        FROM (SELECT * FROM node_tags
+              UNION ALL
+              SELECT * FROM way_tags) tags
+        WHERE tags.key='postcode'
+        GROUP BY tags.value
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('street_top5', """
+        SELECT tags.value, COUNT(*) as count
+        FROM (SELECT * FROM node_tags
+              UNION ALL
+              SELECT * FROM way_tags) tags
+        WHERE tags.key='street'
+        GROUP BY tags.value
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('node_users_top5', """
+        SELECT user, COUNT(*) as count
+        FROM nodes
+        GROUP BY uid
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('way_users_top5', """
+        SELECT user, COUNT(*) as count
+        FROM ways
+        GROUP BY uid
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('religion_top10', """
+        SELECT tags.value, COUNT(*) as count
+        FROM (SELECT * FROM node_tags
+              UNION ALL
+              SELECT * FROM way_tags) tags
+        WHERE tags.key='religion'
+        GROUP BY tags.value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('amenity_top10', """
+        SELECT tags.value, COUNT(*) as count
+        FROM (SELECT * FROM node_tags
+              UNION ALL
+              SELECT * FROM way_tags) tags
+        WHERE tags.key='amenity'
+        GROUP BY tags.value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('highway_top10', """
+        SELECT tags.value, COUNT(*) as count
+        FROM (SELECT * FROM node_tags
+              UNION ALL
+              SELECT * FROM way_tags) tags
+        WHERE tags.key='highway'
+        GROUP BY tags.value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('bicycle_yes', """
+        SELECT COUNT(*) as count
+        FROM way_tags
+        WHERE key='bicycle' and value='yes'
+        GROUP BY key, value"""),
+
+    ('natural_top10', """
+        SELECT value, COUNT(*) as count
+        FROM node_tags
+        WHERE key='natural'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('ele_top5', """
+        SELECT id, value
+        FROM node_tags
+        WHERE key='ele'
+        GROUP BY id
+        ORDER BY value DESC LIMIT 5"""),
+
+    ('peak_ele_top10', """
+        SELECT id, value
+        FROM node_tags
+        WHERE id IN (SELECT id FROM node_tags WHERE key='natural' AND value='peak') AND key='ele'
+        ORDER BY value DESC LIMIT 10"""),
+
+    ('peak_name_top10', """
+        SELECT id, value
+        FROM node_tags
+        WHERE id IN (SELECT id FROM node_tags
+                     WHERE id IN (SELECT id FROM node_tags WHERE key='natural' AND value='peak') AND key='ele'
+                     ORDER BY value DESC LIMIT 10) AND
+        key='name'"""),
+]
+
+# ================================================== #
+# Tag report queries rewritten against the combined
+# tags table, so they run as index-only scans
+# ================================================== #
+TAGS_QUERIES = [
+    ('postcode_top5', """
+        SELECT value, COUNT(*) as count
+        FROM tags
+        WHERE key='postcode'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('street_top5', """
+        SELECT value, COUNT(*) as count
+        FROM tags
+        WHERE key='street'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 5"""),
+
+    ('religion_top10', """
+        SELECT value, COUNT(*) as count
+        FROM tags
+        WHERE key='religion'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('amenity_top10', """
+        SELECT value, COUNT(*) as count
+        FROM tags
+        WHERE key='amenity'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 10"""),
+
+    ('highway_top10', """
+        SELECT value, COUNT(*) as count
+        FROM tags
+        WHERE key='highway'
+        GROUP BY value
+        ORDER BY count DESC LIMIT 10"""),
+]
+
+# ================================================== #
+# Indexes built once the bulk load is finished
+# ================================================== #
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS node_tags_key_value ON node_tags(key, value);
+CREATE INDEX IF NOT EXISTS node_tags_id        ON node_tags(id);
+CREATE INDEX IF NOT EXISTS way_tags_key_value  ON way_tags(key, value);
+CREATE INDEX IF NOT EXISTS way_tags_id         ON way_tags(id);
+CREATE INDEX IF NOT EXISTS way_nodes_id        ON way_nodes(id);
+CREATE INDEX IF NOT EXISTS way_nodes_node_id   ON way_nodes(node_id);
+"""
+
+# ================================================== #
+# Combined tags table with a covering index on
+# (key, value) for key filtered GROUP BY queries
+# ================================================== #
+TAGS_TABLE_SQL = """
+DROP TABLE IF EXISTS tags;
+
+CREATE TABLE tags AS
+    SELECT 'node' AS element_type, id, key, value, type FROM node_tags
+    UNION ALL
+    SELECT 'way'  AS element_type, id, key, value, type FROM way_tags;
+
+CREATE INDEX tags_key_value ON tags(key, value);
+CREATE INDEX tags_id        ON tags(id);
+"""
+
+# Triggers to keep the tags table in step with a tag table
+TAGS_TABLE_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS %(table)s_tags_insert;
+DROP TRIGGER IF EXISTS %(table)s_tags_delete;
+DROP TRIGGER IF EXISTS %(table)s_tags_update;
+
+CREATE TRIGGER %(table)s_tags_insert AFTER INSERT ON %(table)s
+BEGIN
+    INSERT INTO tags VALUES ('%(type)s', NEW.id, NEW.key, NEW.value, NEW.type);
+END;
+
+CREATE TRIGGER %(table)s_tags_delete AFTER DELETE ON %(table)s
+BEGIN
+    DELETE FROM tags WHERE rowid = (SELECT rowid FROM tags
+                                    WHERE id = OLD.id AND element_type = '%(type)s'
+                                      AND key IS OLD.key AND value IS OLD.value
+                                      AND type IS OLD.type
+                                    LIMIT 1);
+END;
+
+CREATE TRIGGER %(table)s_tags_update AFTER UPDATE ON %(table)s
+BEGIN
+    UPDATE tags SET id = NEW.id, key = NEW.key, value = NEW.value, type = NEW.type
+        WHERE rowid = (SELECT rowid FROM tags
+                       WHERE id = OLD.id AND element_type = '%(type)s'
+                         AND key IS OLD.key AND value IS OLD.value
+                         AND type IS OLD.type
+                       LIMIT 1);
+END;
+"""
+
+TAG_TABLES = [('node_tags', 'node'), ('way_tags', 'way')]
+
+# ================================================== #
+# Tag statistics summary table, one row per
+# (element_type, key, value) with its tag count, so
+# a node only or way only top N lookup is a scan of
+# the (element_type, key, count) index. The
+# tag_value_counts view sums the two element types
+# for the combined reports
+# ================================================== #
+TAG_STATS_SQL = """
+DROP VIEW IF EXISTS tag_value_counts;
+DROP TABLE IF EXISTS tag_stats;
+
+CREATE TABLE tag_stats (
+    element_type TEXT NOT NULL,
+    key TEXT,
+    value TEXT,
+    count INT NOT NULL,
+    PRIMARY KEY (element_type, key, value)
+);
+
+INSERT INTO tag_stats
+    SELECT 'node', key, value, COUNT(*) FROM node_tags GROUP BY key, value;
+INSERT INTO tag_stats
+    SELECT 'way', key, value, COUNT(*) FROM way_tags GROUP BY key, value;
+
+CREATE INDEX tag_stats_type_key_count ON tag_stats(element_type, key, count, value);
+CREATE INDEX tag_stats_key_value ON tag_stats(key, value, count);
+
+CREATE VIEW tag_value_counts AS
+    SELECT key, value, SUM(count) AS count
+    FROM tag_stats
+    GROUP BY key, value;
+"""
+
+# Triggers to keep tag_stats in step with the tag
+# table of one element type. The key and value
+# expressions differ between the plain and the
+# dictionary encoded tag tables. NULL
+# keys and values are distinct in the primary key,
+# so rows are matched with IS and only added when
+# no matching row exists
+TAG_STATS_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS %(table)s_stats_insert;
+DROP TRIGGER IF EXISTS %(table)s_stats_delete;
+DROP TRIGGER IF EXISTS %(table)s_stats_update;
+
+CREATE TRIGGER %(table)s_stats_insert AFTER INSERT ON %(source)s
+BEGIN
+    INSERT INTO tag_stats SELECT '%(type)s', %(new_key)s, %(new_value)s, 0
+        WHERE NOT EXISTS (SELECT 1 FROM tag_stats
+                          WHERE element_type = '%(type)s'
+                            AND key IS %(new_key)s AND value IS %(new_value)s);
+    UPDATE tag_stats SET count = count + 1
+        WHERE element_type = '%(type)s'
+          AND key IS %(new_key)s AND value IS %(new_value)s;
+END;
+
+CREATE TRIGGER %(table)s_stats_delete AFTER DELETE ON %(source)s
+BEGIN
+    UPDATE tag_stats SET count = count - 1
+        WHERE element_type = '%(type)s'
+          AND key IS %(old_key)s AND value IS %(old_value)s;
+    DELETE FROM tag_stats
+        WHERE element_type = '%(type)s'
+          AND key IS %(old_key)s AND value IS %(old_value)s AND count <= 0;
+END;
+
+CREATE TRIGGER %(table)s_stats_update AFTER UPDATE OF %(columns)s ON %(source)s
+BEGIN
+    UPDATE tag_stats SET count = count - 1
+        WHERE element_type = '%(type)s'
+          AND key IS %(old_key)s AND value IS %(old_value)s;
+    DELETE FROM tag_stats
+        WHERE element_type = '%(type)s'
+          AND key IS %(old_key)s AND value IS %(old_value)s AND count <= 0;
+    INSERT INTO tag_stats SELECT '%(type)s', %(new_key)s, %(new_value)s, 0
+        WHERE NOT EXISTS (SELECT 1 FROM tag_stats
+                          WHERE element_type = '%(type)s'
+                            AND key IS %(new_key)s AND value IS %(new_value)s);
+    UPDATE tag_stats SET count = count + 1
+        WHERE element_type = '%(type)s'
+          AND key IS %(new_key)s AND value IS %(new_value)s;
+END;
+"""
+
+TAG_STATS_COLUMNS = {'columns':   'key, value',
+                     'new_key':   'NEW.key',
+                     'new_value': 'NEW.value',
+                     'old_key':   'OLD.key',
+                     'old_value': 'OLD.value'}
+
+ENCODED_TAG_STATS_COLUMNS = {
+    'columns':   'key_id, value_id',
+    'new_key':   '(SELECT key FROM tag_keys WHERE id = NEW.key_id)',
+    'new_value': '(SELECT value FROM tag_values WHERE id = NEW.value_id)',
+    'old_key':   '(SELECT key FROM tag_keys WHERE id = OLD.key_id)',
+    'old_value': '(SELECT value FROM tag_values WHERE id = OLD.value_id)'}
+
+# ================================================== #
+# Dictionary encoded tag storage. Each distinct key
+# (and type) and each distinct value is stored once;
+# the tag rows in node_tags_data and way_tags_data
+# hold their integer ids. node_tags and way_tags
+# become views with the usual columns, so queries.sql
+# runs unchanged, and writes to them go through
+# INSTEAD OF triggers
+# ================================================== #
+TAG_DICTIONARY_SQL = """
+CREATE TABLE IF NOT EXISTS tag_keys (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS tag_values (
+    id INTEGER PRIMARY KEY,
+    value TEXT UNIQUE
+);
+"""
+
+ENCODED_TAG_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS %(table)s_data (
+    id INT REFERENCES %(parent)s,
+    key_id INT REFERENCES tag_keys,
+    value_id INT REFERENCES tag_values,
+    type_id INT REFERENCES tag_keys
+);
+
+CREATE VIEW IF NOT EXISTS %(table)s AS
+    SELECT d.id AS id, k.key AS key, v.value AS value, t.key AS type
+    FROM %(table)s_data d
+    LEFT JOIN tag_keys   k ON k.id = d.key_id
+    LEFT JOIN tag_values v ON v.id = d.value_id
+    LEFT JOIN tag_keys   t ON t.id = d.type_id;
+
+CREATE TRIGGER IF NOT EXISTS %(table)s_insert INSTEAD OF INSERT ON %(table)s
+BEGIN
+    INSERT OR IGNORE INTO tag_keys (key) SELECT NEW.key WHERE NEW.key IS NOT NULL;
+    INSERT OR IGNORE INTO tag_keys (key) SELECT NEW.type WHERE NEW.type IS NOT NULL;
+    INSERT OR IGNORE INTO tag_values (value) SELECT NEW.value WHERE NEW.value IS NOT NULL;
+    INSERT INTO %(table)s_data VALUES (NEW.id,
+                                       (SELECT id FROM tag_keys WHERE key = NEW.key),
+                                       (SELECT id FROM tag_values WHERE value = NEW.value),
+                                       (SELECT id FROM tag_keys WHERE key = NEW.type));
+END;
+
+CREATE TRIGGER IF NOT EXISTS %(table)s_delete INSTEAD OF DELETE ON %(table)s
+BEGIN
+    DELETE FROM %(table)s_data
+        WHERE rowid = (SELECT rowid FROM %(table)s_data
+                       WHERE id = OLD.id
+                         AND key_id IS (SELECT id FROM tag_keys WHERE key = OLD.key)
+                         AND value_id IS (SELECT id FROM tag_values WHERE value = OLD.value)
+                         AND type_id IS (SELECT id FROM tag_keys WHERE key = OLD.type)
+                       LIMIT 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS %(table)s_update INSTEAD OF UPDATE ON %(table)s
+BEGIN
+    INSERT OR IGNORE INTO tag_keys (key) SELECT NEW.key WHERE NEW.key IS NOT NULL;
+    INSERT OR IGNORE INTO tag_keys (key) SELECT NEW.type WHERE NEW.type IS NOT NULL;
+    INSERT OR IGNORE INTO tag_values (value) SELECT NEW.value WHERE NEW.value IS NOT NULL;
+    UPDATE %(table)s_data SET id       = NEW.id,
+                              key_id   = (SELECT id FROM tag_keys WHERE key = NEW.key),
+                              value_id = (SELECT id FROM tag_values WHERE value = NEW.value),
+                              type_id  = (SELECT id FROM tag_keys WHERE key = NEW.type)
+        WHERE rowid = (SELECT rowid FROM %(table)s_data
+                       WHERE id = OLD.id
+                         AND key_id IS (SELECT id FROM tag_keys WHERE key = OLD.key)
+                         AND value_id IS (SELECT id FROM tag_values WHERE value = OLD.value)
+                         AND type_id IS (SELECT id FROM tag_keys WHERE key = OLD.type)
+                       LIMIT 1);
+END;
+"""
+
+TAG_TABLE_PARENTS = {'node_tags': 'nodes', 'way_tags': 'ways'}
+
+# Tables the INDEX_SQL and ENCODED_INDEX_SQL indexes are on
+INDEXED_TABLES = ('node_tags', 'way_tags', 'node_tags_data', 'way_tags_data', 'way_nodes')
+
+# Indexes for the dictionary encoded tag tables
+ENCODED_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS node_tags_data_key_value ON node_tags_data(key_id, value_id);
+CREATE INDEX IF NOT EXISTS node_tags_data_id        ON node_tags_data(id);
+CREATE INDEX IF NOT EXISTS way_tags_data_key_value  ON way_tags_data(key_id, value_id);
+CREATE INDEX IF NOT EXISTS way_tags_data_id         ON way_tags_data(id);
+CREATE INDEX IF NOT EXISTS way_nodes_id             ON way_nodes(id);
+CREATE INDEX IF NOT EXISTS way_nodes_node_id        ON way_nodes(node_id);
+"""
+
+# With encoded tags the combined tags table is a view
+# too, rather than another copy of every tag string
+TAGS_VIEW_SQL = """
+DROP VIEW IF EXISTS tags;
+
+CREATE VIEW tags AS
+    SELECT 'node' AS element_type, id, key, value, type FROM node_tags
+    UNION ALL
+    SELECT 'way'  AS element_type, id, key, value, type FROM way_tags;
+"""
+
+# ================================================== #
+# R-tree spatial index over the node coordinates and
+# the triggers that keep it in step with nodes
+# ================================================== #
+RTREE_SQL = """
+DROP TABLE IF EXISTS nodes_rtree;
+
+CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+
+INSERT INTO nodes_rtree
+    SELECT id, lat, lat, lon, lon FROM nodes
+    WHERE lat IS NOT NULL AND lon IS NOT NULL;
+
+DROP TRIGGER IF EXISTS nodes_rtree_insert;
+DROP TRIGGER IF EXISTS nodes_rtree_delete;
+DROP TRIGGER IF EXISTS nodes_rtree_update;
+
+CREATE TRIGGER nodes_rtree_insert AFTER INSERT ON nodes
+WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL
+BEGIN
+    INSERT OR REPLACE INTO nodes_rtree VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+END;
+
+CREATE TRIGGER nodes_rtree_delete AFTER DELETE ON nodes
+BEGIN
+    DELETE FROM nodes_rtree WHERE id = OLD.id;
+END;
+
+CREATE TRIGGER nodes_rtree_update AFTER UPDATE OF id, lat, lon ON nodes
+BEGIN
+    DELETE FROM nodes_rtree WHERE id = OLD.id;
+    INSERT INTO nodes_rtree
+        SELECT NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon
+        WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+END;
+"""
+
+# The R-tree stores 32 bit floats rounded outwards, so
+# its candidates are checked against the exact lat/lon
+NODES_IN_BBOX_SQL = """
+    SELECT nodes.*
+    FROM nodes_rtree JOIN nodes ON nodes.id = nodes_rtree.id
+    WHERE nodes_rtree.max_lat >= :min_lat AND nodes_rtree.min_lat <= :max_lat
+      AND nodes_rtree.max_lon >= :min_lon AND nodes_rtree.min_lon <= :max_lon
+      AND nodes.lat BETWEEN :min_lat AND :max_lat
+      AND nodes.lon BETWEEN :min_lon AND :max_lon"""
+
+WAYS_IN_BBOX_SQL = """
+    SELECT ways.*
+    FROM ways
+    WHERE ways.id IN (SELECT way_nodes.id
+                      FROM nodes_rtree
+                      JOIN nodes     ON nodes.id = nodes_rtree.id
+                      JOIN way_nodes ON way_nodes.node_id = nodes_rtree.id
+                      WHERE nodes_rtree.max_lat >= :min_lat AND nodes_rtree.min_lat <= :max_lat
+                        AND nodes_rtree.max_lon >= :min_lon AND nodes_rtree.min_lon <= :max_lon
+                        AND nodes.lat BETWEEN :min_lat AND :max_lat
+                        AND nodes.lon BETWEEN :min_lon AND :max_lon)"""
+
+# Top N values for a tag key over nodes and ways,
+# summed from tag_stats
+TOP_TAG_VALUES_SQL = """
+    SELECT value, count
+    FROM tag_value_counts
+    WHERE key=?
+    ORDER BY count DESC LIMIT ?"""
+
+# Top N values for a tag key on one element type
+TOP_TYPED_TAG_VALUES_SQL = """
+    SELECT value, count
+    FROM tag_stats
+    WHERE element_type=? AND key=?
+    ORDER BY count DESC LIMIT ?"""
+
+# Count of one tag on one element type
+TYPED_TAG_COUNT_SQL = """
+    SELECT count
+    FROM tag_stats
+    WHERE element_type=? AND key=? AND value=?"""
+
+# Tag report queries answered from tag_stats, with
+# the parameters of the matching queries.sql query
+STATS_QUERIES = [('postcode_top5',  TOP_TAG_VALUES_SQL,       ('postcode', 5)),
+                 ('street_top5',    TOP_TAG_VALUES_SQL,       ('street', 5)),
+                 ('religion_top10', TOP_TAG_VALUES_SQL,       ('religion', 10)),
+                 ('amenity_top10',  TOP_TAG_VALUES_SQL,       ('amenity', 10)),
+                 ('highway_top10',  TOP_TAG_VALUES_SQL,       ('highway', 10)),
+                 ('bicycle_yes',    TYPED_TAG_COUNT_SQL,      ('way', 'bicycle', 'yes')),
+                 ('natural_top10',  TOP_TYPED_TAG_VALUES_SQL, ('node', 'natural', 10))]
+
+
+# ================================================== #
+# Function to create the dictionary encoded tag
+# tables, views and triggers
+# ================================================== #
+def create_encoded_tag_tables(db):
+
+    db.executescript(TAG_DICTIONARY_SQL)
+    for table, _ in TAG_TABLES:
+        db.executescript(ENCODED_TAG_TABLE_SQL % {'table':  table,
+                                                  'parent': TAG_TABLE_PARENTS[table]})
+
+
+# ================================================== #
+# Helper Functions to check how a database stores its
+# tags: node_tags is a 'table' for plain text tags, a
+# 'view' for dictionary encoded ones, or None before
+# the tables are created
+# ================================================== #
+def tag_table_type(db):
+    row = db.execute("SELECT type FROM sqlite_master WHERE name = 'node_tags'").fetchone()
+    return row and row[0]
+
+
+def is_encoded(db):
+    return tag_table_type(db) == 'view'
+
+
+# ================================================== #
+# Function to drop the indexes build_indexes puts on
+# the loaded tables, so a database can be timed as
+# it was straight after the bulk load
+# ================================================== #
+def drop_indexes(db):
+    # Indexes without sql are the automatic primary key ones
+    names = [row[0] for row in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        "AND tbl_name IN (%s)" % ", ".join("?" * len(INDEXED_TABLES)), INDEXED_TABLES)]
+    for name in names:
+        db.execute("DROP INDEX %s" % name)
+    db.commit()
+
+
+# ================================================== #
+# Function to build the indexes and the combined
+# tags table after the bulk load
+# ================================================== #
+def build_indexes(db):
+
+    if is_encoded(db):
+        db.executescript(ENCODED_INDEX_SQL)
+        db.executescript(TAGS_VIEW_SQL)
+    else:
+        db.executescript(INDEX_SQL)
+        db.executescript(TAGS_TABLE_SQL)
+        for table, element_type in TAG_TABLES:
+            db.executescript(TAGS_TABLE_TRIGGERS_SQL % {'table': table, 'type': element_type})
+    db.execute("ANALYZE")
+    db.commit()
+
+
+# ================================================== #
+# Function to build the tag_stats summary table and
+# the triggers that maintain it as tag rows are
+# added or removed
+# ================================================== #
+def build_tag_stats(db):
+
+    encoded = is_encoded(db)
+    db.executescript(TAG_STATS_SQL)
+    for table, element_type in TAG_TABLES:
+        params = dict(ENCODED_TAG_STATS_COLUMNS if encoded else TAG_STATS_COLUMNS)
+        params.update({'table':  table,
+                       'type':   element_type,
+                       'source': table + '_data' if encoded else table})
+        db.executescript(TAG_STATS_TRIGGERS_SQL % params)
+    db.commit()
+
+
+# ================================================== #
+# Function to build the R-tree index over the node
+# coordinates
+# ================================================== #
+def build_spatial_index(db):
+
+    db.executescript(RTREE_SQL)
+    db.commit()
+
+
+# ================================================== #
+# Helper Function to turn a bounding box into query
+# parameters
+# ================================================== #
+def bbox_params(min_lat, min_lon, max_lat, max_lon):
+    return {'min_lat': min_lat, 'min_lon': min_lon,
+            'max_lat': max_lat, 'max_lon': max_lon}
+
+
+# ================================================== #
+# Function to find the nodes inside a bounding box
+# ================================================== #
+def nodes_in_bbox(db, min_lat, min_lon, max_lat, max_lon):
+    return db.execute(NODES_IN_BBOX_SQL,
+                      bbox_params(min_lat, min_lon, max_lat, max_lon)).fetchall()
+
+
+# ================================================== #
+# Function to find the ways with at least one node
+# inside a bounding box
+# ================================================== #
+def ways_in_bbox(db, min_lat, min_lon, max_lat, max_lon):
+    return db.execute(WAYS_IN_BBOX_SQL,
+                      bbox_params(min_lat, min_lon, max_lat, max_lon)).fetchall()
+
+
+# ================================================== #
+# Function to look up the most common values of a
+# tag key from tag_stats, over nodes and ways or
+# for one element type
+# ================================================== #
+def top_tag_values(db, key, limit=10, element_type=None):
+    if element_type is None:
+        return db.execute(TOP_TAG_VALUES_SQL, (key, limit)).fetchall()
+    return db.execute(TOP_TYPED_TAG_VALUES_SQL, (element_type, key, limit)).fetchall()
+
+
+# ================================================== #
+# Function to time each query, keeping the best of
+# a few runs. A query is (name, sql) or
+# (name, sql, parameters)
+# ================================================== #
+def time_queries(db, queries=QUERIES, repeat=3):
+
+    timings = []
+    for query in queries:
+        name, sql = query[:2]
+        params    = query[2] if len(query) > 2 else ()
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            db.execute(sql, params).fetchall()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append((name, best))
+    return timings
+
+
+# ================================================== #
+# Function to print the queries.sql timings before
+# and after the indexes are built. Indexes already
+# in the database are dropped first, so "before"
+# times the bare tables
+# ================================================== #
+def benchmark_indexes(db_path=DB_PATH, repeat=3):
+
+    db = sqlite3.connect(db_path)
+    try:
+        drop_indexes(db)
+        before = time_queries(db, QUERIES, repeat)
+
+        start = time.time()
+        build_indexes(db)
+        build_tag_stats(db)
+        print "Built indexes in %.2fs" % (time.time() - start)
+
+        after       = dict(time_queries(db, QUERIES, repeat))
+        after_tags  = dict(time_queries(db, TAGS_QUERIES, repeat))
+        after_stats = dict(time_stats_queries(db, repeat))
+    finally:
+        db.close()
+
+    print "%-16s %10s %10s %10s %10s" % ("query", "before", "after", "tags", "stats")
+    for name, elapsed in before:
+        print "%-16s %9.2fms %9.2fms %10s %10s" % (name,
+                                                   elapsed * 1000,
+                                                   after[name] * 1000,
+                                                   format_ms(after_tags.get(name)),
+                                                   format_ms(after_stats.get(name)))
+
+
+# ================================================== #
+# Helper Function to time the tag_stats lookups
+# ================================================== #
+def time_stats_queries(db, repeat=3):
+    return time_queries(db, STATS_QUERIES, repeat)
+
+
+# ================================================== #
+# Helper Function to format an optional timing
+# ================================================== #
+def format_ms(elapsed):
+    if elapsed is None:
+        return "-"
+    return "%.2fms" % (elapsed * 1000)
+
+
+# ================================================== #
+# Main()
+# ================================================== #
+if __name__ == "__main__":
+    print("Running...")
+    benchmark_indexes(DB_PATH)
@@ -0,0 +1,329 @@
+####################################################################
+# File: osm_input.py
+#
+# Description: This code opens OSM input files, reading .bz2, .gz
+# and .xz extracts without expanding them on disk first. A
+# background thread decompresses the file into a bounded queue of
+# blocks while the caller parses the blocks already there, so
+# decompression and parsing overlap. .xz files are decompressed by
+# an xz process when the lzma module is not available. Byte
+# ranges of a plain file are read the same way, a block at a
+# time, for the parallel workers.
+####################################################################
+
+import bz2
+import os
+import subprocess
+import threading
+import zlib
+import Queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# ================================================== #
+# Compressed bytes read at a time, and decompressed
+# blocks buffered ahead of the parser. OSM XML
+# expands 10-20x, so the queue holds about 20 MB
+# ================================================== #
+READ_SIZE    = 1 << 16
+QUEUE_BLOCKS = 16
+
+COMPRESSIONS = {'.bz2': 'bz2',
+                '.gz':  'gzip',
+                '.xz':  'xz'}
+
+# Put into the queue after the last block
+END_OF_DATA = None
+
+
+# ================================================== #
+# Helper Function to find the compression of a file
+# from its extension, None for a plain file
+# ================================================== #
+def compression(path):
+    if not isinstance(path, basestring):
+        return None
+    return COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def is_compressed(path):
+    return compression(path) is not None
+
+
+# PBF files are read by osm_pbf, not as XML
+def is_pbf(path):
+    return isinstance(path, basestring) and path.lower().endswith('.pbf')
+
+
+# ================================================== #
+# Functions to refuse input the byte level XML code
+# cannot read: PBF files, and compressed files where
+# the code has to seek around the file
+# ================================================== #
+def require_xml(path, purpose):
+    if is_pbf(path):
+        raise ValueError("%s needs OSM XML input, %s is a PBF file" % (purpose, path))
+
+
+def require_seekable(path, purpose):
+    require_xml(path, purpose)
+    if is_compressed(path):
+        raise ValueError("%s needs an uncompressed .osm file, %s is %s compressed; "
+                         "decompress it first or use the serial path"
+                         % (purpose, path, compression(path)))
+
+
+# ================================================== #
+# Decompressors. Each yields the decompressed blocks
+# of a compressed file object. Files made of several
+# concatenated streams (pbzip2, pigz) are read to the
+# end
+# ================================================== #
+def decompress_blocks(raw, new_decompressor, read_size=READ_SIZE):
+
+    decompressor = new_decompressor()
+    while True:
+        data = raw.read(read_size)
+        if not data:
+            break
+        while data:
+            try:
+                block = decompressor.decompress(data)
+            except EOFError:
+                # bz2 raises once its stream has ended
+                decompressor = new_decompressor()
+                block = decompressor.decompress(data)
+            if block:
+                yield block
+            data = decompressor.unused_data
+            if data:
+                decompressor = new_decompressor()
+
+    flush = getattr(decompressor, 'flush', None)
+    if flush:
+        block = flush()
+        if block:
+            yield block
+
+
+def gzip_decompressor():
+    # 16 + MAX_WBITS reads the gzip header and trailer
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def xz_blocks(path, read_size=READ_SIZE):
+
+    if lzma is not None:
+        with open(path, 'rb') as raw:
+            for block in decompress_blocks(raw, lzma.LZMADecompressor, read_size):
+                yield block
+        return
+
+    try:
+        process = subprocess.Popen(['xz', '--decompress', '--stdout', path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        raise IOError("reading %s needs the lzma module or the xz program" % path)
+    try:
+        while True:
+            block = process.stdout.read(read_size)
+            if not block:
+                break
+            yield block
+    finally:
+        process.stdout.close()
+        error = process.stderr.read()
+        if process.wait() not in (0, -13):
+            raise IOError("xz failed on %s: %s" % (path, error.strip()))
+
+
+def compressed_blocks(path, read_size=READ_SIZE):
+
+    kind = compression(path)
+    if kind == 'xz':
+        return xz_blocks(path, read_size)
+
+    def blocks():
+        with open(path, 'rb') as raw:
+            new_decompressor = bz2.BZ2Decompressor if kind == 'bz2' else gzip_decompressor
+            for block in decompress_blocks(raw, new_decompressor, read_size):
+                yield block
+    return blocks()
+
+
+# ================================================== #
+# Read only file object over a compressed file. The
+# decompressing thread blocks once the queue holds
+# queue_blocks blocks, so memory stays bounded
+# ================================================== #
+class DecompressingReader(object):
+
+    def __init__(self, path, queue_blocks=QUEUE_BLOCKS, read_size=READ_SIZE):
+        self.name    = path
+        self.queue   = Queue.Queue(queue_blocks)
+        self.stopped = threading.Event()
+        self.buffer  = ''
+        self.offset  = 0
+        self.done    = False
+        self.closed  = False
+
+        self.thread = threading.Thread(target=self.fill, args=(path, read_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # ---------------------------------------------- #
+    # Runs in the background thread
+    # ---------------------------------------------- #
+    def put(self, item):
+        # Wait for room, giving up once the reader is closed
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fill(self, path, read_size):
+        blocks = compressed_blocks(path, read_size)
+        try:
+            for block in blocks:
+                if not self.put(block):
+                    return
+            self.put(END_OF_DATA)
+        except Exception as e:
+            self.put(e)
+        finally:
+            blocks.close()
+
+    # ---------------------------------------------- #
+    # File interface for the parser
+    # ---------------------------------------------- #
+    def next_block(self):
+        item = self.queue.get()
+        if item is END_OF_DATA:
+            self.done = True
+            return False
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+        self.buffer = item
+        self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        if size is None or size < 0:
+            parts = [self.buffer[self.offset:]]
+            while not self.done and self.next_block():
+                parts.append(self.buffer)
+            self.buffer, self.offset = '', 0
+            return ''.join(parts)
+
+        parts = []
+        while size > 0:
+            available = len(self.buffer) - self.offset
+            if available <= 0:
+                if self.done or not self.next_block():
+                    break
+                continue
+            part = self.buffer[self.offset:self.offset + size]
+            self.offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return parts[0] if len(parts) == 1 else ''.join(parts)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stopped.set()
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ================================================== #
+# Read only file object over a byte range of a plain
+# file, between a prefix and a suffix. Lets a worker
+# parse one chunk of an OSM file as a document of its
+# own, reading the range a block at a time
+# ================================================== #
+class ByteRangeReader(object):
+
+    def __init__(self, path, start, end, prefix='', suffix='', read_size=READ_SIZE):
+        self.name   = path
+        self.file   = open(path, 'rb')
+        self.blocks = self.range_blocks(start, end, prefix, suffix, read_size)
+        self.buffer = ''
+        self.offset = 0
+        self.closed = False
+
+    def range_blocks(self, start, end, prefix, suffix, read_size):
+        yield prefix
+        self.file.seek(start)
+        left = end - start
+        while left > 0:
+            block = self.file.read(min(read_size, left))
+            if not block:
+                break
+            left -= len(block)
+            yield block
+        yield suffix
+
+    # ---------------------------------------------- #
+    # File interface for the parser
+    # ---------------------------------------------- #
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        if size is None or size < 0:
+            parts = [self.buffer[self.offset:]]
+            parts.extend(self.blocks)
+            self.buffer, self.offset = '', 0
+            return ''.join(parts)
+
+        parts = []
+        while size > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = next(self.blocks, None)
+                self.offset = 0
+                if self.buffer is None:
+                    self.buffer = ''
+                    break
+                continue
+            part = self.buffer[self.offset:self.offset + size]
+            self.offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ================================================== #
+# Function to open an OSM file for binary reading,
+# decompressing it in the background when needed
+# ================================================== #
+def open_osm(path, queue_blocks=QUEUE_BLOCKS):
+    if is_compressed(path):
+        return DecompressingReader(path, queue_blocks)
+    return open(path, 'rb')
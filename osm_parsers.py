@@ -0,0 +1,290 @@
+####################################################################
+# File: osm_parsers.py
+#
+# Description: This code provides the XML parser backends behind
+# get_element in the audit, clean and split scripts. Every backend
+# streams the elements of an OSM file on their end events and
+# yields objects with the same .tag, .attrib, child iteration and
+# .iter(tag), so the scripts work with any of them:
+#
+#   etree  cElementTree iterparse (the default)
+#   expat  expat events straight into ElementRecord objects,
+#          without building an ElementTree. Its handlers run
+#          in Python, so it is not faster than etree (0.8-1.1x
+#          on the sample and a 10 MB synthetic file) and is
+#          not a speed option; all its strings are unicode
+#   lxml   lxml iterparse, registered only when lxml is
+#          installed (about 1.1-1.3x etree)
+#
+# The backend is picked with set_parser() or the parser argument.
+# Compressed .bz2, .gz and .xz files are read through osm_input,
+# and .osm.pbf files by osm_pbf whichever backend is selected.
+####################################################################
+
+import sys
+import time
+import xml.etree.cElementTree as ET
+from collections import OrderedDict
+from xml.parsers import expat
+
+import osm_input
+
+try:
+    import lxml.etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# ================================================== #
+# Bytes handed to expat at a time
+# ================================================== #
+BLOCK_SIZE = 1 << 16
+
+
+# ================================================== #
+# Lightweight element: a list of its child elements
+# with a tag name and an attribute dict, covering
+# the parts of the ElementTree interface the
+# scripts use
+# ================================================== #
+class ElementRecord(list):
+
+    __slots__ = ('tag', 'attrib')
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def keys(self):
+        return self.attrib.keys()
+
+    def items(self):
+        return self.attrib.items()
+
+    def iter(self, tag=None):
+        """Yield this element and its descendants, optionally only one tag"""
+
+        if tag == '*':
+            tag = None
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self:
+            if child:
+                for elem in child.iter(tag):
+                    yield elem
+            elif tag is None or child.tag == tag:
+                yield child
+
+    def clear(self):
+        self.attrib = {}
+        del self[:]
+
+    def __repr__(self):
+        return "<ElementRecord %r at 0x%x>" % (self.tag, id(self))
+
+
+# ================================================== #
+# Helper Function to match cElementTree's strings:
+# plain ASCII stays str, anything else is unicode
+# ================================================== #
+def decode_text(value):
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+# ================================================== #
+# Parser Backends. Each takes a path or binary file
+# object and yields the elements whose tag is in
+# tags (every element when tags is None) once they
+# are complete. Top level elements are released
+# after they have been yielded
+# ================================================== #
+def etree_elements(osm_file, tags=None):
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 1
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if tags is None or elem.tag in tags:
+            yield elem
+        if depth == 1:
+            root.clear()
+
+
+def expat_elements(osm_file, tags=None, block_size=BLOCK_SIZE):
+
+    stack = []
+    done  = []
+    push  = stack.append
+    pop   = stack.pop
+
+    def start(tag, attrib):
+        elem = ElementRecord()
+        elem.tag    = tag
+        elem.attrib = attrib
+        push(elem)
+
+    def end(tag):
+        elem = pop()
+        # Children of the root are not kept on it, so memory
+        # stays bounded by the largest top level element
+        if len(stack) > 1:
+            stack[-1].append(elem)
+        if tags is None or elem.tag in tags:
+            done.append(elem)
+
+    # expat decodes the names and values to unicode in C,
+    # which is cheaper than checking each start tag for
+    # UTF-8 in Python
+    parser = expat.ParserCreate()
+    parser.returns_unicode     = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler   = end
+
+    own_file = not hasattr(osm_file, 'read')
+    if own_file:
+        osm_file = open(osm_file, 'rb')
+    try:
+        while True:
+            data = osm_file.read(block_size)
+            parser.Parse(data, not data)
+            for elem in done:
+                yield elem
+            del done[:]
+            if not data:
+                break
+    finally:
+        if own_file:
+            osm_file.close()
+
+
+def lxml_elements(osm_file, tags=None):
+
+    for _, elem in lxml_etree.iterparse(osm_file, events=('end',)):
+        if tags is None or elem.tag in tags:
+            yield elem
+        parent = elem.getparent()
+        if parent is not None and parent.getparent() is None:
+            # Top level element: drop it and anything before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+PARSERS = OrderedDict([('etree', etree_elements),
+                       ('expat', expat_elements)])
+if lxml_etree is not None:
+    PARSERS['lxml'] = lxml_elements
+
+# Backend used when no parser is given
+PARSER = 'etree'
+
+
+# ================================================== #
+# Function to select the default backend at runtime
+# ================================================== #
+def set_parser(name):
+    global PARSER
+    get_parser(name)
+    PARSER = name
+
+
+def get_parser(name=None):
+    name = PARSER if name is None else name
+    if name not in PARSERS:
+        raise ValueError("unknown parser %r, expected one of: %s" % (name, ", ".join(PARSERS)))
+    return PARSERS[name]
+
+
+# ================================================== #
+# Function to list the backends that can be used
+# ================================================== #
+def available_parsers():
+    return list(PARSERS)
+
+
+# ================================================== #
+# Function to stream elements with a backend
+# ================================================== #
+def iter_elements(osm_file, tags=None, parser=None):
+    backend = get_parser(parser)
+    if osm_input.is_pbf(osm_file):
+        import osm_pbf
+        return osm_pbf.pbf_elements(osm_file, tags)
+    if osm_input.is_compressed(osm_file):
+        return compressed_elements(backend, osm_file, tags)
+    return backend(osm_file, tags)
+
+
+# ================================================== #
+# Helper Function to parse a .bz2, .gz or .xz file
+# while osm_input decompresses it in the background
+# ================================================== #
+def compressed_elements(backend, osm_file, tags):
+    with osm_input.open_osm(osm_file) as reader:
+        for elem in backend(reader, tags):
+            yield elem
+
+
+# ================================================== #
+# Helper Function to reduce an element to plain data
+# for comparing the backends' output
+# ================================================== #
+def element_summary(elem):
+    return (elem.tag, sorted(elem.attrib.items()),
+            [(child.tag, sorted(child.attrib.items())) for child in elem])
+
+
+# ================================================== #
+# Function to time the backends on the same file.
+# Each run reads every top level element's
+# attributes and children, and the output of every
+# backend is checked against the first one
+# ================================================== #
+BENCHMARK_NOTES = {'expat': "Python handlers, not a speed option"}
+
+
+def benchmark_parsers(osm_file, parsers=None, repeat=3, tags=('node', 'way', 'relation')):
+
+    parsers = parsers or available_parsers()
+
+    expected = None
+    times    = OrderedDict()
+    for name in parsers:
+        summaries = [element_summary(elem) for elem in iter_elements(osm_file, tags, name)]
+        if expected is None:
+            expected = summaries
+        elif summaries != expected:
+            raise AssertionError("%s parser output differs from %s" % (name, parsers[0]))
+
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for elem in iter_elements(osm_file, tags, name):
+                elem.attrib.get('id')
+                for child in elem:
+                    child.attrib
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+
+    print "%d elements" % len(expected)
+    for name, elapsed in times.items():
+        line = "%-6s %8.3fs %10.0f elements/s (%.2fx) %s" % (name, elapsed,
+                                                             len(expected) / max(elapsed, 1e-9),
+                                                             times[parsers[0]] / max(elapsed, 1e-9),
+                                                             BENCHMARK_NOTES.get(name, ""))
+        print line.rstrip()
+    return times
+
+
+# ================================================== #
+# Main()
+# ================================================== #
+if __name__ == "__main__":
+    benchmark_parsers(sys.argv[1] if len(sys.argv) > 1 else 'denver-boulder_colorado_small.osm')
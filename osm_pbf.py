@@ -0,0 +1,933 @@
+####################################################################
+# File: osm_pbf.py
+#
+# Description: This code reads OSM PBF files (.osm.pbf), the
+# format extracts are usually distributed in. The protobuf messages
+# are decoded by hand, so nothing beyond the standard library is
+# needed: blob framing, the OSMHeader block, and OSMData blocks with
+# their string tables, plain and dense nodes, ways and relations
+# (ids, coordinates and metadata are delta coded). Elements come
+# out as osm_parsers.ElementRecord objects with the same attributes
+# and tag/nd/member children the XML parsers give, so shape_node
+# and shape_way work on them unchanged. Data blobs do not depend on
+# each other and are decoded in a process pool.
+#
+# PBFWriter and xml_to_pbf write PBF files, so small fixtures can be
+# made offline from any OSM XML file (see write_fixture).
+####################################################################
+
+import calendar
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+
+from osm_parsers import ElementRecord, decode_text
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# ================================================== #
+# Decoding Settings
+# ================================================== #
+
+# Processes decoding data blobs (1 decodes in this process)
+WORKERS = multiprocessing.cpu_count()
+
+# Blobs queued per worker ahead of the consumer, which
+# bounds memory however large the file is
+PENDING_PER_WORKER = 2
+
+# Size limits from the PBF specification
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE        = 32 * 1024 * 1024
+
+SUPPORTED_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+TOP_LEVEL_TAGS = frozenset(['node', 'way', 'relation'])
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Elements per OSMData block written by PBFWriter
+BLOCK_ELEMENTS = 8000
+
+# DenseInfo columns, in field order. A column is only
+# written when some node of the block has the
+# attribute; nodes without it get the value below,
+# which the reader skips. None of them occur in real
+# data: versions and uids start at 1 and 0, OSM
+# timestamps and changesets are after the epoch and
+# above 0, and string 0 is the empty string
+DENSE_INFO_FIELDS = ('version', 'timestamp', 'changeset', 'uid', 'user')
+DENSE_MISSING     = {'version':   -1,
+                     'timestamp': 0,
+                     'changeset': 0,
+                     'uid':       -1,
+                     'user':      0}
+
+# Every this many fixture nodes are written without
+# metadata (see write_fixture)
+FIXTURE_BARE_EVERY = 5
+
+# Protobuf wire types
+VARINT, FIXED64, LENGTH, FIXED32 = 0, 1, 2, 5
+
+UINT64 = 1 << 64
+INT64_MAX = (1 << 63) - 1
+
+
+# ================================================== #
+# Protobuf Decoding. Messages are bytearrays so
+# indexing gives ints without a call per byte
+# ================================================== #
+def read_varint(buf, pos):
+    result = 0
+    shift  = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buf):
+    """Yield (field number, value) for each field of a message
+
+    Varints come back as unsigned ints, length delimited fields as
+    bytearrays and fixed width fields as raw bytes.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def decode_packed(buf):
+    """Decode a packed field of unsigned varints"""
+
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        if byte < 0x80:
+            append(byte)
+            continue
+        result = byte & 0x7f
+        shift  = 7
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def signed(value):
+    # int32/int64 fields store negatives as 64 bit two's complement
+    return value - UINT64 if value > INT64_MAX else value
+
+
+def zigzag(value):
+    # sint32/sint64 fields
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_packed_signed(buf):
+    return [value - UINT64 if value > INT64_MAX else value for value in decode_packed(buf)]
+
+
+def decode_packed_deltas(buf):
+    """Decode a packed, delta coded field of sint64s (ids, coordinates)"""
+
+    total   = 0
+    decoded = []
+    append  = decoded.append
+    for value in decode_packed(buf):
+        total += (value >> 1) ^ -(value & 1)
+        append(total)
+    return decoded
+
+
+# ================================================== #
+# Helper Functions to format values the way they are
+# written in OSM XML
+# ================================================== #
+def format_coord(nanodegrees):
+    sign = '-' if nanodegrees < 0 else ''
+    whole, fraction = divmod(abs(nanodegrees), 1000000000)
+    fraction = ('%09d' % fraction).rstrip('0')
+    return "%s%d.%s" % (sign, whole, fraction) if fraction else "%s%d" % (sign, whole)
+
+
+def format_coords(values, offset, granularity):
+    """format_coord for a column of coordinates of one block"""
+
+    if offset % 100 or granularity % 100:
+        return [format_coord(offset + granularity * value) for value in values]
+
+    # Whole units of 1e-7 degrees, the usual case
+    scale  = granularity // 100
+    offset = offset // 100
+    texts  = []
+    append = texts.append
+    for value in values:
+        value = offset + scale * value
+        if value < 0:
+            whole, fraction = divmod(-value, 10000000)
+            text = "-%d.%07d" % (whole, fraction)
+        else:
+            whole, fraction = divmod(value, 10000000)
+            text = "%d.%07d" % (whole, fraction)
+        append(text.rstrip('0').rstrip('.') if text[-1] == '0' else text)
+    return texts
+
+
+def format_timestamp(seconds):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+
+def make_record(tag, attrib):
+    elem = ElementRecord()
+    elem.tag    = tag
+    elem.attrib = attrib
+    return elem
+
+
+def add_tags(elem, keys, values, strings):
+    for key, value in zip(keys, values):
+        elem.append(make_record('tag', {'k': strings[key], 'v': strings[value]}))
+
+
+# ================================================== #
+# File Framing: each blob is a 4 byte length, a
+# BlobHeader message and the Blob itself
+# ================================================== #
+def read_blobs(pbf_path):
+    """Yield (blob type, raw Blob message) for each blob in the file"""
+
+    with open(pbf_path, 'rb') as pbf_file:
+        while True:
+            size = pbf_file.read(4)
+            if not size:
+                return
+            if len(size) < 4:
+                raise ValueError("%s: truncated blob header length" % pbf_path)
+            header_size = struct.unpack('>I', size)[0]
+            if header_size > MAX_BLOB_HEADER_SIZE:
+                raise ValueError("%s: blob header of %d bytes is too large" % (pbf_path, header_size))
+
+            blob_type = None
+            data_size = 0
+            for field, value in iter_fields(bytearray(pbf_file.read(header_size))):
+                if field == 1:
+                    blob_type = str(value)
+                elif field == 3:
+                    data_size = value
+            if data_size > MAX_BLOB_SIZE:
+                raise ValueError("%s: blob of %d bytes is too large" % (pbf_path, data_size))
+
+            blob = pbf_file.read(data_size)
+            if len(blob) < data_size:
+                raise ValueError("%s: truncated %s blob" % (pbf_path, blob_type))
+            yield blob_type, blob
+
+
+def decompress_blob(blob):
+    """Return the uncompressed contents of a Blob message"""
+
+    fields = dict(iter_fields(bytearray(blob)))
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        data = zlib.decompress(str(fields[3]))
+    elif 4 in fields:
+        if lzma is None:
+            raise ValueError("lzma compressed blobs need the lzma module")
+        data = lzma.decompress(str(fields[4]))
+    elif set(fields) & set([5, 6, 7]):
+        raise ValueError("unsupported blob compression (field %d)" % min(set(fields) & set([5, 6, 7])))
+    else:
+        raise ValueError("blob has no data")
+
+    if 2 in fields and len(data) != fields[2]:
+        raise ValueError("blob decompressed to %d bytes, expected %d" % (len(data), fields[2]))
+    return bytearray(data)
+
+
+# ================================================== #
+# OSMHeader block. Returns the required features and
+# the bounding box (or None)
+# ================================================== #
+def decode_header_block(data):
+
+    required = []
+    bbox     = None
+    for field, value in iter_fields(data):
+        if field == 4:
+            required.append(str(value))
+        elif field == 1:
+            sides = dict((side, zigzag(edge)) for side, edge in iter_fields(value))
+            bbox = {'minlon': format_coord(sides.get(1, 0)),
+                    'maxlon': format_coord(sides.get(2, 0)),
+                    'maxlat': format_coord(sides.get(3, 0)),
+                    'minlat': format_coord(sides.get(4, 0))}
+
+    unsupported = set(required) - SUPPORTED_FEATURES
+    if unsupported:
+        raise ValueError("PBF file needs unsupported features: %s" % ", ".join(sorted(unsupported)))
+    return required, bbox
+
+
+# ================================================== #
+# OSMData block
+# ================================================== #
+class PrimitiveBlock(object):
+    """Decoding state shared by the groups of one OSMData block"""
+
+    def __init__(self, data):
+        self.strings          = []
+        self.groups           = []
+        self.granularity      = 100
+        self.date_granularity = 1000
+        self.lat_offset       = 0
+        self.lon_offset       = 0
+
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [decode_text(str(text)) for number, text in iter_fields(value)
+                                if number == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def lat(self, value):
+        return format_coord(self.lat_offset + self.granularity * value)
+
+    def lon(self, value):
+        return format_coord(self.lon_offset + self.granularity * value)
+
+    def timestamp(self, value):
+        return format_timestamp(value * self.date_granularity // 1000)
+
+    def info(self, attrib, data):
+        """Add the fields of an Info message to attrib"""
+
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['version'] = str(signed(value))
+            elif field == 2:
+                attrib['timestamp'] = self.timestamp(signed(value))
+            elif field == 3:
+                attrib['changeset'] = str(signed(value))
+            elif field == 4:
+                attrib['uid'] = str(signed(value))
+            elif field == 5:
+                attrib['user'] = self.strings[value]
+            elif field == 6:
+                attrib['visible'] = 'true' if value else 'false'
+
+    # ---------------------------------------------- #
+    # Element types
+    # ---------------------------------------------- #
+    def nodes(self, data):
+        node_id = lat = lon = 0
+        keys = values = ()
+        attrib = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                node_id = zigzag(value)
+            elif field == 2:
+                keys = decode_packed(value)
+            elif field == 3:
+                values = decode_packed(value)
+            elif field == 4:
+                self.info(attrib, value)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+
+        attrib['id']  = str(node_id)
+        attrib['lat'] = self.lat(lat)
+        attrib['lon'] = self.lon(lon)
+        elem = make_record('node', attrib)
+        add_tags(elem, keys, values, self.strings)
+        return [elem]
+
+    def dense_nodes(self, data):
+        ids = lats = lons = keys_vals = ()
+        info = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                ids = decode_packed_deltas(value)
+            elif field == 8:
+                lats = decode_packed_deltas(value)
+            elif field == 9:
+                lons = decode_packed_deltas(value)
+            elif field == 10:
+                keys_vals = decode_packed(value)
+            elif field == 5:
+                info = self.dense_info(value)
+
+        # The attributes are built a column at a time, then
+        # zipped into one dict per node. Metadata a node
+        # did not have is None and left out
+        names   = ['id', 'lat', 'lon'] + info.keys()
+        columns = [map(str, ids),
+                   format_coords(lats, self.lat_offset, self.granularity),
+                   format_coords(lons, self.lon_offset, self.granularity)] + info.values()
+        missing = any(None in column for column in info.itervalues())
+
+        strings = self.strings
+        nodes   = []
+        kv      = 0
+        for row in zip(*columns):
+            elem = ElementRecord()
+            elem.tag = 'node'
+            if missing:
+                elem.attrib = dict((name, value) for name, value in zip(names, row)
+                                   if value is not None)
+            else:
+                elem.attrib = dict(zip(names, row))
+
+            # keys_vals holds key, value pairs for each node,
+            # ending with a 0
+            while kv < len(keys_vals):
+                key = keys_vals[kv]
+                if key == 0:
+                    kv += 1
+                    break
+                elem.append(make_record('tag', {'k': strings[key], 'v': strings[keys_vals[kv + 1]]}))
+                kv += 2
+            nodes.append(elem)
+        return nodes
+
+    def dense_info(self, data):
+        """Decode DenseInfo into {attribute: column of strings}
+
+        Entries holding the DENSE_MISSING value of their column
+        are None.
+        """
+
+        columns = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                columns['version'] = [str(version) if version != -1 else None
+                                      for version in decode_packed_signed(value)]
+            elif field == 2:
+                columns['timestamp'] = [self.timestamp(stamp) if stamp else None
+                                        for stamp in decode_packed_deltas(value)]
+            elif field == 3:
+                columns['changeset'] = [str(changeset) if changeset else None
+                                        for changeset in decode_packed_deltas(value)]
+            elif field == 4:
+                columns['uid'] = [str(uid) if uid != -1 else None
+                                  for uid in decode_packed_deltas(value)]
+            elif field == 5:
+                strings = self.strings
+                columns['user'] = [strings[sid] if sid else None
+                                   for sid in decode_packed_deltas(value)]
+            elif field == 6:
+                columns['visible'] = ['true' if flag else 'false' for flag in decode_packed(value)]
+        return columns
+
+    def ways(self, data):
+        way_id = 0
+        keys = values = refs = ()
+        attrib = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                way_id = signed(value)
+            elif field == 2:
+                keys = decode_packed(value)
+            elif field == 3:
+                values = decode_packed(value)
+            elif field == 4:
+                self.info(attrib, value)
+            elif field == 8:
+                refs = decode_packed_deltas(value)
+
+        attrib['id'] = str(way_id)
+        elem = make_record('way', attrib)
+        for ref in refs:
+            elem.append(make_record('nd', {'ref': str(ref)}))
+        add_tags(elem, keys, values, self.strings)
+        return [elem]
+
+    def relations(self, data):
+        relation_id = 0
+        keys = values = roles = member_ids = types = ()
+        attrib = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                relation_id = signed(value)
+            elif field == 2:
+                keys = decode_packed(value)
+            elif field == 3:
+                values = decode_packed(value)
+            elif field == 4:
+                self.info(attrib, value)
+            elif field == 8:
+                roles = decode_packed_signed(value)
+            elif field == 9:
+                member_ids = decode_packed_deltas(value)
+            elif field == 10:
+                types = decode_packed(value)
+
+        attrib['id'] = str(relation_id)
+        elem = make_record('relation', attrib)
+        strings = self.strings
+        for role, member_id, member_type in zip(roles, member_ids, types):
+            elem.append(make_record('member', {'type': MEMBER_TYPES[member_type],
+                                               'ref':  str(member_id),
+                                               'role': strings[role]}))
+        add_tags(elem, keys, values, strings)
+        return [elem]
+
+    def elements(self, wanted=None):
+        """Decode the groups, skipping element types not in wanted"""
+
+        decoders = {1: ('node',     self.nodes),
+                    2: ('node',     self.dense_nodes),
+                    3: ('way',      self.ways),
+                    4: ('relation', self.relations)}
+        elements = []
+        for group in self.groups:
+            for field, value in iter_fields(group):
+                if field not in decoders:
+                    continue
+                tag, decode = decoders[field]
+                if wanted is None or tag in wanted:
+                    elements.extend(decode(value))
+        return elements
+
+
+# ================================================== #
+# Worker Function to decode one OSMData blob. Runs in
+# the pool, so it only takes picklable arguments
+# ================================================== #
+def decode_data_blob(job):
+    blob, wanted = job
+    return PrimitiveBlock(decompress_blob(blob)).elements(wanted)
+
+
+# ================================================== #
+# Function to stream the elements of a PBF file with
+# the same element view (and order) as the XML
+# parsers: tags=None yields every element, children
+# before their parent, then the osm root
+# ================================================== #
+def pbf_elements(pbf_path, tags=None, workers=None):
+
+    workers = WORKERS if workers is None else workers
+
+    # Only child tags asked for means every element
+    # type has to be decoded
+    if tags is None or set(tags) - TOP_LEVEL_TAGS:
+        wanted = None
+    else:
+        wanted = frozenset(tags)
+
+    blobs = read_blobs(pbf_path)
+    for blob_type, blob in blobs:
+        if blob_type == 'OSMHeader':
+            _, bbox = decode_header_block(decompress_blob(blob))
+            if bbox and (tags is None or 'bounds' in tags):
+                yield make_record('bounds', bbox)
+            break
+        if blob_type == 'OSMData':
+            raise ValueError("%s: OSMData blob before the OSMHeader" % pbf_path)
+
+    jobs = ((blob, wanted) for blob_type, blob in blobs if blob_type == 'OSMData')
+
+    if workers > 1:
+        decoded = pooled_decode(jobs, workers)
+    else:
+        decoded = (decode_data_blob(job) for job in jobs)
+
+    for elements in decoded:
+        for elem in elements:
+            if tags is None:
+                for child in elem:
+                    yield child
+                yield elem
+            else:
+                for child in elem:
+                    if child.tag in tags:
+                        yield child
+                if elem.tag in tags:
+                    yield elem
+
+    if tags is None or 'osm' in tags:
+        yield make_record('osm', {})
+
+
+# ================================================== #
+# Helper Function to decode blobs in a process pool,
+# returning their elements in file order
+# ================================================== #
+def pooled_decode(jobs, workers):
+
+    pool    = multiprocessing.Pool(workers)
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(decode_data_blob, (job,)))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# ================================================== #
+# Protobuf Encoding, for the fixture writer
+# ================================================== #
+def encode_varint(value):
+    if value < 0:
+        value += UINT64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def encode_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint_field(field, value):
+    return encode_varint(field << 3 | VARINT) + encode_varint(value)
+
+
+def bytes_field(field, data):
+    return encode_varint(field << 3 | LENGTH) + encode_varint(len(data)) + bytearray(data)
+
+
+def packed_field(field, values):
+    packed = bytearray()
+    for value in values:
+        packed += encode_varint(value)
+    return bytes_field(field, packed)
+
+
+def delta_encode(values):
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(encode_zigzag(value - previous))
+        previous = value
+    return deltas
+
+
+def parse_coord(text, granularity=100):
+    """Decimal degrees text to units of granularity nanodegrees, exactly"""
+
+    sign = -1 if text.startswith('-') else 1
+    whole, _, fraction = text.lstrip('+-').partition('.')
+    nanodegrees = int(whole or 0) * 1000000000 + int((fraction + '0' * 9)[:9])
+    return sign * int(round(float(nanodegrees) / granularity))
+
+
+def parse_timestamp(text):
+    return calendar.timegm(time.strptime(text, TIMESTAMP_FORMAT))
+
+
+def utf8(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+# ================================================== #
+# PBF Writer. Elements (anything with the element
+# view) are added in order and written out in blocks
+# of one element type, zlib compressed
+# ================================================== #
+class PBFWriter(object):
+    """Write elements to a PBF file
+
+    dense=False writes nodes as plain Node messages instead of
+    DenseNodes, and compress=False stores raw blobs, so every path
+    of the reader can be exercised.
+    """
+
+    def __init__(self, pbf_path, dense=True, compress=True, block_elements=BLOCK_ELEMENTS,
+                 granularity=100, bbox=None):
+        self.output         = open(pbf_path, 'wb')
+        self.dense          = dense
+        self.compress       = compress
+        self.block_elements = block_elements
+        self.granularity    = granularity
+        self.pending        = []
+        self.pending_tag    = None
+        self.write_header(bbox)
+
+    def write_blob(self, blob_type, data):
+        data = bytes(data)
+        if self.compress:
+            blob = varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+        else:
+            blob = bytes_field(1, data)
+        header = bytes_field(1, blob_type) + varint_field(3, len(blob))
+        self.output.write(struct.pack('>I', len(header)))
+        self.output.write(bytes(header))
+        self.output.write(bytes(blob))
+
+    def write_header(self, bbox):
+        header = bytearray()
+        if bbox:
+            box = bytearray()
+            for field, side in [(1, 'minlon'), (2, 'maxlon'), (3, 'maxlat'), (4, 'minlat')]:
+                box += varint_field(field, encode_zigzag(parse_coord(bbox[side], 1)))
+            header += bytes_field(1, box)
+        header += bytes_field(4, 'OsmSchema-V0.6')
+        if self.dense:
+            header += bytes_field(4, 'DenseNodes')
+        header += bytes_field(16, 'osm_pbf.py')
+        self.write_blob('OSMHeader', header)
+
+    def add(self, elem):
+        if elem.tag not in TOP_LEVEL_TAGS:
+            return
+        if elem.tag != self.pending_tag or len(self.pending) >= self.block_elements:
+            self.flush()
+            self.pending_tag = elem.tag
+        self.pending.append((elem.tag, dict(elem.attrib),
+                             [(child.tag, dict(child.attrib)) for child in elem]))
+
+    # ---------------------------------------------- #
+    # Encoding one block
+    # ---------------------------------------------- #
+    def flush(self):
+        if not self.pending:
+            return
+
+        strings = {'': 0}
+
+        def sid(text):
+            text = utf8(text)
+            if text not in strings:
+                strings[text] = len(strings)
+            return strings[text]
+
+        if self.pending_tag == 'node' and self.dense:
+            groups = [bytes_field(2, self.dense_nodes(sid))]
+        else:
+            encode = {'node': (1, self.node), 'way': (3, self.way), 'relation': (4, self.relation)}
+            field, encode_element = encode[self.pending_tag]
+            groups = [bytes_field(field, encode_element(elem, sid)) for elem in self.pending]
+
+        table = bytearray()
+        for text, _ in sorted(strings.items(), key=lambda item: item[1]):
+            table += bytes_field(1, text)
+
+        block = bytes_field(1, table) + bytes_field(2, b''.join(bytes(group) for group in groups))
+        if self.granularity != 100:
+            block += varint_field(17, self.granularity)
+        self.write_blob('OSMData', block)
+        self.pending = []
+
+    def info(self, attrib, sid):
+        info = bytearray()
+        if 'version' in attrib:
+            info += varint_field(1, int(attrib['version']))
+        if 'timestamp' in attrib:
+            info += varint_field(2, parse_timestamp(attrib['timestamp']))
+        if 'changeset' in attrib:
+            info += varint_field(3, int(attrib['changeset']))
+        if 'uid' in attrib:
+            info += varint_field(4, int(attrib['uid']))
+        if 'user' in attrib:
+            info += varint_field(5, sid(attrib['user']))
+        return bytes_field(4, info) if info else bytearray()
+
+    def tag_fields(self, children, sid):
+        tags = [(sid(attrib['k']), sid(attrib['v'])) for tag, attrib in children if tag == 'tag']
+        if not tags:
+            return bytearray()
+        return packed_field(2, [key for key, _ in tags]) + packed_field(3, [value for _, value in tags])
+
+    def node(self, elem, sid):
+        tag, attrib, children = elem
+        return (varint_field(1, encode_zigzag(int(attrib['id']))) +
+                self.tag_fields(children, sid) +
+                self.info(attrib, sid) +
+                varint_field(8, encode_zigzag(parse_coord(attrib['lat'], self.granularity))) +
+                varint_field(9, encode_zigzag(parse_coord(attrib['lon'], self.granularity))))
+
+    def dense_nodes(self, sid):
+        ids, lats, lons, keys_vals = [], [], [], []
+        for tag, attrib, children in self.pending:
+            ids.append(int(attrib['id']))
+            lats.append(parse_coord(attrib['lat'], self.granularity))
+            lons.append(parse_coord(attrib['lon'], self.granularity))
+            for child_tag, child in children:
+                if child_tag == 'tag':
+                    keys_vals.extend([sid(child['k']), sid(child['v'])])
+            keys_vals.append(0)
+
+        encoders = {'version':   int,
+                    'timestamp': parse_timestamp,
+                    'changeset': int,
+                    'uid':       int,
+                    'user':      sid}
+        info = bytearray()
+        for field, name in enumerate(DENSE_INFO_FIELDS, 1):
+            if not any(name in attrib for _, attrib, _ in self.pending):
+                continue
+            encode = encoders[name]
+            values = [encode(attrib[name]) if name in attrib else DENSE_MISSING[name]
+                      for _, attrib, _ in self.pending]
+            # Versions are the one column not delta coded
+            info += packed_field(field, values if name == 'version' else delta_encode(values))
+
+        dense = packed_field(1, delta_encode(ids))
+        if info:
+            dense += bytes_field(5, info)
+        dense += packed_field(8, delta_encode(lats)) + packed_field(9, delta_encode(lons))
+        if any(keys_vals):
+            dense += packed_field(10, keys_vals)
+        return dense
+
+    def way(self, elem, sid):
+        tag, attrib, children = elem
+        refs = [int(child['ref']) for child_tag, child in children if child_tag == 'nd']
+        return (varint_field(1, int(attrib['id'])) +
+                self.tag_fields(children, sid) +
+                self.info(attrib, sid) +
+                packed_field(8, delta_encode(refs)))
+
+    def relation(self, elem, sid):
+        tag, attrib, children = elem
+        members = [child for child_tag, child in children if child_tag == 'member']
+        return (varint_field(1, int(attrib['id'])) +
+                self.tag_fields(children, sid) +
+                self.info(attrib, sid) +
+                packed_field(8, [sid(member.get('role', '')) for member in members]) +
+                packed_field(9, delta_encode([int(member['ref']) for member in members])) +
+                packed_field(10, [MEMBER_TYPES.index(member['type']) for member in members]))
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ================================================== #
+# Function to convert an OSM XML file (or any file
+# get_element reads) to PBF
+# ================================================== #
+def xml_to_pbf(osm_file, pbf_path, **options):
+
+    import osm_parsers
+
+    count = 0
+    with PBFWriter(pbf_path, **options) as writer:
+        for elem in osm_parsers.iter_elements(osm_file, ('node', 'way', 'relation')):
+            writer.add(elem)
+            count += 1
+    return count
+
+
+# ================================================== #
+# Function to stream the elements of a fixture: the
+# elements of an OSM file with every bare_every-th
+# node stripped of its metadata, so dense blocks mix
+# nodes with and without it
+# ================================================== #
+def fixture_elements(osm_file, bare_every=FIXTURE_BARE_EVERY):
+
+    import osm_parsers
+
+    nodes = 0
+    for elem in osm_parsers.iter_elements(osm_file, ('node', 'way', 'relation')):
+        if elem.tag == 'node':
+            nodes += 1
+            if bare_every and nodes % bare_every == 0:
+                for name in DENSE_INFO_FIELDS:
+                    elem.attrib.pop(name, None)
+        yield elem
+
+
+# ================================================== #
+# Function to write a small PBF fixture from a
+# synthetic OSM file, so the reader can be tested
+# without downloading an extract
+# ================================================== #
+def write_fixture(pbf_path, scale=0.02, seed=None, bare_every=FIXTURE_BARE_EVERY, **options):
+
+    import tempfile
+    import synth_osm
+
+    handle, xml_path = tempfile.mkstemp(suffix=".osm")
+    os.close(handle)
+    try:
+        synth_osm.write_synthetic_osm(xml_path, scale, synth_osm.SEED if seed is None else seed)
+        count = 0
+        with PBFWriter(pbf_path, **options) as writer:
+            for elem in fixture_elements(xml_path, bare_every):
+                writer.add(elem)
+                count += 1
+        return count
+    finally:
+        os.remove(xml_path)
+
+
+# ================================================== #
+# Main(): osm_pbf.py [input.osm] output.osm.pbf
+# ================================================== #
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print "%d elements written" % xml_to_pbf(sys.argv[1], sys.argv[2])
+    else:
+        out_path = sys.argv[1] if len(sys.argv) > 1 else "fixture.osm.pbf"
+        print "%d elements written to %s" % (write_fixture(out_path), out_path)
@@ -1,22 +1,33 @@
 
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+
 import seaborn           as sns
 import pandas            as pd
-import sqlite3
+import osm_db
+from query_runner import QueryRunner
+
+DB_PATH = osm_db.DB_PATH
+
+# The figures embedded in README.md
+AMENITY_FIGURE = "figure_2.png"
+PEAKS_FIGURE   = "figure_1.png"
+
+runner = QueryRunner(DB_PATH)
 
-db = sqlite3.connect('/Users/aehsaei/Desktop/DataAnalyst/Project3/denver_osm.db')
-cursor = db.cursor()
+# Top 10 amenities in Denver/Boulder, read from the tag_stats
+# summary table built at load time
+runner.add_query('amenity_stats_top10', osm_db.TOP_TAG_VALUES_SQL)
 
-# SQL command to find the top 10 amenities in Denver/Boulder
-cursor.execute('''SELECT tags.value, COUNT(*) as count
-                  FROM (SELECT * FROM node_tags
-                        UNION ALL
-                        SELECT * FROM way_tags) tags
-                  WHERE tags.key='amenity'
-                  GROUP BY tags.value
-                  ORDER BY count DESC LIMIT 10''')
+# Run every query for both figures in one batch; results come
+# from the cache until the database changes
+results = runner.run_batch([('amenity_stats_top10', ('amenity', 10)),
+                            'peak_ele_top10',
+                            'peak_name_top10'])
 
-db.commit()
-natural_df = pd.DataFrame(cursor.fetchall())
+natural_df = results['amenity_stats_top10']
 
 # Create the labels for the dataframe
 natural_df.columns = ['Amenity', 'Amount']
@@ -27,25 +38,29 @@ natural_df.drop(natural_df.head(1).index, inplace=True)
 
 sns.set_style("whitegrid")
 ax = sns.barplot(x="Amenity", y="Amount", data=natural_df)
-sns.plt.show()
-
-
-# Now plot the mountain peak data (not using direct SQL, this required a few SQL commands)
-data = [{'Mountain Peak': 'Longs',         'Elevation (Meters)': 4340},
-        {'Mountain Peak': 'Evans',         'Elevation (Meters)': 4335},
-        {'Mountain Peak': 'Bierstadt',     'Elevation (Meters)': 4282},
-        {'Mountain Peak': 'Meeker',        'Elevation (Meters)': 4227},
-        {'Mountain Peak': 'Spalding',      'Elevation (Meters)': 4222},
-        {'Mountain Peak': 'Gray Wolf',     'Elevation (Meters)': 4148},
-        {'Mountain Peak': 'Rosalie',       'Elevation (Meters)': 4138},
-        {'Mountain Peak': 'Epaulet',       'Elevation (Meters)': 4126},
-        {'Mountain Peak': 'Chiefs Head',   'Elevation (Meters)': 4121},
-        {'Mountain Peak': 'North Arapaho', 'Elevation (Meters)': 4100}]
-
-mountains_df = pd.DataFrame(data)
+ax.get_figure().savefig(AMENITY_FIGURE)
+plt.clf()
+
+
+# Now plot the mountain peak data, joining the ten highest peak
+# elevations to their names
+elevations = results['peak_ele_top10']
+elevations.columns = ['id', 'Elevation (Meters)']
+elevations['Elevation (Meters)'] = pd.to_numeric(elevations['Elevation (Meters)'], errors='coerce')
+
+names = results['peak_name_top10']
+names.columns = ['id', 'Mountain Peak']
+
+mountains_df = (elevations.merge(names, on='id')
+                          .sort_values('Elevation (Meters)', ascending=False)
+                          [['Mountain Peak', 'Elevation (Meters)']])
 print "\n\n"
 print mountains_df
 sns.set_style("whitegrid")
 ax = sns.barplot(x="Mountain Peak", y="Elevation (Meters)", data=mountains_df)
-sns.plt.ylim(4050, 4350)
-sns.plt.show()
\ No newline at end of file
+low, high = mountains_df['Elevation (Meters)'].min(), mountains_df['Elevation (Meters)'].max()
+plt.ylim(low - 50, high + 10)
+ax.get_figure().savefig(PEAKS_FIGURE)
+plt.clf()
+
+print runner.cache_info()
@@ -0,0 +1,173 @@
+####################################################################
+# File: query_runner.py
+#
+# Description: This code runs named report queries against the
+# OSM database and returns each result as a pandas DataFrame.
+# Results are cached on disk, keyed by the query text and a
+# fingerprint of the database file, so re-running a report only
+# goes back to SQLite once the database has changed. Entries for
+# an older state of the database are pruned when it changes.
+####################################################################
+
+import hashlib
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+
+import pandas as pd
+
+import osm_db
+
+# ================================================== #
+# Cache Directory
+# ================================================== #
+CACHE_DIR = "query_cache"
+
+# ================================================== #
+# Regex forms
+# ================================================== #
+query_name_re = re.compile(r'^--\s*name:\s*(\w+)\s*$', re.MULTILINE)
+
+
+# ================================================== #
+# Function to load named queries. With no path these
+# are the queries.sql queries kept in osm_db; a plain
+# .sql file can name its queries with a line such as
+#   -- name: postcode_top5
+# in front of each one
+# ================================================== #
+def load_queries(path=None):
+
+    if path is None:
+        return OrderedDict(osm_db.QUERIES)
+
+    with open(path) as sql_file:
+        text = sql_file.read()
+
+    queries = OrderedDict()
+    parts = query_name_re.split(text)
+    for name, sql in zip(parts[1::2], parts[2::2]):
+        sql = sql.strip().rstrip(';').strip()
+        if sql:
+            queries[name] = sql
+    return queries
+
+
+# ================================================== #
+# Helper Function to fingerprint a database file by
+# its path, size and modification time. Cache file
+# names start with a hash of the path and one of the
+# size and time, so the entries for an older state
+# of the same file can be found and removed
+# ================================================== #
+def db_fingerprint(db_path):
+    stat = os.stat(db_path)
+    return "%s-%s" % (short_hash(os.path.abspath(db_path)),
+                      short_hash("%d:%r" % (stat.st_size, stat.st_mtime)))
+
+
+def short_hash(text):
+    return hashlib.sha1(text).hexdigest()[:16]
+
+
+# ================================================== #
+# Runner for named queries with a DataFrame cache
+# ================================================== #
+class QueryRunner(object):
+    """Run named queries against db_path, caching the DataFrames"""
+
+    def __init__(self, db_path=osm_db.DB_PATH, queries=None, cache_dir=CACHE_DIR):
+        self.db_path   = db_path
+        self.queries   = load_queries() if queries is None else OrderedDict(queries)
+        self.cache_dir = cache_dir
+        self.memory    = {}
+        self.hits      = 0
+        self.misses    = 0
+        self.pruned    = 0
+
+        # Fingerprint the memory and disk caches hold
+        # results for
+        self.fingerprint = None
+
+    def add_query(self, name, sql):
+        self.queries[name] = sql
+
+    def cache_key(self, sql, params, fingerprint):
+        return "%s-%s" % (fingerprint, hashlib.sha1("\0".join([sql, repr(tuple(params))])).hexdigest())
+
+    def run(self, name, params=()):
+        """Return the result of a named query (or raw SQL) as a DataFrame"""
+
+        sql         = self.queries.get(name, name)
+        fingerprint = db_fingerprint(self.db_path)
+        if fingerprint != self.fingerprint:
+            self.memory.clear()
+            self.prune_cache(fingerprint)
+            self.fingerprint = fingerprint
+        key = self.cache_key(sql, params, fingerprint)
+
+        if key in self.memory:
+            self.hits += 1
+            return self.memory[key].copy()
+
+        cache_path = self.cache_dir and os.path.join(self.cache_dir, key + ".pkl")
+        if cache_path and os.path.exists(cache_path):
+            self.hits += 1
+            df = pd.read_pickle(cache_path)
+        else:
+            self.misses += 1
+            df = self.execute(sql, params)
+            if cache_path:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                df.to_pickle(cache_path)
+
+        self.memory[key] = df
+        return df.copy()
+
+    def run_batch(self, names):
+        """Run several queries (names, or (name, params) pairs) by name"""
+
+        results = OrderedDict()
+        for name in names:
+            if isinstance(name, tuple):
+                name, params = name
+            else:
+                params = ()
+            results[name] = self.run(name, params)
+        return results
+
+    def execute(self, sql, params=()):
+        db = sqlite3.connect(self.db_path)
+        try:
+            cursor = db.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+        finally:
+            db.close()
+
+    def prune_cache(self, fingerprint):
+        """Remove cached results of this database taken before it last changed"""
+
+        if not (self.cache_dir and os.path.isdir(self.cache_dir)):
+            return
+        db_prefix = fingerprint.split("-")[0] + "-"
+        for file_name in os.listdir(self.cache_dir):
+            if (file_name.endswith(".pkl") and file_name.startswith(db_prefix)
+                    and not file_name.startswith(fingerprint + "-")):
+                os.remove(os.path.join(self.cache_dir, file_name))
+                self.pruned += 1
+
+    def clear_cache(self):
+        self.memory.clear()
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(".pkl"):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+    def cache_info(self):
+        return {'hits':   self.hits,
+                'misses': self.misses,
+                'pruned': self.pruned,
+                'size':   len(self.memory)}
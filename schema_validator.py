@@ -0,0 +1,272 @@
+####################################################################
+# File: schema_validator.py
+#
+# Description: This code turns the Cerberus style `schema` from
+# schema.py into one generated Python function per table. Each
+# function checks a whole batch of shaped records at once: values
+# are coerced column by column with map(), so a clean batch never
+# runs a Python level loop per value, and only a column that fails
+# is scanned row by row to find the bad elements.
+####################################################################
+
+from collections import namedtuple
+
+from schema import schema as SCHEMA
+
+# ================================================== #
+# A value that failed validation, with the id of the
+# element it came from
+# ================================================== #
+ValidationFailure = namedtuple('ValidationFailure', ['table', 'id', 'field', 'value', 'error'])
+
+STRING_TYPES = frozenset([str, unicode])
+
+TYPE_CHECKS = {'integer': frozenset([int, long]),
+               'float':   frozenset([float]),
+               'string':  STRING_TYPES}
+
+SUPPORTED_RULES = frozenset(['required', 'type', 'coerce'])
+
+# Rows validated per batch by ValidatingWriter
+VALIDATE_BATCH = 10000
+
+
+# ================================================== #
+# Helper Function to find the field rules of a table.
+# Row tables are 'dict' schemas, tag and way node
+# tables are 'list' schemas of dicts
+# ================================================== #
+def table_fields(table_schema):
+    if table_schema['type'] == 'list':
+        table_schema = table_schema['schema']
+    return table_schema['schema']
+
+
+# ================================================== #
+# Helper Function to check a single value against a
+# field's rules. Returns the coerced value and an
+# error message, or None when the value is valid
+# ================================================== #
+def check_value(value, rules):
+
+    if value is None:
+        if rules.get('required'):
+            return value, "required field"
+        return value, None
+
+    coerce = rules.get('coerce')
+    if coerce is not None:
+        try:
+            value = coerce(value)
+        except (TypeError, ValueError):
+            return value, "cannot coerce to %s" % rules['type']
+
+    if 'type' in rules and type(value) not in TYPE_CHECKS[rules['type']]:
+        return value, "must be of %s type" % rules['type']
+    return value, None
+
+
+# ================================================== #
+# Helper Function for the common case of an integer
+# column of plain digit strings, which is checked in
+# one pass over the joined text instead of int() per
+# value
+# ================================================== #
+def all_digits(values):
+    try:
+        joined = "".join(values)
+    except TypeError:
+        return False
+    return type(joined) is str and joined.isdigit() and "" not in values
+
+
+# ================================================== #
+# Function to scan one column row by row, used once a
+# batch check has found a problem in it
+# ================================================== #
+def scan_column(table, field, index, rules, rows, failures):
+
+    bad = set()
+    for row_number, row in enumerate(rows):
+        value, error = check_value(row[index], rules)
+        if error:
+            failures.append(ValidationFailure(table, row[0], field, row[index], error))
+            bad.add(row_number)
+    return bad
+
+
+# ================================================== #
+# Source code generation. For each field the batch is
+# checked with C level operations (a None membership
+# test, map() of the coerce function and a set of the
+# value types); anything unexpected falls back to
+# scan_column for that field only
+# ================================================== #
+FUNCTION_TEMPLATE = """
+def validate_%(table)s(rows, failures, coerce=False):
+    if not rows:
+        return []
+    columns = zip(*rows)
+    bad = set()
+%(fields)s
+    if not coerce:
+        return rows
+    if bad:
+        return [coerce_row(row) for row_number, row in enumerate(rows)
+                if row_number not in bad]
+    return zip(%(columns)s)
+"""
+
+FIELD_TEMPLATE = """
+    # %(field)s: %(rules)r
+    values = columns[%(index)d]
+    try:
+        if %(required_check)s:
+            raise ValueError
+        %(coerce)s
+        if %(type_check)s:
+            raise ValueError
+    except (TypeError, ValueError):
+        bad |= scan_column(%(table)r, %(field)r, %(index)d, RULES[%(field)r], rows, failures)
+    column_%(index)d = values
+"""
+
+
+def generate_source(table, fields, rules_by_field):
+
+    parts = []
+    for index, field in enumerate(fields):
+        rules = rules_by_field.get(field)
+        if rules is None:
+            raise ValueError("%s.%s is not in the schema" % (table, field))
+        unknown = set(rules) - SUPPORTED_RULES
+        if unknown:
+            raise ValueError("%s.%s uses unsupported rules: %s" % (table, field, ", ".join(sorted(unknown))))
+
+        # Without 'required' a None is allowed, so the
+        # coerce and type checks only see the other values
+        if rules.get('required'):
+            required_check = "None in values"
+            present = "values"
+        else:
+            required_check = "False"
+            present = "[value for value in values if value is not None]"
+
+        if 'coerce' not in rules:
+            coerce = "pass"
+        elif rules.get('required') and rules['coerce'] is int and rules.get('type') == 'integer':
+            coerce = ("if coerce or not all_digits(values):\n"
+                      "            values = map(COERCE[%r], values)\n"
+                      "            if not set(map(type, values)) <= TYPES[%r]:\n"
+                      "                raise ValueError" % (field, field))
+        elif rules.get('required'):
+            coerce = "values = map(COERCE[%r], values)" % field
+        else:
+            coerce = ("values = [value if value is None else COERCE[%r](value) for value in values]"
+                      % field)
+
+        if 'type' in rules and coerce.startswith("if coerce"):
+            type_check = "False"
+        elif 'type' in rules:
+            type_check = "not set(map(type, %s)) <= TYPES[%r]" % (present, field)
+        else:
+            type_check = "False"
+
+        parts.append(FIELD_TEMPLATE % {'table':          table,
+                                       'field':          field,
+                                       'rules':          dict((k, getattr(v, '__name__', v))
+                                                              for k, v in rules.items()),
+                                       'index':          index,
+                                       'required_check': required_check,
+                                       'coerce':         coerce,
+                                       'type_check':     type_check})
+
+    return FUNCTION_TEMPLATE % {'table':   table,
+                                'fields':  "".join(parts),
+                                'columns': ", ".join("column_%d" % i for i in range(len(fields)))}
+
+
+# ================================================== #
+# Function to compile the validator for one table.
+# Rows are sequences in the order of fields
+# ================================================== #
+def compile_table_validator(table, fields, table_schema):
+
+    rules_by_field = table_fields(table_schema)
+    source = generate_source(table, fields, rules_by_field)
+
+    def coerce_row(row):
+        return tuple(check_value(value, rules_by_field[field])[0]
+                     for field, value in zip(fields, row))
+
+    namespace = {'RULES':       rules_by_field,
+                 'COERCE':      dict((field, rules['coerce']) for field, rules in rules_by_field.items()
+                                     if 'coerce' in rules),
+                 'TYPES':       dict((field, TYPE_CHECKS[rules['type']])
+                                     for field, rules in rules_by_field.items() if 'type' in rules),
+                 'scan_column': scan_column,
+                 'all_digits':  all_digits,
+                 'coerce_row':  coerce_row}
+    exec compile(source, "<validate_%s>" % table, 'exec') in namespace
+
+    function = namespace['validate_%s' % table]
+    function.source = source
+    return function
+
+
+# ================================================== #
+# Validators for every table of the schema
+# ================================================== #
+class SchemaValidator(object):
+    """Per-table batch validators generated from a schema"""
+
+    def __init__(self, table_fields, schema=SCHEMA):
+        self.validators = dict((table, compile_table_validator(table, fields, schema[table]))
+                               for table, fields in table_fields)
+
+    def validate(self, table, rows, failures, coerce=False):
+        """Check rows, appending a ValidationFailure for each bad value
+
+        With coerce the valid rows come back as coerced tuples,
+        otherwise rows is returned as it was.
+        """
+        return self.validators[table](rows, failures, coerce)
+
+
+# ================================================== #
+# Writer with the same interface as the csv writers
+# used by process_map, validating rows a batch at a
+# time before passing them on unchanged
+# ================================================== #
+class ValidatingWriter(object):
+
+    def __init__(self, writer, table, validator, failures, batch_size=VALIDATE_BATCH):
+        self.writer     = writer
+        self.table      = table
+        self.validate   = validator.validators[table]
+        self.failures   = failures
+        self.batch_size = batch_size
+        self.rows       = []
+
+    def writeheader(self):
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.check()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.check()
+
+    def check(self):
+        if self.rows:
+            self.validate(self.rows, self.failures)
+            self.writer.writerows(self.rows)
+            self.rows = []
+
+    def flush(self):
+        self.check()
+        self.writer.flush()
@@ -0,0 +1,159 @@
+####################################################################
+# File: stage_profiler.py
+#
+# Description: This code profiles a process_map run stage by
+# stage. process_map sets clean_osm_data.PROFILER to a
+# StageProfiler for the run, and write_elements reports the time
+# of each stage (parsing, shaping, tag cleaning, writing) to it.
+# With PROFILER unset the hooks cost one check each. The report
+# is written out as JSON.
+####################################################################
+
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+
+# ================================================== #
+# Report File
+# ================================================== #
+PROFILE_PATH = "process_map_profile.json"
+
+# Take a throughput and memory sample every this
+# many elements
+SAMPLE_EVERY = 10000
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+# ================================================== #
+# Helper Function to read the current resident set
+# size in MB. Falls back to the peak where /proc is
+# not available
+# ================================================== #
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE / 1e6
+    except (IOError, OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+# ================================================== #
+# Profiler for one process_map run
+# ================================================== #
+class StageProfiler(object):
+    """Collect the stage times clean_osm_data.write_elements reports
+
+    Each lap() charges the time since the previous one to its
+    stage, so every second of the loop is counted once: parse
+    (reading the next element), shape_node and shape_way, write,
+    and tag cleaning. Tag cleaning is split into one rule:<type>:<key>
+    stage per cleaning rule and clean_tags for the rest of
+    TagCleaner.clean.
+    """
+
+    def __init__(self, report_path=PROFILE_PATH, sample_every=SAMPLE_EVERY):
+        self.report_path  = report_path
+        self.sample_every = sample_every
+        self.seconds      = defaultdict(float)
+        self.calls        = defaultdict(int)
+        self.elements     = defaultdict(int)
+        self.rows         = defaultdict(int)
+        self.parsed       = 0
+        self.samples      = []
+        self.tick         = time.time()
+
+    # ---------------------------------------------- #
+    # Hooks called from write_elements, shape_node,
+    # shape_way and TagCleaner
+    # ---------------------------------------------- #
+    def mark(self):
+        self.tick = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.seconds[stage] += now - self.tick
+        self.calls[stage]   += 1
+        self.tick = now
+
+    def written(self, tag, shaped):
+        self.elements[tag] += 1
+        rows = self.rows
+        if tag == 'node':
+            rows['nodes']     += 1
+            rows['node_tags'] += len(shaped['node_tags'])
+        else:
+            rows['ways']      += 1
+            rows['way_nodes'] += len(shaped['way_nodes'])
+            rows['way_tags']  += len(shaped['way_tags'])
+
+        self.parsed += 1
+        if self.parsed % self.sample_every == 0:
+            self.take_sample()
+
+    def start(self):
+        self.lap_seconds = self.measure_lap()
+        self.started     = time.time()
+        self.take_sample()
+
+    def stop(self):
+        self.finished = time.time()
+        self.take_sample()
+
+    # Cost of one lap() call, for the overhead estimate
+    # in the report
+    def measure_lap(self, laps=10000):
+        scratch = StageProfiler(self.report_path)
+        start   = time.time()
+        for _ in xrange(laps):
+            scratch.lap('lap')
+        return (time.time() - start) / laps
+
+    # ---------------------------------------------- #
+    # Samples and the report
+    # ---------------------------------------------- #
+    def take_sample(self):
+        now      = time.time()
+        elements = self.parsed
+        if self.samples:
+            last = self.samples[-1]
+            rate = (elements - last['elements']) / max(now - self.started - last['seconds'], 1e-9)
+        else:
+            rate = 0.0
+        self.samples.append({'seconds':          now - self.started,
+                             'elements':         elements,
+                             'elements_per_sec': rate,
+                             'rss_mb':           current_rss_mb()})
+
+    def report(self):
+        total = max(self.finished - self.started, 1e-9)
+        elements = sum(self.elements.values())
+        return {'total_seconds':         total,
+                'elements':              dict(self.elements),
+                'elements_per_sec':      elements / total,
+                'rows':                  dict(self.rows),
+                'stages':                dict((stage, {'seconds': self.seconds[stage],
+                                                       'calls':   self.calls[stage],
+                                                       'share':   self.seconds[stage] / total})
+                                              for stage in self.seconds),
+                'hook_overhead_seconds': self.lap_seconds * sum(self.calls.values()),
+                'samples':               self.samples,
+                'peak_rss_mb':           max(sample['rss_mb'] for sample in self.samples)}
+
+    def write_report(self):
+        report = self.report()
+        with open(self.report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        return report
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        self.write_report()
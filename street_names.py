@@ -0,0 +1,121 @@
+####################################################################
+# File: street_names.py
+#
+# Description: This code holds the street type mapping and the
+# street name fixes shared by the audit and the clean scripts.
+####################################################################
+
+# ================================================== #
+# Mapping for correcting street type names
+# ================================================== #
+MAPPING = {"St":      "Street",
+           "Strret":  "Street",
+           "Street ": "Street",
+           "st":      "Street",
+           "ST.":     "Street",
+           "Ave":     "Avenue",
+           "ave.":    "Avenue",
+           "Ave.":    "Avenue",
+           "Av":      "Avenue",
+           "avenue":  "Avenue",
+           "Rd.":     "Road",
+           "Rd":      "Road",
+           "rd":      "Road",
+           "Raod":    "Road",
+           "Pkwy":    "Parkway",
+           "Pky":     "Parkway",
+           "ct":      "Court",
+           "Dr":      "Drive",
+           "dr":      "Drive",
+           "trail":   "Trail",
+           "Pl":      "Place",
+           "Ct":      "Court",
+           "Blvd":    "Boulevard",
+           "ste.":    "Suite",
+           "Ste":     "Suite",
+           "ste":     "Suite"}
+
+# Words after which a mapped abbreviation is left alone
+APARTMENT_WORDS = frozenset(['apartment', 'apt', 'building', 'suite', 'ste.', 'ste'])
+
+# Number of street names kept by the normalizer cache
+STREET_CACHE_SIZE = 4096
+
+
+# ================================================== #
+# Helper Function to update a bad street name based
+# on a defined mapping
+# ================================================== #
+def fix_street_name(address, mapping):
+    words = address.split()
+    for w in range(len(words)):
+        if words[w] in mapping:
+            # Don't update 'Apartment E' to 'Apartment East'
+            if words[w-1].lower() in [ 'apartment', 'apt', 'building', 'suite', 'ste.', 'ste']:
+                continue
+            else:
+                words[w] = mapping[words[w]]
+                address = " ".join(words)
+    return address
+
+
+# ================================================== #
+# Street name normalizer built once from a mapping.
+# Street names repeat heavily, so results are kept in
+# a bounded cache of two generations: names used in
+# the current generation survive the next rollover,
+# names unused for a whole generation are dropped
+# ================================================== #
+class StreetNameNormalizer(object):
+    """Fix street names like fix_street_name, caching recent results"""
+
+    def __init__(self, mapping, cache_size=STREET_CACHE_SIZE):
+        self.mapping         = dict(mapping)
+        self.generation_size = max(1, cache_size // 2)
+        self.recent          = {}
+        self.older           = {}
+        self.hits            = 0
+        self.misses          = 0
+
+    def __call__(self, address):
+        try:
+            result = self.recent[address]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        if address in self.older:
+            self.hits += 1
+            result = self.older.pop(address)
+        else:
+            self.misses += 1
+            result = self.normalize(address)
+
+        recent = self.recent
+        if len(recent) >= self.generation_size:
+            self.older  = recent
+            self.recent = recent = {}
+        recent[address] = result
+        return result
+
+    def normalize(self, address):
+        mapping = self.mapping
+        words   = address.split()
+        changed = False
+        for w, word in enumerate(words):
+            if word in mapping:
+                # Don't update 'Apartment E' to 'Apartment East'
+                if words[w-1].lower() in APARTMENT_WORDS:
+                    continue
+                words[w] = mapping[word]
+                changed  = True
+        if changed:
+            return " ".join(words)
+        return address
+
+    def cache_info(self):
+        return {'hits':   self.hits,
+                'misses': self.misses,
+                'size':   len(self.recent) + len(self.older)}
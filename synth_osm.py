@@ -0,0 +1,383 @@
+####################################################################
+# File: synth_osm.py
+#
+# Description: This code writes a synthetic OSM XML file that
+# looks like the Denver/Boulder extract: TIGER tagged roads, messy
+# postcodes, abbreviated street names, peaks, amenities and a
+# Zipf-like set of users. The output only depends on the scale
+# factor and the seed, so the same file can be regenerated at any
+# size for benchmarking. Scale 1 is about 10 MB.
+####################################################################
+
+import bisect
+import random
+import sys
+from xml.sax.saxutils import escape
+
+from street_names import MAPPING
+
+# ================================================== #
+# Output File and Size
+# ================================================== #
+SYNTH_FILE = "synthetic.osm"
+SCALE      = 1.0
+SEED       = 2016
+
+# Elements written per unit of scale
+NODES_PER_SCALE     = 50000
+WAYS_PER_SCALE      = 5500
+RELATIONS_PER_SCALE = 120
+
+FIRST_NODE_ID     = 25000000
+FIRST_WAY_ID      = 4000000
+FIRST_RELATION_ID = 10000
+
+# Denver/Boulder area
+MIN_LAT, MAX_LAT = 39.50, 40.30
+MIN_LON, MAX_LON = -105.60, -104.60
+
+# Elements are buffered and written this many at a time
+WRITE_BATCH = 2000
+
+ATTR_ESCAPES = {'"': "&quot;"}
+
+# ================================================== #
+# Tag Distributions, as (value, weight) pairs
+# ================================================== #
+STREET_NAMES = ["Colfax", "Broadway", "Federal", "Alameda", "Wadsworth", "Colorado",
+                "Main", "Pearl", "Walnut", "Arapahoe", "Baseline", "Canyon",
+                "Welton", "California", "Decatur", "Sheridan", "Kipling", "Evans",
+                "Yale", "Hampden", "Quebec", "Monaco", "Holly", "Downing",
+                "38th", "35th", "17th", "29th", "6th", "1st", "Table Mesa", "Cherry Creek"]
+
+FULL_STREET_TYPES = [("Street", 40), ("Avenue", 30), ("Road", 10), ("Drive", 10),
+                     ("Court", 4), ("Place", 4), ("Boulevard", 3), ("Parkway", 2),
+                     ("Way", 3), ("Lane", 3), ("Circle", 2), ("Trail", 1)]
+
+# The abbreviations street_names.MAPPING expands
+ABBREVIATED_STREET_TYPES = [(abbreviation, 1) for abbreviation in sorted(MAPPING)]
+
+DIRECTIONS = [("", 70), ("West", 8), ("East", 8), ("North", 5), ("South", 5),
+              ("W", 1), ("E", 1), ("N", 1), ("S", 1)]
+
+ZIP_CODES = ["80202", "80203", "80204", "80205", "80206", "80210", "80211", "80212",
+             "80214", "80218", "80220", "80226", "80301", "80302", "80303", "80304",
+             "80401", "80403", "80501", "80503", "80516", "80525"]
+
+# Postcode formats; the later ones are the kinds
+# fix_postcode_tag cleans or reports as invalid
+POSTCODE_FORMATS = [("%s", 80), ("%s-1234", 6), ("CO %s", 4), ("CO%s", 3),
+                    ("Golden, CO %s", 2), (" %s ", 3), ("%.4s", 1), ("8%.3s", 1)]
+
+TIGER_COUNTIES = [("Denver, CO", 40), ("Boulder, CO", 25), ("Jefferson, CO", 20),
+                  ("Adams, CO", 8), ("Arapahoe, CO", 6), ("Broomfield, CO", 1)]
+
+TIGER_TYPES = [("St", 40), ("Ave", 30), ("Rd", 10), ("Dr", 10), ("Ct", 4),
+               ("Pl", 4), ("Blvd", 3), ("Pkwy", 2), ("Ln", 3), ("Cir", 2)]
+
+HIGHWAYS = [("residential", 45), ("service", 20), ("footway", 8), ("track", 5),
+            ("tertiary", 6), ("secondary", 5), ("primary", 4), ("path", 4),
+            ("motorway_link", 2), ("unclassified", 1)]
+
+NODE_HIGHWAYS = [("crossing", 40), ("traffic_signals", 25), ("stop", 20),
+                 ("turning_circle", 10), ("motorway_junction", 5)]
+
+AMENITIES = [("parking", 35), ("school", 4), ("restaurant", 4), ("fuel", 3),
+             ("cafe", 3), ("fast_food", 3), ("fire_station", 2), ("bench", 4),
+             ("place_of_worship", 4), ("bank", 2), ("post_office", 1),
+             ("shelter", 1), ("recycling", 1), ("toilets", 1), ("library", 1)]
+
+RELIGIONS = [("christian", 85), ("jewish", 6), ("buddhist", 3), ("muslim", 3),
+             ("unitarian_universalist", 3)]
+
+NATURAL = [("tree", 50), ("peak", 25), ("spring", 10), ("saddle", 8), ("cliff", 7)]
+
+PEAK_NAMES = ["Longs", "Evans", "Bierstadt", "Meeker", "Spalding", "Gray Wolf",
+              "Rosalie", "Epaulet", "Chiefs Head", "North Arapaho", "Green",
+              "Bear", "South Boulder", "Flagstaff", "Sugarloaf", "Emancipation"]
+
+PLACE_NAMES = [u"Pearl Street Caf\xe9", u"Bar & Grill", u"Sunflower Market",
+               u"Mile High Diner", u"Crest Caf\xe9", u"Cherry Creek Books",
+               u"Rocky Mountain Bank", u"Flatirons School"]
+
+SURFACES = [("asphalt", 60), ("unpaved", 15), ("gravel", 10), ("paved", 8),
+            ("concrete", 5), ("dirt", 2)]
+
+LANDUSE = [("residential", 40), ("grass", 20), ("forest", 15), ("meadow", 10),
+           ("commercial", 8), ("industrial", 7)]
+
+USER_COUNT = 400
+
+
+# ================================================== #
+# Helper class to pick from (value, weight) pairs
+# ================================================== #
+class WeightedChoice(object):
+
+    def __init__(self, pairs):
+        self.values = [value for value, _ in pairs]
+        self.cumulative = []
+        total = 0
+        for _, weight in pairs:
+            total += weight
+            self.cumulative.append(total)
+        self.total = float(total)
+
+    def pick(self, rng):
+        return self.values[bisect.bisect_right(self.cumulative, rng.random() * self.total)]
+
+
+# ================================================== #
+# Generator for one synthetic OSM file. Nodes come in
+# short random walks so a way over consecutive nodes
+# looks like a street
+# ================================================== #
+class SyntheticOSM(object):
+    """Write a deterministic synthetic OSM file"""
+
+    def __init__(self, scale=SCALE, seed=SEED):
+        self.rng            = random.Random(seed)
+        self.node_count     = max(10, int(NODES_PER_SCALE * scale))
+        self.way_count      = max(1, int(WAYS_PER_SCALE * scale))
+        self.relation_count = max(1, int(RELATIONS_PER_SCALE * scale))
+
+        self.users = [("mapper_%d" % i, 10000 + i * 37) for i in range(USER_COUNT - 3)]
+        self.users += [("GPS_dr", 117055), ("woodpeck_fixbot", 147510), (u"J\xfcrgen", 98765)]
+        self.user_choice = WeightedChoice([(user, 1.0 / (rank + 1))
+                                           for rank, user in enumerate(self.users)])
+
+        self.full_types       = WeightedChoice(FULL_STREET_TYPES)
+        self.abbreviated      = WeightedChoice(ABBREVIATED_STREET_TYPES)
+        self.directions       = WeightedChoice(DIRECTIONS)
+        self.postcode_formats = WeightedChoice(POSTCODE_FORMATS)
+        self.counties         = WeightedChoice(TIGER_COUNTIES)
+        self.tiger_types      = WeightedChoice(TIGER_TYPES)
+        self.highways         = WeightedChoice(HIGHWAYS)
+        self.node_highways    = WeightedChoice(NODE_HIGHWAYS)
+        self.amenities        = WeightedChoice(AMENITIES)
+        self.religions        = WeightedChoice(RELIGIONS)
+        self.natural          = WeightedChoice(NATURAL)
+        self.surfaces         = WeightedChoice(SURFACES)
+        self.landuse          = WeightedChoice(LANDUSE)
+
+        self.counts = {'node': 0, 'way': 0, 'relation': 0, 'tag': 0}
+
+    # ---------------------------------------------- #
+    # Attribute and tag values
+    # ---------------------------------------------- #
+    def common_attributes(self, element_id):
+        rng = self.rng
+        user, uid = self.user_choice.pick(rng)
+        timestamp = "%04d-%02d-%02dT%02d:%02d:%02dZ" % (rng.randint(2007, 2016), rng.randint(1, 12),
+                                                        rng.randint(1, 28), rng.randint(0, 23),
+                                                        rng.randint(0, 59), rng.randint(0, 59))
+        return (rng.randint(100000, 40000000), element_id, timestamp, uid, user, rng.randint(1, 12))
+
+    def street_name(self):
+        rng = self.rng
+        parts = [self.directions.pick(rng), rng.choice(STREET_NAMES)]
+        if rng.random() < 0.12:
+            parts.append(self.abbreviated.pick(rng))
+        else:
+            parts.append(self.full_types.pick(rng))
+        return " ".join(part for part in parts if part)
+
+    def postcode(self):
+        return self.postcode_formats.pick(self.rng) % self.rng.choice(ZIP_CODES)
+
+    def address_tags(self):
+        rng = self.rng
+        tags = [("addr:housenumber", str(rng.randint(1, 19999))),
+                ("addr:street", self.street_name()),
+                ("addr:postcode", self.postcode())]
+        if rng.random() < 0.6:
+            tags.append(("addr:city", rng.choice(["Denver", "Boulder", "Golden", "Lakewood"])))
+        if rng.random() < 0.3:
+            tags.append(("addr:state", "CO"))
+        return tags
+
+    def node_tags(self):
+        rng = self.rng
+        roll = rng.random()
+        if roll < 0.35:
+            return [("highway", self.node_highways.pick(rng))]
+        if roll < 0.55:
+            amenity = self.amenities.pick(rng)
+            tags = [("amenity", amenity)]
+            if amenity == "place_of_worship":
+                tags.append(("religion", self.religions.pick(rng)))
+            if rng.random() < 0.5:
+                tags.append(("name", rng.choice(PLACE_NAMES)))
+                tags.extend(self.address_tags())
+            return tags
+        if roll < 0.75:
+            natural = self.natural.pick(rng)
+            tags = [("natural", natural)]
+            if natural == "peak":
+                tags.append(("ele", str(rng.randint(1600, 4350))))
+                tags.append(("name", rng.choice(["Mount %s", "%s Peak"]) % rng.choice(PEAK_NAMES)))
+            return tags
+        if roll < 0.9:
+            return self.address_tags()
+        return [("power", "tower"), ("source", "survey")]
+
+    def tiger_tags(self):
+        rng = self.rng
+        tags = [("tiger:county", self.counties.pick(rng)),
+                ("tiger:cfcc", rng.choice(["A41", "A41", "A31", "A74"])),
+                ("tiger:reviewed", "no")]
+        direction = self.directions.pick(rng)
+        if direction:
+            tags.append(("tiger:name_direction_prefix", direction[0]))
+        tags.append(("tiger:name_base", rng.choice(STREET_NAMES)))
+        tags.append(("tiger:name_type", self.tiger_types.pick(rng)))
+        zip_code = rng.choice(ZIP_CODES)
+        tags.append(("tiger:zip_left", zip_code))
+        tags.append(("tiger:zip_right", zip_code))
+        tags.append(("tiger:source", "tiger_import_dch_v0.6_20070809"))
+        tags.append(("tiger:tlid", "%d:%d" % (rng.randint(100000000, 200000000), rng.randint(100000000, 200000000))))
+        if rng.random() < 0.5:
+            tags.append(("tiger:separated", "no"))
+        return tags
+
+    def way_tags(self):
+        rng = self.rng
+        roll = rng.random()
+        if roll < 0.6:
+            tags = [("highway", self.highways.pick(rng)), ("name", self.street_name())]
+            if rng.random() < 0.45:
+                tags.extend(self.tiger_tags())
+            if rng.random() < 0.4:
+                tags.append(("surface", self.surfaces.pick(rng)))
+            if rng.random() < 0.25:
+                tags.append(("oneway", "yes"))
+            if rng.random() < 0.15:
+                tags.append(("bicycle", rng.choice(["yes", "yes", "no", "designated"])))
+            return tags, False
+        if roll < 0.85:
+            tags = [("building", rng.choice(["yes", "yes", "yes", "house", "commercial"]))]
+            if rng.random() < 0.3:
+                tags.extend(self.address_tags())
+            return tags, True
+        if roll < 0.95:
+            return [("landuse", self.landuse.pick(rng))], True
+        return [("amenity", "parking"), ("parking", "surface")], True
+
+    # ---------------------------------------------- #
+    # XML output
+    # ---------------------------------------------- #
+    def format_tags(self, tags):
+        self.counts['tag'] += len(tags)
+        return "".join('\t\t<tag k="%s" v="%s" />\n' % (key, attr(value)) for key, value in tags)
+
+    def nodes(self):
+        rng = self.rng
+        lat = lon = None
+        for i in range(self.node_count):
+            # Start a new walk every so often
+            if lat is None or rng.random() < 0.06:
+                lat = rng.uniform(MIN_LAT, MAX_LAT)
+                lon = rng.uniform(MIN_LON, MAX_LON)
+            else:
+                lat = min(MAX_LAT, max(MIN_LAT, lat + rng.uniform(-0.0008, 0.0008)))
+                lon = min(MAX_LON, max(MIN_LON, lon + rng.uniform(-0.0008, 0.0008)))
+
+            changeset, node_id, timestamp, uid, user, version = self.common_attributes(FIRST_NODE_ID + i)
+            head = ('\t<node changeset="%d" id="%d" lat="%.7f" lon="%.7f" timestamp="%s" '
+                    'uid="%d" user="%s" version="%d"' % (changeset, node_id, lat, lon,
+                                                         timestamp, uid, attr(user), version))
+            if rng.random() < 0.08:
+                yield head + ">\n" + self.format_tags(self.node_tags()) + "\t</node>\n"
+            else:
+                yield head + " />\n"
+            self.counts['node'] += 1
+
+    def ways(self):
+        rng = self.rng
+        for i in range(self.way_count):
+            tags, closed = self.way_tags()
+            length = rng.randint(3, 8) if closed else rng.randint(2, 30)
+            start = rng.randint(0, self.node_count - length)
+            refs = [FIRST_NODE_ID + start + j for j in range(length)]
+            if closed:
+                refs.append(refs[0])
+
+            changeset, way_id, timestamp, uid, user, version = self.common_attributes(FIRST_WAY_ID + i)
+            yield ('\t<way changeset="%d" id="%d" timestamp="%s" uid="%d" user="%s" version="%d">\n'
+                   % (changeset, way_id, timestamp, uid, attr(user), version) +
+                   "".join('\t\t<nd ref="%d" />\n' % ref for ref in refs) +
+                   self.format_tags(tags) +
+                   "\t</way>\n")
+            self.counts['way'] += 1
+
+    def relations(self):
+        rng = self.rng
+        for i in range(self.relation_count):
+            kind = rng.choice(["route", "multipolygon", "restriction"])
+            if kind == "restriction":
+                members = [("way", FIRST_WAY_ID + rng.randint(0, self.way_count - 1), "from"),
+                           ("node", FIRST_NODE_ID + rng.randint(0, self.node_count - 1), "via"),
+                           ("way", FIRST_WAY_ID + rng.randint(0, self.way_count - 1), "to")]
+                tags = [("type", "restriction"),
+                        ("restriction", rng.choice(["no_left_turn", "no_right_turn", "no_u_turn"]))]
+            elif kind == "multipolygon":
+                members = [("way", FIRST_WAY_ID + rng.randint(0, self.way_count - 1), role)
+                           for role in ["outer"] + ["inner"] * rng.randint(0, 3)]
+                tags = [("type", "multipolygon"), ("landuse", self.landuse.pick(rng))]
+            else:
+                members = [("way", FIRST_WAY_ID + rng.randint(0, self.way_count - 1), "")
+                           for _ in range(rng.randint(2, 20))]
+                tags = [("type", "route"), ("route", "bus"), ("ref", str(rng.randint(1, 300)))]
+
+            changeset, relation_id, timestamp, uid, user, version = self.common_attributes(FIRST_RELATION_ID + i)
+            yield ('\t<relation changeset="%d" id="%d" timestamp="%s" uid="%d" user="%s" version="%d">\n'
+                   % (changeset, relation_id, timestamp, uid, attr(user), version) +
+                   "".join('\t\t<member ref="%d" role="%s" type="%s" />\n' % (ref, role, member_type)
+                           for member_type, ref, role in members) +
+                   self.format_tags(tags) +
+                   "\t</relation>\n")
+            self.counts['relation'] += 1
+
+    def write(self, out_path):
+        with open(out_path, 'wb') as output:
+            output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            output.write('<osm version="0.6" generator="synth_osm.py">\n')
+            output.write('\t<bounds minlat="%.2f" minlon="%.2f" maxlat="%.2f" maxlon="%.2f" />\n'
+                         % (MIN_LAT, MIN_LON, MAX_LAT, MAX_LON))
+            for elements in (self.nodes(), self.ways(), self.relations()):
+                batch = []
+                for element in elements:
+                    batch.append(element)
+                    if len(batch) >= WRITE_BATCH:
+                        output.write(encode(batch))
+                        batch = []
+                output.write(encode(batch))
+            output.write('</osm>\n')
+        return self.counts
+
+
+# ================================================== #
+# Helper Functions for the XML text
+# ================================================== #
+def attr(value):
+    return escape(value, ATTR_ESCAPES)
+
+
+def encode(parts):
+    return u"".join(parts).encode('utf-8')
+
+
+# ================================================== #
+# Function to write a synthetic OSM file
+# ================================================== #
+def write_synthetic_osm(out_path=SYNTH_FILE, scale=SCALE, seed=SEED):
+    return SyntheticOSM(scale, seed).write(out_path)
+
+
+# ================================================== #
+# Main()
+# ================================================== #
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else SCALE
+    out_path = sys.argv[2] if len(sys.argv) > 2 else SYNTH_FILE
+    print write_synthetic_osm(out_path, scale)
@@ -0,0 +1,78 @@
+####################################################################
+# File: test_audit_memory.py
+#
+# Description: Checks that auditing streams its input: the peak
+# memory of audit_tags on a synthetic file SCALE_FACTOR times
+# larger stays within a few MB of the peak on the small file.
+#
+# Run with: python -m unittest test_audit_memory
+####################################################################
+
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import unittest
+
+import audit_osm_data
+import synth_osm
+
+SMALL_SCALE  = 0.25
+SCALE_FACTOR = 8
+
+# Allowed growth of the peak RSS between the two runs
+MAX_GROWTH_MB = 5.0
+
+
+# ================================================== #
+# Helper Function run in a child process, so each
+# audit starts from the same memory and reports only
+# its own peak
+# ================================================== #
+def audit_peak_mb(osm_file, conn):
+    tags = audit_osm_data.audit_tags(osm_file)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024
+    conn.send((peak / 1024.0, sum(tags.values())))
+    conn.close()
+
+
+def measure(osm_file):
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=audit_peak_mb, args=(osm_file, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+class AuditMemoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="audit_memory_")
+        cls.small = os.path.join(cls.tmp_dir, "small.osm")
+        cls.large = os.path.join(cls.tmp_dir, "large.osm")
+        synth_osm.write_synthetic_osm(cls.small, SMALL_SCALE)
+        synth_osm.write_synthetic_osm(cls.large, SMALL_SCALE * SCALE_FACTOR)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_peak_rss_stays_flat(self):
+        small_peak, small_elements = measure(self.small)
+        large_peak, large_elements = measure(self.large)
+
+        # The large file really has SCALE_FACTOR times the elements
+        self.assertGreater(large_elements, small_elements * (SCALE_FACTOR - 1))
+        self.assertLess(large_peak - small_peak, MAX_GROWTH_MB,
+                        "peak RSS grew from %.1f MB to %.1f MB" % (small_peak, large_peak))
+
+
+if __name__ == "__main__":
+    unittest.main()
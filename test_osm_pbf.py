@@ -0,0 +1,98 @@
+####################################################################
+# File: test_osm_pbf.py
+#
+# Description: Checks that PBF files written by osm_pbf read back
+# as the same elements the XML parser gives, including nodes with
+# all, some or none of their metadata in one dense block.
+#
+# Run with: python -m unittest test_osm_pbf
+####################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import osm_parsers
+import osm_pbf
+import synth_osm
+
+FIXTURE_SCALE = 0.02
+
+TOP_LEVEL_TAGS = ('node', 'way', 'relation')
+
+PARTIAL_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="39.7" lon="-105.0" version="3" timestamp="2012-05-01T10:00:00Z" changeset="120" uid="7" user="ann"/>
+ <node id="2" lat="39.8" lon="-105.1"/>
+ <node id="3" lat="39.9" lon="-105.2" version="1" timestamp="2014-01-02T03:04:05Z"/>
+ <node id="-4" lat="-39.9" lon="105.2" uid="0" user="anon">
+  <tag k="amenity" v="bench"/>
+ </node>
+ <way id="10"><nd ref="1"/><nd ref="2"/><tag k="highway" v="path"/></way>
+</osm>
+"""
+
+
+# ================================================== #
+# Helper Functions to reduce an element to plain data.
+# The reader writes coordinates without trailing
+# zeros, so they are compared in that form
+# ================================================== #
+def plain_attrib(attrib):
+    attrib = dict(attrib)
+    for name in ('lat', 'lon'):
+        if name in attrib:
+            attrib[name] = osm_pbf.format_coord(osm_pbf.parse_coord(attrib[name], 1))
+    return sorted(attrib.items())
+
+
+def summary(elem):
+    return (elem.tag, plain_attrib(elem.attrib),
+            [(child.tag, plain_attrib(child.attrib)) for child in elem])
+
+
+class PBFRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="osm_pbf_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def check_round_trip(self, expected, pbf_path):
+        for workers in (1, 2):
+            actual = [summary(elem) for elem in osm_pbf.pbf_elements(pbf_path, TOP_LEVEL_TAGS, workers)]
+            self.assertEqual(actual, expected)
+
+    def test_fixture_mixes_nodes_with_and_without_metadata(self):
+        xml_path = self.path("fixture.osm")
+        synth_osm.write_synthetic_osm(xml_path, FIXTURE_SCALE, synth_osm.SEED)
+        expected = [summary(elem) for elem in osm_pbf.fixture_elements(xml_path)]
+
+        has_version = set('version' in dict(attrib) for tag, attrib, _ in expected if tag == 'node')
+        self.assertEqual(has_version, set([True, False]))
+
+        for options in ({}, {'dense': False, 'compress': False, 'block_elements': 97}):
+            pbf_path = self.path("fixture.osm.pbf")
+            osm_pbf.write_fixture(pbf_path, FIXTURE_SCALE, **options)
+            self.check_round_trip(expected, pbf_path)
+
+    def test_partial_metadata(self):
+        xml_path = self.path("partial.osm")
+        with open(xml_path, 'w') as xml_file:
+            xml_file.write(PARTIAL_OSM)
+        expected = [summary(elem)
+                    for elem in osm_parsers.iter_elements(xml_path, TOP_LEVEL_TAGS)]
+
+        for options in ({}, {'dense': False}):
+            pbf_path = self.path("partial.osm.pbf")
+            osm_pbf.xml_to_pbf(xml_path, pbf_path, **options)
+            self.check_round_trip(expected, pbf_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+####################################################################
+# File: test_tag_cleaner.py
+#
+# Description: Checks that the TagCleaner rules in clean_osm_data
+# clean every element's tags exactly as the original
+# clean_tiger_data, clean_addresses and clean_zip_codes functions
+# did. The original functions are kept here as the reference.
+#
+# Run with: python -m unittest test_tag_cleaner
+####################################################################
+
+import cStringIO
+import sys
+import unittest
+
+import clean_osm_data
+from clean_osm_data import (get_element_id, is_postcode_valid, make_tag,
+                            remove_whitespace, street_normalizer, tag_cleaner)
+
+OSM_FILE = 'denver-boulder_colorado_small.osm'
+
+
+# ================================================== #
+# Function to clean TIGER data addresses and zip codes
+# ================================================== #
+def clean_tiger_data(list_of_tags):
+
+    #TAGS_FIELDS = ['id', 'key', 'value', 'type']
+    new_list_of_tags = []
+
+    street_str   = []
+    city_str     = ""
+    id_str       = ""
+    zipcode_str = ""
+
+    for tag_item in list_of_tags:
+
+        # TIGER data
+        if tag_item["type"] == "tiger":
+
+            # County <=> City
+            if tag_item["key"] == "county":
+                new_tag_item         = {}
+                new_tag_item['type'] = "addr"
+                new_tag_item['key']  = "county"
+                new_tag_item['id']   = tag_item['id']
+                if "," in  tag_item["value"]:
+                    new_tag_item['value'] = tag_item["value"].split(",", 1)[0]
+                else:
+                    new_tag_item['value'] = tag_item["value"]
+                new_list_of_tags.append(new_tag_item)
+
+            # zipcode
+            if tag_item["key"] == "zip_left":
+                new_tag_item          = {}
+                new_tag_item['type']  = "addr"
+                new_tag_item['key']   = "postcode"
+                new_tag_item['id']    = tag_item['id']
+                new_tag_item['value'] = tag_item["value"]
+                new_list_of_tags.append(new_tag_item)
+
+            # street_address pt1"
+            if tag_item["key"] == "name_direction_prefix":
+                street_str.insert(0, tag_item["value"])
+
+            # street_address pt2"
+            if tag_item["key"] == "name_base":
+                street_str.insert(1, tag_item["value"])
+
+            # street_address pt3"
+            if tag_item["key"] == "name_type":
+                street_str.insert(2, tag_item["value"])
+
+        # Non Tiger item, don't change
+        else:
+            new_list_of_tags.append(tag_item)
+
+        # Add an item of the joined street address
+    if (len(street_str) != 0):
+        new_tag_item          = {}
+        new_tag_item['type']  = "addr"
+        new_tag_item['key']   = "street"
+        new_tag_item['id']    = tag_item['id']
+        new_tag_item['value'] = " ".join(street_str)
+        new_list_of_tags.append(new_tag_item)
+
+    return new_list_of_tags
+
+
+# ================================================== #
+# Function to clean address names of mistakes
+# ================================================== #
+def clean_addresses(list_of_tags):
+
+    for item in list_of_tags:
+
+        # Street name
+        if (item['key'] == "street"):
+            item['value'] = street_normalizer(item['value'])
+
+    return list_of_tags
+
+
+# ================================================== #
+# Function to clean zip codes of mistakes
+# ================================================== #
+def clean_zip_codes(list_of_tags):
+
+    for item in list_of_tags:
+        if(item['key'] == "postcode"):
+
+            # Assign the postcode to a local variable
+            postcode = item['value']
+
+            # Remove whitespace to standardize format
+            postcode = remove_whitespace(postcode)
+
+            # Standardize each postcode format
+
+            if (len(postcode) == 5
+                and is_postcode_valid(postcode)):
+
+                # Standard 5 digit postcode
+                item['value'] = postcode
+
+            elif (len(postcode) == 10
+                  and postcode[5] == "-"
+                  and is_postcode_valid(postcode[:5])):
+
+                # Grab 5 digits from ZIP+4 format
+                item['value'] = postcode[:5]
+
+
+            elif (len(postcode) == 7
+                  and postcode[:2] == "CO"
+                  and is_postcode_valid(postcode[2:])):
+
+                # Correct zip code in format "CO80214"
+                item['value'] = postcode[2:]
+
+            elif (len(postcode) == 14
+                  and postcode[:9] == "Golden,CO"
+                  and is_postcode_valid(postcode[9:])):
+
+                # Correct zip code in format "Golden, CO 80401"
+                item['value'] = postcode[9:]
+
+            elif (";" in postcode):
+
+                # Add all valid postalcode values if multiples listed
+                for new_postcode in postcode.split(';'):
+                    new_tag = item.copy()
+                    new_tag['value'] = new_postcode
+                    if(is_postcode_valid(new_postcode)):
+                        list_of_tags.append(new_tag)
+                list_of_tags.remove(item)
+
+            elif (":" in postcode):
+
+                # Add all valid postalcode values if range listed
+                for new_postcode in range(int(postcode.split(':')[0]), int(postcode.split(':')[1])):
+                    new_tag = item.copy()
+                    new_tag['value'] = str(new_postcode)
+                    if (is_postcode_valid(str(new_postcode))):
+                        list_of_tags.append(new_tag)
+                list_of_tags.remove(item)
+
+            else:
+
+                # Display the bad postcodes
+                print "Bad postcode: " + postcode
+
+                # Remove bad postal code
+                list_of_tags.remove(item)
+
+    return list_of_tags
+
+
+# ================================================== #
+# Helper Function to gather the uncleaned tags of an
+# element
+# ================================================== #
+def get_raw_tags(element):
+
+    element_id = get_element_id(element)
+    return [make_tag(element_id, subelem.attrib)
+            for subelem in element if subelem.tag == "tag"]
+
+
+class TagCleanerParityTest(unittest.TestCase):
+
+    def test_sample_file_matches_original_cleaners(self):
+        checked    = 0
+        mismatches = []
+
+        # Both paths print every bad postcode, keep that out
+        # of the test output
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            for element in clean_osm_data.get_element(OSM_FILE, tags=('node', 'way')):
+                tags     = get_raw_tags(element)
+                expected = clean_zip_codes(clean_addresses(clean_tiger_data([dict(tag._asdict())
+                                                                             for tag in tags])))
+                actual   = [dict(tag._asdict()) for tag in tag_cleaner.clean(tags)]
+                if actual != expected:
+                    mismatches.append((get_element_id(element), expected, actual))
+                checked += 1
+        finally:
+            sys.stdout = stdout
+
+        self.assertGreater(checked, 0)
+        self.assertEqual(mismatches, [])
+
+
+if __name__ == "__main__":
+    unittest.main()